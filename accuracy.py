@@ -0,0 +1,176 @@
+# Provider accuracy weights: keeps running error statistics per region, provider and variable, and turns them into
+# weights for the consensus (aggregation.aggregate's 'weighted_mean').
+#
+# There's no ground truth to compare against, so a provider's error for a lookup is how far its reading is from the
+# mean of the other providers' readings. Mean and variance of that error are updated with Welford's method as each
+# lookup arrives, and a provider's weight is 1 / its mean squared error. Until a region has enough lookups the
+# statistics are pulled towards a prior (the same for every provider), so weights start out equal.
+#
+# Providers whose weight for a region is negligible for every variable they supply can be skipped, saving the
+# upstream call. A skipped provider is still fetched every RECHECK_INTERVAL seconds so its weight can recover.
+#
+# Readings served again from the forecast cache aren't new evidence, so a provider's reading is only counted the first
+# time it is seen for a forecast location.
+import math
+import threading
+import time
+
+import numpy as np
+
+import aggregation  # Module for averaging provider readings
+import cache  # Module containing a TTL/LRU cache
+
+# Regions are REGION_DEGREES x REGION_DEGREES cells of latitude / longitude
+REGION_DEGREES = 2
+
+# Prior mean squared error per variable (in aggregation.VARIABLES order) and how many lookups it counts as
+PRIOR_MSE = np.array([1.0, 2.0, 4.0, 100.0, 25.0])
+PRIOR_COUNT = 10
+
+# A provider is skipped when its share of the total weight is below MIN_WEIGHT_SHARE for every variable it supplies,
+# once it has at least MIN_OBSERVATIONS lookups for each of them
+MIN_WEIGHT_SHARE = 0.05
+MIN_OBSERVATIONS = 24
+
+# Seconds between fetches of a skipped provider
+RECHECK_INTERVAL = 6 * 60 * 60
+
+# Providers that are never skipped, because they're the only source of something on the page: the Met Office
+# supplies the weather code, UV index, gusts and snow, BBC Weather the wind description and Yr.No the rain amount
+NEVER_SKIP = ('MetOffice', 'BBCWeather', 'YrNo')
+
+# Last reading counted per (forecast location, provider): how many are remembered, and for how long
+MAX_COUNTED = 100000
+COUNTED_TTL = 24 * 60 * 60
+
+
+def region(latitude, longitude):
+
+    return (math.floor(float(latitude) / REGION_DEGREES), math.floor(float(longitude) / REGION_DEGREES))
+
+
+def errors(readings):
+
+    # Each provider's difference from the mean of the other providers, for one location's (providers, variables)
+    # readings (NaN where the provider or all the others have no reading)
+    valid = ~np.isnan(readings)
+    values = np.where(valid, readings, 0.0)
+
+    others_count = valid.sum(axis=0) - valid
+    with np.errstate(invalid='ignore', divide='ignore'):
+        others_mean = (values.sum(axis=0) - values) / others_count
+
+    return np.where(valid & (others_count > 0), readings - others_mean, np.nan)
+
+
+class RegionStats:
+
+    def __init__(self):
+
+        # Welford running count, mean and sum of squared differences of the error, shape (providers, variables)
+        shape = (len(aggregation.PROVIDERS), len(aggregation.VARIABLES))
+        self.count = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+        # Provider name -> time it last returned readings
+        self.last_seen = {}
+
+    def update(self, error):
+
+        valid = ~np.isnan(error)
+        self.count += valid
+
+        delta = np.where(valid, error - self.mean, 0.0)
+        self.mean += np.where(valid, delta / np.maximum(self.count, 1), 0.0)
+        self.m2 += np.where(valid, delta * (np.where(valid, error, 0.0) - self.mean), 0.0)
+
+    def mean_squared_error(self):
+
+        # Bias squared plus variance (m2 + count * mean^2 is the sum of squared errors), pulled towards the prior
+        return (self.m2 + self.count * self.mean ** 2 + PRIOR_COUNT * PRIOR_MSE) / (self.count + PRIOR_COUNT)
+
+
+class AccuracyEngine:
+
+    def __init__(self, min_weight_share=MIN_WEIGHT_SHARE, min_observations=MIN_OBSERVATIONS,
+                 recheck_interval=RECHECK_INTERVAL, never_skip=NEVER_SKIP):
+
+        self.min_weight_share = min_weight_share
+        self.min_observations = min_observations
+        self.recheck_interval = recheck_interval
+        self.never_skip = never_skip
+
+        # region -> RegionStats
+        self.regions = {}
+        self.lock = threading.Lock()
+
+        # (forecast location, provider) -> bytes of the last reading counted
+        self.counted = cache.TTLCache(maxsize=MAX_COUNTED, ttl=COUNTED_TTL)
+
+    def update(self, latitude, longitude, readings, location=None, now=None):
+
+        # Called with one location's (providers, variables) readings from aggregation.collect. 'location' identifies
+        # where the readings were fetched for: a provider's reading already counted there (a cache hit) is only used
+        # as one of the 'other providers' for the rest
+        now = time.time() if now is None else now
+        error = errors(readings)
+
+        if location is not None:
+            for provider_index, provider in enumerate(aggregation.PROVIDERS):
+                reading = readings[provider_index].tobytes()
+                if self.counted.get((location, provider)) == reading:
+                    error[provider_index] = np.nan
+                else:
+                    self.counted.set((location, provider), reading)
+
+        with self.lock:
+            stats = self.regions.setdefault(region(latitude, longitude), RegionStats())
+            stats.update(error)
+
+            for provider_index, provider in enumerate(aggregation.PROVIDERS):
+                if not np.isnan(readings[provider_index]).all():
+                    stats.last_seen[provider] = now
+
+    def weights(self, latitude, longitude):
+
+        # (providers, variables) weights for aggregation.aggregate, equal for a region with no statistics yet
+        with self.lock:
+            stats = self.regions.get(region(latitude, longitude))
+            if stats is None:
+                return np.ones((len(aggregation.PROVIDERS), len(aggregation.VARIABLES)))
+
+            return 1 / stats.mean_squared_error()
+
+    def skipped(self, latitude, longitude, now=None):
+
+        # Providers not worth fetching for this location right now
+        now = time.time() if now is None else now
+
+        with self.lock:
+            stats = self.regions.get(region(latitude, longitude))
+            if stats is None:
+                return set()
+
+            count = stats.count.copy()
+            last_seen = dict(stats.last_seen)
+
+            # Share of each variable's weight among the providers that supply it
+            weights = np.where(count > 0, 1 / stats.mean_squared_error(), 0.0)
+            with np.errstate(invalid='ignore'):
+                share = weights / weights.sum(axis=0)
+
+        skipped = set()
+        for provider_index, provider in enumerate(aggregation.PROVIDERS):
+            if provider in self.never_skip or now - last_seen.get(provider, 0) >= self.recheck_interval:
+                continue
+
+            # Only the variables the provider supplies
+            supplied = count[provider_index] > 0
+            if not supplied.any() or (count[provider_index][supplied] < self.min_observations).any():
+                continue
+
+            if (share[provider_index][supplied] < self.min_weight_share).all():
+                skipped.add(provider)
+
+        return skipped
@@ -0,0 +1,79 @@
+# Consensus aggregation: puts every provider's readings into one preallocated array and works out the
+# averages (and spread) for all variables, and any number of locations, in a single vectorised pass.
+#
+# Readings arrays have the shape (locations, providers, variables). A provider that didn't answer, or doesn't
+# supply a variable, is NaN and is left out of every statistic.
+import numpy as np
+import warnings
+
+# Providers and variables, in array order
+PROVIDERS = ('OpenWeather', 'MetOffice', 'BBCWeather', 'YrNo')
+VARIABLES = ('temperature', 'feels_like', 'wind_speed', 'rain_chance', 'humidity')
+
+# Position of each variable along the last axis, e.g. readings[:, :, VARIABLE_INDEX['humidity']]
+VARIABLE_INDEX = {variable: index for index, variable in enumerate(VARIABLES)}
+
+# Fraction cut from each end of the sorted readings for the trimmed mean
+TRIM_PROPORTION = 0.25
+
+
+def collect(locations_data):
+
+    # 'locations_data' is a list with one {provider name: records.Reading} per location (providers parse their
+    # values with records.number, so readings are already numeric, NaN where missing)
+    readings = np.full((len(locations_data), len(PROVIDERS), len(VARIABLES)), np.nan)
+
+    for location_index, provider_data in enumerate(locations_data):
+        for provider_index, provider in enumerate(PROVIDERS):
+            data = provider_data.get(provider)
+            if data is None:
+                continue
+            readings[location_index, provider_index] = [getattr(data, variable) for variable in VARIABLES]
+
+    return readings
+
+
+def aggregate(readings, weights=None, trim_proportion=TRIM_PROPORTION):
+
+    # Returns {statistic: array of shape (locations, variables)}
+    # 'weights' is optional, either one weight per provider or an array that broadcasts against 'readings'
+    valid = ~np.isnan(readings)
+    count = valid.sum(axis=1)
+    values = np.where(valid, readings, 0.0)
+
+    if weights is None:
+        weights = np.ones(len(PROVIDERS))
+    weights = np.asarray(weights, dtype=float)
+    if weights.ndim == 1:
+        weights = weights[None, :, None]
+    weights = np.where(valid, weights, 0.0)
+
+    # Locations/variables with no readings come out as NaN rather than warnings
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        mean = values.sum(axis=1) / count
+        weighted_mean = (values * weights).sum(axis=1) / weights.sum(axis=1)
+        median = np.nanmedian(readings, axis=1)
+        minimum = np.nanmin(readings, axis=1)
+        maximum = np.nanmax(readings, axis=1)
+        std = np.sqrt((np.where(valid, readings - mean[:, None, :], 0.0) ** 2).sum(axis=1) / count)
+
+        # Trimmed mean: sort each provider column (NaNs go last) and keep ranks in [cut, count - cut)
+        ordered = np.sort(readings, axis=1)
+        ranks = np.arange(len(PROVIDERS))[None, :, None]
+        cut = np.floor(count * trim_proportion)[:, None, :]
+        kept = (ranks >= cut) & (ranks < count[:, None, :] - cut)
+        trimmed_mean = np.where(kept, ordered, 0.0).sum(axis=1) / kept.sum(axis=1)
+
+    return {
+        'count': count,
+        'mean': mean,
+        'weighted_mean': weighted_mean,
+        'median': median,
+        'trimmed_mean': trimmed_mean,
+        'min': minimum,
+        'max': maximum,
+        'spread': maximum - minimum,
+        'std': std
+    }
@@ -1,10 +1,12 @@
 # Import packages
-import requests
-from dataclasses import dataclass
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, Response, stream_with_context
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import json
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import math
 import numpy as np
-from bs4 import BeautifulSoup
-from datetime import datetime
+import logging
 import time
 from dotenv import load_dotenv
 import os
@@ -15,8 +17,85 @@ GeoNamesUsername = os.getenv('GeoNamesUsername')
 OpenWeatherAPIKey = os.getenv('OpenWeatherAPIKey')
 MetOfficeAPIKey = os.getenv('MetOfficeAPIKey')
 
+# Provider base URLs (can be overridden in '.env', e.g. to point at a local stub server)
+GeoNamesURL = os.getenv('GeoNamesURL', 'http://api.geonames.org')
+OpenWeatherURL = os.getenv('OpenWeatherURL', 'https://api.openweathermap.org')
+MetOfficeURL = os.getenv('MetOfficeURL', 'https://data.hub.api.metoffice.gov.uk')
+BBCWeatherURL = os.getenv('BBCWeatherURL', 'https://bbc.co.uk')
+YrNoURL = os.getenv('YrNoURL', 'https://www.yr.no')
+
+# Logging, one 'event key=value ...' line per message. Set 'LogLevel=DEBUG' in '.env' to log provider data and readings
+logging.basicConfig(level=os.getenv('LogLevel', 'INFO'), format='%(asctime)s %(levelname)s %(name)s %(message)s')
+logger = logging.getLogger('weather')
+
 # Import modules
 import conversions  # Module containing constants for common conversions e.g. M/S to MPH
+import fanout  # Module for running provider fetches concurrently
+import cache  # Module containing a TTL/LRU cache
+import http_client  # Module containing the shared, pooled HTTP session for outbound requests
+import html_extract  # Module for pulling elements out of scraped web pages
+import forecast_cache  # Module for caching provider results per location and time bucket
+import prefetch  # Module for refreshing popular locations in the background
+import aggregation  # Module for averaging provider readings
+import ephemeris  # Module for calculating sunrise/sunset and moon phase
+import timeseries  # Module for indexing hourly forecasts
+import conditions  # Module containing the weather condition table (descriptions, emoji, images, UV bands)
+import single_flight  # Module for sharing one upstream call between identical concurrent lookups
+import circuit_breaker  # Module for skipping providers while they are unhealthy
+import metrics  # Module for latency histograms and counters
+import page_cache  # Module for caching rendered results pages
+import records  # Module containing the typed provider reading / weather report records
+import history  # Module for storing past provider readings per location
+import accuracy  # Module for weighting providers by their running accuracy
+import gazetteer  # Module for offline town lookups from a GeoNames dump
+import spatial  # Module for snapping locations to forecast cells
+import quota  # Module for per-provider upstream request quotas
+import hedging  # Module for hedging slow upstream calls with a second request
+
+# Geocoding cache, keyed on normalised (town, country code). Set 'GeoCacheFile' in '.env' to keep it across restarts
+GEO_CACHE_SIZE = 5000
+GEO_CACHE_TTL = 7 * 24 * 60 * 60  # One week - towns don't move
+geo_cache = cache.TTLCache(maxsize=GEO_CACHE_SIZE, ttl=GEO_CACHE_TTL, path=os.getenv('GeoCacheFile'))
+
+# Offline gazetteer index (build it with 'python gazetteer.py build'), searched before calling GeoNames.
+# Set 'GazetteerFile' in '.env' if it isn't 'gazetteer.idx', lookups go straight to GeoNames if there's no index
+GazetteerFile = os.getenv('GazetteerFile', 'gazetteer.idx')
+gazetteer_index = gazetteer.Gazetteer(GazetteerFile) if GazetteerFile and os.path.exists(GazetteerFile) else None
+
+# History of every lookup's provider readings, per location and hour. Set 'HistoryFile' in '.env' to choose the
+# SQLite file, or set it empty to turn history off
+HistoryFile = os.getenv('HistoryFile', 'weather_history.db')
+history_store = history.HistoryStore(HistoryFile) if HistoryFile else None
+
+# Running error statistics per region and provider, used to weight the averages and skip inaccurate providers
+accuracy_engine = accuracy.AccuracyEngine()
+
+# Forecast cell size in km: locations in the same cell share provider fetches and cached results. Set
+# 'ForecastCellKm' in '.env' to change it, or to 0 to fetch every location separately
+ForecastCellKm = float(os.getenv('ForecastCellKm', '2'))
+forecast_grid = spatial.Grid(ForecastCellKm) if ForecastCellKm > 0 else None
+
+# Upstream request quotas (rates and daily budgets in quota.LIMITS). Set 'UpstreamQuotas' in '.env' to 'off' to
+# turn them off, e.g. when pointing the providers at a local stub
+UpstreamQuotas = os.getenv('UpstreamQuotas', 'on')
+if UpstreamQuotas == 'off':
+    quota.quotas.clear()
+
+# Slow provider calls are repeated, and the first answer used, once they pass the provider's recent p95 latency
+# (see 'hedging'). Set 'HedgedRequests' in '.env' to 'off' to turn hedging off
+HedgedRequests = os.getenv('HedgedRequests', 'on')
+if HedgedRequests == 'off':
+    hedging.hedged.clear()
+
+# Forecast cache TTLs in seconds, per provider. Stale results are served while a background refresh runs
+OPENWEATHER_TTL = 10 * 60
+METOFFICE_TTL = 60 * 60
+BBCWEATHER_TTL = 30 * 60
+YRNO_TTL = 30 * 60
+
+# Forecast cache time buckets in seconds (weather is hourly, the Met Office forecast covers ~48 hours)
+HOURLY = 60 * 60
+METOFFICE_BUCKET = 12 * 60 * 60
 
 # Functions
 def validate_request(submitted_field):
@@ -33,169 +112,170 @@ def validate_request(submitted_field):
 
 def geo_coder(town, country_code):
 
-    api_search_url = f'http://api.geonames.org/searchJSON?q={town}&country={country_code}&featureClass=P&continentCode=&fuzzy=0.6&username={GeoNamesUsername}'
-
     # Validate submitted form fields for request (using helper function)
-    if validate_request(town) is True and validate_request(country_code) is True:
-        geonames_request = requests.get(api_search_url)
-    else:
+    if validate_request(town) is False or validate_request(country_code) is False:
         return "Error"
 
-    # Bad request
-    if geonames_request.status_code == 401 or geonames_request.json()['totalResultsCount'] == 0:
-        return "Error"  # Use this returned string "Error" later to redirect user
+    # Check the cache first
+    cache_key = geo_coder_key(town, country_code)
+    geo_coder_data = geo_cache.get(cache_key)
 
-    # Store geocoding information
-    name = geonames_request.json()['geonames'][0]['name']
-    country_code = geonames_request.json()['geonames'][0]['countryCode']
-    latitude = geonames_request.json()['geonames'][0]['lat']
-    longitude = geonames_request.json()['geonames'][0]['lng']
-    location_id = geonames_request.json()['geonames'][0]['geonameId']
+    if geo_coder_data is not None:
+        return geo_coder_data
 
-    # GeoNames data
-    geo_coder_data = {
-        'name': name,
-        'country_code': country_code,
-        'latitude': latitude,
-        'longitude': longitude,
-        'location_id': location_id
-    }
+    # Then the offline gazetteer
+    geo_coder_data = local_geo_coder(town, country_code)
+
+    if geo_coder_data is not None:
+        return geo_coder_data
+
+    # Identical lookups arriving together share one GeoNames call
+    return single_flight.group.do(('GeoNames',) + cache_key, geo_coder_fetch, town, country_code, cache_key)
+
+
+def local_geo_coder(town, country_code):
+
+    # Same fields as geo_coder_result from the offline gazetteer, None if there's no index or no match
+    if gazetteer_index is None:
+        return None
+
+    geo_coder_data = gazetteer_index.search(town, country_code)
+
+    metrics.increment('weather_cache_requests_total', cache='gazetteer', result='miss' if geo_coder_data is None else 'hit')
 
     return geo_coder_data
 
 
-def bs4logic(url):
+def geo_coder_fetch(town, country_code, cache_key):
 
-    # Make a request to url
-    response = requests.get(url)
+    # Every GeoNames call counts against our quota (forecast providers take theirs in forecast_cache)
+    if not geo_coder_quota():
+        return "Busy"  # Use this returned string "Busy" later to ask the user to try again shortly
 
-    # Parse webpage with Beautiful Soup
-    soup = BeautifulSoup(response.content, "html.parser")
+    geonames_request = http_client.get(geo_coder_url(town, country_code))
 
-    return soup
+    return geo_coder_result(cache_key, geonames_request)
 
 
-def clean_data(variable):
+def geo_coder_quota():
 
-    # Convert value to string
-    variable = str(variable)
+    # Whether a GeoNames call may go ahead (False if the quota is used up for now - nothing is cached, so the same
+    # lookup works again once there are tokens)
+    try:
+        quota.acquire('GeoNames')
+    except quota.QuotaExceededError as error:
+        logger.warning('geocode_busy error="%s"', error)
+        return False
 
-    # Remove any degree symbols, percentage signs, or spaces
-    variable = variable.strip("°% ")
+    return True
 
-    # Convert into float
-    variable = float(variable)
 
-    return variable
+def geo_coder_key(town, country_code):
 
+    # Normalised town and country code e.g. (' new  york', 'us') -> ('new york', 'US')
+    return (' '.join(town.split()).lower(), country_code.strip().upper())
 
-def format_variable(variable):
 
-    # Convert to float
-    variable = float(variable)
+def geo_coder_url(town, country_code):
 
-    # Round float
-    variable = round(variable, 1)
+    return f'{GeoNamesURL}/searchJSON?q={town}&country={country_code}&featureClass=P&continentCode=&fuzzy=0.6&style=FULL&username={GeoNamesUsername}'
 
-    # If the float is a whole number, convert it to an integer
-    if variable % 1 == 0:
-        variable = int(variable)
 
-    # Convert variable into string for output
-    variable = str(variable)
+def geo_coder_result(cache_key, geonames_request):
 
-    return variable
+    # Bad request (HTTP status code outside 200-299, or a reply that isn't JSON)
+    if not 200 <= geonames_request.status_code < 300:
+        return "Error"  # Use this returned string "Error" later to redirect user
 
-# Weather emoji picker
-def weather_emoji_picker(weather_desc):
+    try:
+        geonames_json = geonames_request.json()
+    except ValueError:
+        return "Error"
 
-    # HTMl Emojis start with '&#' followed by a number
-    emoji_base = '&#'
+    if geonames_json['totalResultsCount'] == 0:
+        return "Error"
 
-    # HTML emoji codes mapped to weather description
-    emoji_codes = {
-        "Not available": "10068",
-        "Clear night": "127747",
-        "Sunny day": "127775",
-        "Partly cloudy (night)": "9729",
-        "Partly cloudy (day)": "9925",
-        "Not used": "10068",
-        "Mist": "127787;&#65039",
-        "Fog": "127787;&#65039",
-        "Cloudy": "9729;&#65039",
-        "Overcast": "127745",
-        "Light rain shower (night)": "9748",
-        "Light rain shower (day)": "9748",
-        "Drizzle": "9748",
-        "Light rain": "9748",
-        "Heavy rain shower (night)": "9748",
-        "Heavy rain shower (day)": "9748",
-        "Heavy rain": "9748",
-        "Sleet shower (night)": "127784;&#65039",
-        "Sleet shower (day)": "127784;&#65039",
-        "Sleet": "127784;&#65039",
-        "Hail shower (night)": "127784;&#65039",
-        "Hail shower (day)": "127784;&#65039",
-        "Hail": "127784;&#65039",
-        "Light snow shower (night)": "127784;&#65039",
-        "Light snow shower (day)": "127784;&#65039",
-        "Light snow": "9731;&#65039",
-        "Heavy snow shower (night)": "9731;&#65039",
-        "Heavy snow shower (day)": "9731;&#65039",
-        "Heavy snow": "9731;&#65039",
-        "Thunder shower (night)": "127785;&#65039",
-        "Thunder shower (day)": "127785;&#65039",
-        "Thunder": "127785;&#65039"
+    # Store geocoding information
+    first_result = geonames_json['geonames'][0]
+
+    # GeoNames data
+    geo_coder_data = {
+        'name': first_result['name'],
+        'country_code': first_result['countryCode'],
+        'latitude': first_result['lat'],
+        'longitude': first_result['lng'],
+        'location_id': first_result['geonameId'],
+        'timezone': first_result.get('timezone', {}).get('timeZoneId')
     }
 
-    weather_emoji = emoji_base + emoji_codes[weather_desc]
-
-    return weather_emoji
-
-# Weather image picker
-def weather_image_picker(weather_desc):
-
-    weather_image = ''
-
-    # HTML code for image to be inserted in webpage mapped to weather descriptions
-    weather_images_dict = {
-        "Not available": '<img src="static/weatherimages/NotAvailable.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Clear night": '<img src="static/weatherimages/ClearNight.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Sunny day": '<img src="static/weatherimages/Sunny.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Partly cloudy (night)": '<img src="static/weatherimages/CloudyNight.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Partly cloudy (day)": '<img src="static/weatherimages/CloudyDay.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Not used": '<img src="static/weatherimages/NotAvailable.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Mist": '<img src="static/weatherimages/Mist.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Fog": '<img src="static/weatherimages/Fog.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Cloudy": '<img src="static/weatherimages/Cloudy.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Overcast": '<img src="static/weatherimages/Overcast.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Light rain shower (night)": '<img src="static/weatherimages/LightRainShowerNight.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Light rain shower (day)": '<img src="static/weatherimages/LightRainShowerDay.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Drizzle": '<img src="static/weatherimages/Drizzle.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Light rain": '<img src="static/weatherimages/LightRain.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Heavy rain shower (night)": '<img src="static/weatherimages/HeavyRainShowerNight.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Heavy rain shower (day)": '<img src="static/weatherimages/HeavyRainShowerDay.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Heavy rain": '<img src="static/weatherimages/HeavyRain.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Sleet shower (night)": '<img src="static/weatherimages/SleetShowerNight.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Sleet shower (day)": '<img src="static/weatherimages/SleetShowerDay.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Sleet": '<img src="static/weatherimages/Sleet.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Hail shower (night)": '<img src="static/weatherimages/HailShowerNight.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Hail shower (day)": '<img src="static/weatherimages/HailShowerDay.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Hail": '<img src="static/weatherimages/Hail.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Light snow shower (night)": '<img src="static/weatherimages/LightSnowShowerNight.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Light snow shower (day)": '<img src="static/weatherimages/LightSnowShowerDay.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Light snow": '<img src="static/weatherimages/LightSnow.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Heavy snow shower (night)": '<img src="static/weatherimages/HeavySnowShowerNight.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Heavy snow shower (day)": '<img src="static/weatherimages/HeavySnowShowerDay.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Heavy snow": '<img src="static/weatherimages/HeavySnow.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Thunder shower (night)": '<img src="static/weatherimages/ThunderShowerNight.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Thunder shower (day)": '<img src="static/weatherimages/ThunderShowerDay.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
-        "Thunder": '<img src="static/weatherimages/Thunder.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>',
+    geo_cache.set(cache_key, geo_coder_data)
+
+    return geo_coder_data
+
+
+def reverse_geo_coder(latitude, longitude):
+
+    # Validate coordinates
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+    except (TypeError, ValueError):
+        return "Error"
+
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return "Error"
+
+    # Check the cache first, coordinates rounded to ~100m
+    cache_key = (f'@{latitude:.3f},{longitude:.3f}', '')
+    geo_coder_data = geo_cache.get(cache_key)
+
+    # Identical lookups arriving together share one GeoNames call
+    if geo_coder_data is None:
+        geo_coder_data = single_flight.group.do(('GeoNames',) + cache_key, reverse_geo_coder_fetch, latitude, longitude,
+                                                cache_key)
+
+    if geo_coder_data in ("Error", "Busy"):
+        return geo_coder_data
+
+    # The nearest place is shared by every lookup rounded to the same coordinates, but each lookup's forecast is for
+    # its own exact coordinates (not those of whichever lookup fetched the place)
+    return dict(geo_coder_data, latitude=str(latitude), longitude=str(longitude))
+
+
+def reverse_geo_coder_fetch(latitude, longitude, cache_key):
+
+    api_search_url = f'{GeoNamesURL}/findNearbyPlaceNameJSON?lat={latitude}&lng={longitude}&style=FULL&username={GeoNamesUsername}'
+
+    if not geo_coder_quota():
+        return "Busy"
+
+    geonames_request = http_client.get(api_search_url)
+
+    # Bad request (HTTP status code outside 200-299, or a reply that isn't JSON)
+    if not 200 <= geonames_request.status_code < 300:
+        return "Error"
+
+    try:
+        nearby_places = geonames_request.json().get('geonames', [])
+    except ValueError:
+        return "Error"
+
+    if len(nearby_places) == 0:
+        return "Error"
+
+    # Nearest place supplies the name and ID for the scrapers, but the forecast is for the exact coordinates given
+    geo_coder_data = {
+        'name': nearby_places[0]['name'],
+        'country_code': nearby_places[0]['countryCode'],
+        'latitude': str(latitude),
+        'longitude': str(longitude),
+        'location_id': nearby_places[0]['geonameId'],
+        'timezone': nearby_places[0].get('timezone', {}).get('timeZoneId')
     }
 
-    weather_image = weather_images_dict[weather_desc]
+    geo_cache.set(cache_key, geo_coder_data)
 
-    return weather_image
+    return geo_coder_data
 
 
 # Main Logic:
@@ -204,27 +284,36 @@ def weather_image_picker(weather_desc):
 # Get weather information from:
 # 1. OpenWeather
 # 2. Met Office
-# 3. BBC Weather (+Sunrise/Sunset)
+# 3. BBC Weather
 # 4. Yr.No
 
-# Additional:
-# TimeandDate.com - 'timeanddate.com/moon/phases' (Moon Phase)
+# Additional (calculated locally):
+# Sunrise/Sunset and Moon Phase
 
 # -------------------
 
 # OpenWeather:
 
+@forecast_cache.cached(ttl=OPENWEATHER_TTL, bucket_seconds=HOURLY)
 def OpenWeather(latitude, longitude):
 
-    base_url = 'https://api.openweathermap.org/data/2.5/weather'
+    # Request
+    ow_request = http_client.get(openweather_url(latitude, longitude))
 
-    query_url = f"{base_url}?lat={latitude}&lon={longitude}&units=metric&APPID={OpenWeatherAPIKey}"
+    return openweather_data(ow_request)
 
-    # Request
-    ow_request = requests.get(query_url)
+
+def openweather_url(latitude, longitude):
+
+    base_url = f'{OpenWeatherURL}/data/2.5/weather'
+
+    return f"{base_url}?lat={latitude}&lon={longitude}&units=metric&APPID={OpenWeatherAPIKey}"
+
+
+def openweather_data(ow_request):
 
     # Check if the request is ok (HTTP status code within 200-299)
-    if ow_request.ok is False:
+    if not 200 <= ow_request.status_code < 300:
         raise Exception("OpenWeather API received a bad request.")
 
     # Data
@@ -236,14 +325,18 @@ def OpenWeather(latitude, longitude):
     weather_desc = data['weather'][0]['description']
     humidity = data['main']['humidity']
 
+    # Map the description onto a Met Office weather code (icon names end in 'n' at night)
+    night = data['weather'][0].get('icon', '').endswith('n')
+    weather_code = conditions.normalise_openweather(weather_desc, night=night)
+
     # Open Weather data
-    ow_data = {
-        'temperature': temperature,
-        'feels_like': feels_like,
-        'wind_speed': wind_speed,
-        'weather_desc': weather_desc,
-        'humidity': humidity
-    }
+    ow_data = records.Reading(
+        temperature=float(temperature),
+        feels_like=float(feels_like),
+        wind_speed=float(wind_speed),
+        humidity=float(humidity),
+        weather_code=records.NO_CODE if weather_code is None else weather_code
+    )
 
     return ow_data
 
@@ -251,9 +344,32 @@ def OpenWeather(latitude, longitude):
 
 # Met Office:
 
-def MetOffice(latitude, longitude):
+# Fields kept from each hourly step of the Met Office forecast
+METOFFICE_FIELDS = (
+    'screenTemperature',
+    'feelsLikeTemperature',
+    'windSpeed10m',
+    'windGustSpeed10m',
+    'probOfPrecipitation',
+    'totalSnowAmount',
+    'significantWeatherCode',
+    'uvIndex',
+    'screenRelativeHumidity'
+)
+
+@forecast_cache.cached(ttl=METOFFICE_TTL, bucket_seconds=METOFFICE_BUCKET)
+def MetOfficeForecast(latitude, longitude):
+
+    url, headers, params = metoffice_request(latitude, longitude)
+
+    req = http_client.get(url, headers=headers, params=params)
+
+    return metoffice_forecast(req)
+
 
-    base_url = 'https://data.hub.api.metoffice.gov.uk/sitespecific/v0/point/'
+def metoffice_request(latitude, longitude):
+
+    base_url = f'{MetOfficeURL}/sitespecific/v0/point/'
 
     # Met Office weather parameters
     requestHeaders = {"apikey": f'{MetOfficeAPIKey}'}
@@ -270,197 +386,148 @@ def MetOffice(latitude, longitude):
 
     url = base_url + timesteps
 
-    req = requests.get(url, headers=headers, params=params)
+    return url, headers, params
+
+
+def metoffice_forecast(req):
 
     # Check if the request is ok (HTTP status code within 200-299)
-    if req.ok is False:
+    if not 200 <= req.status_code < 300:
         raise Exception("MetOffice Weather API received a bad request.")
 
-    # Convert current time into a string that will match in the json data
-    current_time = str(datetime.date(datetime.now())) + str('T') + str(datetime.time(datetime.now()))[0:3] + str('00Z')
-
     # Retrieve data
     json_key = req.json()['features'][0]['properties']['timeSeries']
 
-    # 24 hours in a day
-    for i in range(25):
-
-        # Check for current date and time in data
-        if json_key[i]['time'] == current_time:
-
-            # Temperature
-            temperature = json_key[i]['screenTemperature']
-
-            # Feels like
-            feels_like = json_key[i]['feelsLikeTemperature']
-
-            # Wind speed
-            wind_speed = json_key[i]['windSpeed10m']
-
-            # Gust speed
-            gust_speed = json_key[i]['windGustSpeed10m'] * conversions.KN_TO_MPH
-
-            # Rain chance
-            rain_chance = json_key[i]['probOfPrecipitation']
-
-            # Snow
-
-            # Snow condition flag: 0 = Not going to snow, 1 = Forecasted to snow
-            snow_condition_flag = 0
-
-            # Snow amount - doesn't always exist in the json data
-            try:
-                snow_amount = json_key[i]['totalSnowAmount']
-            except:
-                snow_amount = 0
-
-            # Set snow condition flag equal to 1 if snow is forecasted
-            if snow_amount > 0:
-                snow_condition_flag = 1
-
-            # Significant weather codes
-            significant_weather_codes = {
-                "NA": "Not available",
-                "0": "Clear night",
-                "1": "Sunny day",
-                "2": "Partly cloudy (night)",
-                "3": "Partly cloudy (day)",
-                "4": "Not used",
-                "5": "Mist",
-                "6": "Fog",
-                "7": "Cloudy",
-                "8": "Overcast",
-                "9": "Light rain shower (night)",
-                "10": "Light rain shower (day)",
-                "11": "Drizzle",
-                "12": "Light rain",
-                "13": "Heavy rain shower (night)",
-                "14": "Heavy rain shower (day)",
-                "15": "Heavy rain",
-                "16": "Sleet shower (night)",
-                "17": "Sleet shower (day)",
-                "18": "Sleet",
-                "19": "Hail shower (night)",
-                "20": "Hail shower (day)",
-                "21": "Hail",
-                "22": "Light snow shower (night)",
-                "23": "Light snow shower (day)",
-                "24": "Light snow",
-                "25": "Heavy snow shower (night)",
-                "26": "Heavy snow shower (day)",
-                "27": "Heavy snow",
-                "28": "Thunder shower (night)",
-                "29": "Thunder shower (day)",
-                "30": "Thunder"
-            }
-
-            # Significant weather code
-            weather_code = json_key[i]['significantWeatherCode']
-            weather_code = str(weather_code)
-
-            # Getting value for significant weather code key
-            weather_desc = significant_weather_codes[weather_code]
-
-            # UV index
-            uv_index_codes = {
-                "0": "Low exposure. No protection required. You can safely stay outside",
-                "1": "Low exposure. No protection required. You can safely stay outside",
-                "2": "Low exposure. No protection required. You can safely stay outside",
-                "3": "Moderate exposure. Seek shade during midday hours, cover up and wear sunscreen",
-                "4": "Moderate exposure. Seek shade during midday hours, cover up and wear sunscreen",
-                "5": "Moderate exposure. Seek shade during midday hours, cover up and wear sunscreen",
-                "6": "High exposure. Seek shade during midday hours, cover up and wear sunscreen",
-                "7": "High exposure. Seek shade during midday hours, cover up and wear sunscreen",
-                "8": "Very high. Avoid being outside during midday hours. Shirt, sunscreen and hat are essential",
-                "9": "Very high. Avoid being outside during midday hours. Shirt, sunscreen and hat are essential",
-                "10": "Very high. Avoid being outside during midday hours. Shirt, sunscreen and hat are essential",
-                "11": "Extreme. Avoid being outside during midday hours. Shirt, sunscreen and hat essential."
-            }
-
-            uv_index_code = json_key[i]['uvIndex']
-
-            # If UV Index > 11 display the highest warning
-            if int(uv_index_code) > 11:
-                uv_index_desc = "Extreme. Avoid being outside during midday hours. Shirt, sunscreen and hat essential."
-
-            # Otherwise display the corresponding description for the index number
-            else:
-                uv_index_desc = str(uv_index_code)
-                uv_index_desc = uv_index_codes[uv_index_desc]
-
-            # Humidity
-            humidity = json_key[i]['screenRelativeHumidity']
-
-            # Met Office weather data
-            mo_data = {
-                'temperature': temperature,
-                'feels_like': feels_like,
-                'wind_speed': wind_speed,
-                'gust_speed': gust_speed,
-                'weather_desc': weather_desc,
-                'rain_chance': rain_chance,
-                'snow_condition_flag': snow_condition_flag,
-                'snow_amount': snow_amount,
-                'uv_index_code': uv_index_code,
-                'uv_index_desc': uv_index_desc,
-                'humidity': humidity
-            }
-
-            return mo_data
+    # Index the whole forecast (~48 hours) by hour, so it can be reused for every hour it covers
+    return timeseries.HourlySeries(json_key, METOFFICE_FIELDS)
+
+
+def MetOffice(latitude, longitude, hour=None):
+
+    return metoffice_data(MetOfficeForecast(latitude, longitude), hour)
+
+
+def metoffice_data(forecast, hour=None):
+
+    # Hour to look up (hours since 1970 UTC, as the Met Office times are UTC), defaults to the current hour
+    if hour is None:
+        hour = timeseries.epoch_hour()
+
+    # Look up the hour in the forecast
+    step = forecast.row(hour)
+
+    if step is None:
+        raise Exception(f"MetOffice forecast ({len(forecast)} hours from {forecast.first_time}) does not cover the requested hour.")
+
+    # Temperature
+    temperature = step['screenTemperature']
+
+    # Feels like
+    feels_like = step['feelsLikeTemperature']
+
+    # Wind speed
+    wind_speed = step['windSpeed10m']
+
+    # Gust speed
+    gust_speed = step['windGustSpeed10m'] * conversions.KN_TO_MPH
+
+    # Rain chance
+    rain_chance = step['probOfPrecipitation']
+
+    # Snow amount - doesn't always exist in the json data (the report shows snow if it's above 0)
+    snow_amount = step['totalSnowAmount']
+    if math.isnan(snow_amount):
+        snow_amount = 0
+
+    # Significant weather code (the description, emoji and image are looked up when the page is rendered)
+    condition = conditions.condition(step['significantWeatherCode'])
+    weather_code = records.NO_CODE if condition.code is None else condition.code
+
+    # UV index (whole numbers, the advice for it is looked up when the page is rendered). Missing is NaN, shown as N/A
+    uv_index_code = step['uvIndex']
+    if not math.isnan(uv_index_code):
+        uv_index_code = int(uv_index_code)
+
+    # Humidity
+    humidity = step['screenRelativeHumidity']
+
+    # Met Office weather data
+    mo_data = records.Reading(
+        temperature=float(temperature),
+        feels_like=float(feels_like),
+        wind_speed=float(wind_speed),
+        gust_speed=float(gust_speed),
+        rain_chance=float(rain_chance),
+        snow_amount=float(snow_amount),
+        humidity=float(humidity),
+        uv_index=float(uv_index_code),
+        weather_code=weather_code
+    )
+
+    return mo_data
 
 
 # -------------------
 
 # BBC Weather:
 
+# Elements to pull out of the page
+BBC_SELECTORS = {
+    'temperature': ("div", "class", "wr-time-slot-primary__temperature"),
+    'feels_like': ("span", "class", "wr-time-slot-secondary__feels-like-temperature-value gel-long-primer-bold wr-value--temperature--c"),
+    'wind_speed': ("div", "class", "wr-time-slot-primary__wind-speed"),
+    'wind_desc': ("div", "class", "wr-time-slot-secondary__wind-direction wr-time-slot-secondary__bottom-section gel-long-primer"),
+    'rain_chance': ("div", "class", "wr-u-font-weight-500"),
+    'humidity': ("dd", "class", "wr-time-slot-secondary__value gel-long-primer-bold")
+}
+
+@forecast_cache.cached(ttl=BBCWEATHER_TTL, bucket_seconds=HOURLY)
 def BBCWeather(location_id):
 
-    base_url = 'https://bbc.co.uk/weather/'
+    # Using helper module
+    page = html_extract.fetch(bbc_url(location_id), BBC_SELECTORS)
+
+    return bbc_data(page)
+
 
-    forecast_url = f'{base_url}{location_id}'
+def bbc_url(location_id):
 
-    # Using helper function
-    soup = bs4logic(forecast_url)
+    base_url = f'{BBCWeatherURL}/weather/'
+
+    return f'{base_url}{location_id}'
+
+
+def bbc_data(page):
 
     # Temperature:
-    temperature = soup.find("div", {"class": "wr-time-slot-primary__temperature"}).get_text()
+    temperature = page['temperature']
     temperature = temperature[0:2]
 
     # Feels like:
-    feels_like = soup.find("span", {"class": "wr-time-slot-secondary__feels-like-temperature-value gel-long-primer-bold wr-value--temperature--c"}).get_text()
+    feels_like = page['feels_like']
 
     # Wind speed:
-    wind_speed = soup.find("div", {"class": "wr-time-slot-primary__wind-speed"}).get_text().strip('Wind speed mph').split()[0]
+    wind_speed = page['wind_speed'].strip('Wind speed mph').split()[0]
 
     # Wind description:
-    wind_desc = soup.find("div", {"class": "wr-time-slot-secondary__wind-direction wr-time-slot-secondary__bottom-section gel-long-primer"}).get_text()
+    wind_desc = page['wind_desc']
 
     # Rain chance:
-    rain_chance = soup.find("div", {"class": "wr-u-font-weight-500"}).get_text()
+    rain_chance = page['rain_chance']
     rain_chance = rain_chance.replace('chance of precipitation', '')
 
-    # Sunrise:
-    sunrise = soup.find("span", {"class": "wr-c-astro-data__sunrise gel-pica-bold gs-u-pl-"}).get_text()
-    sunrise = sunrise.strip('Sunrise')
-
-    # Sunset:
-    sunset = soup.find("span", {"class": "wr-c-astro-data__sunset gel-pica gs-u-pl-"}).get_text()
-    sunset = sunset.strip('Sunset')
-
     # Humidity:
-    humidity = soup.find("dd", {"class": "wr-time-slot-secondary__value gel-long-primer-bold"}).get_text()
-
-    # BBC Weather data
-    bbc_data = {
-        'temperature': temperature,
-        'feels_like': feels_like,
-        'wind_speed': wind_speed,
-        'wind_desc': wind_desc,
-        'rain_chance': rain_chance,
-        'humidity': humidity,
-        'sunrise': sunrise,
-        'sunset': sunset
-    }
+    humidity = page['humidity']
+
+    # BBC Weather data (scraped text such as '10°' or '81%' is converted to numbers, NaN if it can't be)
+    bbc_data = records.Reading(
+        temperature=records.number(temperature),
+        feels_like=records.number(feels_like),
+        wind_speed=records.number(wind_speed),
+        rain_chance=records.number(rain_chance),
+        humidity=records.number(humidity),
+        wind_desc=wind_desc
+    )
 
     return bbc_data
 
@@ -468,83 +535,95 @@ def BBCWeather(location_id):
 
 # Yr.No:
 
+# Elements to pull out of the page - temperature can be warm or cold
+YRNO_SELECTORS = {
+    'temperature': [("span", "class", "temperature temperature--warm"), ("span", "class", "temperature temperature--cold")],
+    'feels_like': ("div", "class", "feels-like-text"),
+    'wind_speed': ("span", "class", "wind__value now-hero__next-hour-wind-value"),
+    'rain_amount': ("span", "class", "now-hero__next-hour-precipitation-value")
+}
+
+@forecast_cache.cached(ttl=YRNO_TTL, bucket_seconds=HOURLY)
 def YrNo(location_id):
 
-    base_url = 'https://www.yr.no/en/forecast/daily-table/2-'
+    # Using helper module
+    page = html_extract.fetch(yrno_url(location_id), YRNO_SELECTORS)
 
-    forecast_url = f'{base_url}{location_id}'
+    return yrno_data(page)
 
-    # Using helper function
-    soup = bs4logic(forecast_url)
 
-    # Temperature - temperature can be warm or cold:
-    try:
-        temperature = soup.find("span", {"class": "temperature temperature--warm"}).get_text()
-    except:
-        temperature = soup.find("span", {"class": "temperature temperature--cold"}).get_text()
+def yrno_url(location_id):
+
+    base_url = f'{YrNoURL}/en/forecast/daily-table/2-'
+
+    return f'{base_url}{location_id}'
+
+
+def yrno_data(page):
 
+    # Temperature:
+    temperature = page['temperature']
     temperature = temperature.split('Temperature')[1]
 
     # Feels like:
-    feels_like = soup.find("div", {"class": "feels-like-text"}).get_text()
+    feels_like = page['feels_like']
     feels_like = feels_like.split('Feels like ')[1]
     feels_like = feels_like[-3:]
 
     # Wind speed:
-    wind_speed = soup.find("span", {"class": "wind__value now-hero__next-hour-wind-value"}).get_text()
+    wind_speed = page['wind_speed']
     wind_speed = float(wind_speed) * conversions.MS_TO_MPH
 
     # Rainfall:
-    rain_amount = soup.find("span", {"class": "now-hero__next-hour-precipitation-value"}).get_text()
+    rain_amount = page['rain_amount']
 
     # YrNo weather data
-    yrno_data = {
-        'temperature': temperature,
-        'feels_like': feels_like,
-        'wind_speed': wind_speed,
-        'rain_amount': rain_amount
-    }
+    yrno_data = records.Reading(
+        temperature=records.number(temperature),
+        feels_like=records.number(feels_like),
+        wind_speed=wind_speed,
+        rain_amount=records.number(rain_amount)
+    )
 
     return yrno_data
 
 # -------------------
 
-# TimeandDate.com Moon Phase:
+# Sunrise / Sunset:
 
-def Moon_Phase(location_id):
+def Sun_Times(latitude, longitude, time_zone=None):
 
-    # Get moon phase for chosen location
-    url = f'https://www.timeanddate.com/moon/phases/@{location_id}'
+    # Location's time zone from GeoNames, otherwise a rough offset from the longitude (15 degrees per hour)
+    try:
+        local_zone = ZoneInfo(time_zone)
+    except (TypeError, ValueError, ZoneInfoNotFoundError):
+        local_zone = timezone(timedelta(hours=round(float(longitude) / 15)))
 
-    # Helper function
-    soup = bs4logic(url)
+    # Today's date at the location
+    local_date = datetime.now(local_zone).date()
 
-    # Moon phase tonight
-    moon_phase = soup.find_all("td")[1].get_text()
+    # Calculate sunrise and sunset (None if the sun doesn't rise or set today)
+    sunrise, sunset = ephemeris.sun_times(local_date, latitude, longitude)
 
-    moon_percent = soup.find("span", {"id": "cur-moon-percent"}).get_text()
+    # Format as local 'HH:MM'
+    sunrise = sunrise.astimezone(local_zone).strftime('%H:%M') if sunrise else 'N/A'
+    sunset = sunset.astimezone(local_zone).strftime('%H:%M') if sunset else 'N/A'
 
-    # HTML moon emoji code strings all start the same, just the last 2 characters are different for specific moon phase
-    moon_emoji_base = '&#1277'
+    return sunrise, sunset
 
-    moon_emoji_dict = {
-        "New Moon": "61",
-        "Waxing Crescent": "62",
-        "First Quarter": "63",
-        "Waxing Gibbous": "64",
-        "Full Moon": "65",
-        "Waning Gibbous": "66",
-        "Third Quarter": "67",
-        "Waning Crescent": "68"
-    }
+# -------------------
+
+# Moon Phase:
+
+def Moon_Phase():
 
-    # Retrieve last 2 characters of moon emoji code mapped to moon phase
-    last_2_characters = moon_emoji_dict[moon_phase]
+    # Moon phase and percentage illuminated right now (the same everywhere on Earth)
+    moon_phase, moon_percent = ephemeris.moon_phase()
 
-    # Concatenate strings to create moon_emoji
-    moon_emoji = moon_emoji_base + last_2_characters
+    # HTML moon emoji for the phase
+    moon_emoji = conditions.MOON_EMOJI[moon_phase]
 
-    # TimeandDate.com moon phase dataa
+    # Moon phase data
     moon_data = {
         'moon_phase': moon_phase,
         'moon_emoji': moon_emoji,
@@ -554,40 +633,191 @@ def Moon_Phase(location_id):
     return moon_data
 
 
-# Initialise output data class
-@dataclass
-class AppData:
-    current_date: str
-    current_time: str
-    latitude: str
-    longitude: str
-    location_name: str
-    location_id: str
-    temperature: str
-    feels_like: str
-    weather_desc: str
-    wind_speed: str
-    gust_speed: str
-    wind_desc: str
-    rain_chance: str
-    rain_amount: str
-    snow_condition_flag: int
-    snow_amount: str
-    uv_index_code: str
-    uv_index_desc: str
-    humidity: str
-    sunrise: str
-    sunset: str
-    moon_phase: str
-    moon_emoji: str
-    moon_percent: str
-    weather_emoji: str
-    weather_image: str
+# Prefetch scheduler for popular locations:
+# provider function, geocoding fields passed to it, and minimum seconds between calls (to stay inside rate limits)
+prefetcher = prefetch.Prefetcher({
+    'OpenWeather': (OpenWeather, ('latitude', 'longitude'), 1),
+    'MetOffice': (MetOfficeForecast, ('latitude', 'longitude'), 10),
+    'BBCWeather': (BBCWeather, ('location_id',), 2),
+    'YrNo': (YrNo, ('location_id',), 2)
+})
+
+
+def forecast_location(GEO_CODER_DATA):
+
+    # Where the providers are asked about: the location snapped to its forecast cell
+    if forecast_grid is None:
+        return GEO_CODER_DATA
+
+    return forecast_grid.snap(GEO_CODER_DATA)
+
+
+# Weather report for a geocoded location (used by the results page and the JSON API)
+# Providers are asked about the location's forecast cell, the report itself shows the location looked up
+def weather_report(GEO_CODER_DATA):
+
+    # Getting weather information...
+
+    # Get weather data from all providers at the same time
+    provider_data, provider_errors = fanout.fan_out(provider_calls(GEO_CODER_DATA))
+
+    return build_report(GEO_CODER_DATA, provider_data, provider_errors)
+
+
+def provider_calls(GEO_CODER_DATA):
+
+    # Provider fetches for a location, for 'fanout' (except any not accurate enough here to be worth it)
+    FORECAST_LOCATION = forecast_location(GEO_CODER_DATA)
+    latitude = FORECAST_LOCATION['latitude']
+    longitude = FORECAST_LOCATION['longitude']
+    location_id = FORECAST_LOCATION['location_id']
+
+    skipped = skipped_providers(GEO_CODER_DATA)
+
+    return {name: call for name, call in {
+        'OpenWeather': (OpenWeather, (latitude, longitude)),
+        'MetOffice': (MetOffice, (latitude, longitude)),
+        'BBCWeather': (BBCWeather, (location_id,)),
+        'YrNo': (YrNo, (location_id,))
+    }.items() if name not in skipped}
+
+
+def skipped_providers(GEO_CODER_DATA):
+
+    # Providers whose weight for the location's region is negligible (see accuracy.py)
+    skipped = accuracy_engine.skipped(GEO_CODER_DATA['latitude'], GEO_CODER_DATA['longitude'])
+
+    for provider_name in skipped:
+        metrics.increment('weather_provider_skipped_total', provider=provider_name)
+
+    return skipped
+
+
+# Build the output data from whatever the providers returned (shared by the WSGI and ASGI handlers)
+def build_report(GEO_CODER_DATA, provider_data, provider_errors):
+
+    # Get location info using geo_coder function
+    latitude = GEO_CODER_DATA['latitude']
+    longitude = GEO_CODER_DATA['longitude']
+    location_id = GEO_CODER_DATA['location_id']
+
+    # Carry on with whichever providers answered in time (a provider that failed - including MetOffice when its
+    # forecast doesn't cover the current hour - is in provider_errors, and any that returned nothing are dropped)
+    for provider_name, provider_error in provider_errors.items():
+        logger.warning('provider_skipped provider=%s error="%s"', provider_name, provider_error)
+
+    provider_data = {name: data for name, data in provider_data.items() if data is not None}
+
+    # Record which providers contributed
+    sources = [name for name in aggregation.PROVIDERS if name in provider_data]
+
+    # At least one weather provider is needed for the averages
+    if not any(name in provider_data for name in aggregation.PROVIDERS):
+        raise Exception(f"No weather providers answered: {provider_errors}")
+
+    OW_DATA = provider_data.get('OpenWeather', records.NO_READING)
+    MO_DATA = provider_data.get('MetOffice', records.NO_READING)
+    BBC_DATA = provider_data.get('BBCWeather', records.NO_READING)
+    YRNO_DATA = provider_data.get('YrNo', records.NO_READING)
+
+    # Sunrise/sunset and moon phase are calculated locally
+    sunrise, sunset = Sun_Times(latitude, longitude, GEO_CODER_DATA.get('timezone'))
+    MOON_DATA = Moon_Phase()
+
+    # Log weather data (formatted only if debug logging is on)
+    for provider_name, data in provider_data.items():
+        logger.debug('provider_data provider=%s data=%s', provider_name, data)
+    logger.debug('provider_data provider=Moon data=%s', MOON_DATA)
+
+    # Average the providers' readings, then add any new ones to the accuracy statistics (readings are fetched for the
+    # forecast cell, so repeat lookups anywhere in it are served the same cached readings)
+    with metrics.timer('aggregation'):
+        readings, consensus = provider_consensus(latitude, longitude, provider_data)
+        FORECAST_LOCATION = forecast_location(GEO_CODER_DATA)
+        accuracy_engine.update(latitude, longitude, readings[0], location=(
+            str(FORECAST_LOCATION['latitude']), str(FORECAST_LOCATION['longitude']), str(FORECAST_LOCATION['location_id'])))
+
+    # Log readings
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('provider_readings variables=%s readings=%s', aggregation.VARIABLES, readings[0].tolist())
+
+    # Keep the readings for trends and accuracy analysis (written in the background)
+    if history_store is not None:
+        history_store.record(location_id, timeseries.epoch_hour(), readings[0])
+
+    # Get average values
+    average_temperature = consensus[aggregation.VARIABLE_INDEX['temperature']]
+    average_feels_like = consensus[aggregation.VARIABLE_INDEX['feels_like']]
+    average_wind_speed = consensus[aggregation.VARIABLE_INDEX['wind_speed']]
+    average_rain_chance = consensus[aggregation.VARIABLE_INDEX['rain_chance']]
+    average_humidity = consensus[aggregation.VARIABLE_INDEX['humidity']]
+
+    # Weather condition from the Met Office code, or OpenWeather's (normalised onto the same codes) if it's missing
+    weather_code = MO_DATA.weather_code
+    if weather_code == records.NO_CODE:
+        weather_code = OW_DATA.weather_code
+
+    # Extras:
+
+    location_name = report_location_name(GEO_CODER_DATA)
+
+    # Put output variables in a Report record as 'weather_data'
+    # Values stay as numbers (NaN for any provider that didn't answer) and are formatted when the page is rendered
+    weather_data = records.Report(
+        timestamp=time.time(),
+        latitude=float(latitude),
+        longitude=float(longitude),
+        location_id=int(location_id),
+        location_name=location_name,
+        temperature=float(average_temperature),
+        feels_like=float(average_feels_like),
+        wind_speed=float(average_wind_speed),
+        gust_speed=MO_DATA.gust_speed,
+        rain_chance=float(average_rain_chance),
+        rain_amount=YRNO_DATA.rain_amount,
+        snow_amount=MO_DATA.snow_amount,
+        humidity=float(average_humidity),
+        uv_index=MO_DATA.uv_index,
+        moon_percent=float(MOON_DATA['moon_percent']),
+        weather_code=weather_code,
+        wind_desc=BBC_DATA.wind_desc,
+        sunrise=sunrise,
+        sunset=sunset,
+        moon_phase=MOON_DATA['moon_phase'],
+        sources=tuple(sources)
+    )
+
+    logger.debug('weather_report location=%s data=%s', location_name, weather_data)
+
+    return weather_data
+
+
+def provider_consensus(latitude, longitude, provider_data):
+
+    # Put every provider's readings into one array (providers x variables) and average them, weighting each
+    # provider by how accurate it has been in this region
+    readings = aggregation.collect([provider_data])
+    weights = accuracy_engine.weights(latitude, longitude)
+
+    return readings, aggregation.aggregate(readings, weights=weights[None])['weighted_mean'][0]
+
+
+def report_location_name(GEO_CODER_DATA):
+
+    # Retrieve town and country code as shown in GeoNames API request, then format to create location_name string
+    town = GEO_CODER_DATA['name']
+    country_code = GEO_CODER_DATA['country_code']
+
+    return f'{town}, {country_code}'
 
 
 # Flask website
 app = Flask(__name__)
 
+# Shown on the search page (HTTP 503) when a lookup can't be answered right now
+BUSY_MESSAGE = 'Too many lookups right now. Please try again in a minute.'
+UNAVAILABLE_MESSAGE = "The weather providers aren't answering right now. Please try again in a minute."
+
 # Home
 @app.route('/')
 def home():
@@ -595,189 +825,378 @@ def home():
     return render_template('home.html')
 
 # Results
+# (GET is what the search form uses, so browsers can cache and revalidate the page)
+@app.route('/results')
 @app.route('/', methods=['POST'])
 def results():
 
-    time.sleep(0.1)
-
-    # Initialise weather_data variable
-    weather_data = None
-
-    # Create empty numpy arrays to put variables in, to average afterwards
-    all_temperatures = np.array([])
-    all_feels_like = np.array([])
-    all_wind_speeds = np.array([])
-    all_rain_chance = np.array([])
-    all_humidity = np.array([])
-
     # Geocoding information
 
     # Get town and country code from html form submission
-    town = request.form['townName']
-    country_code = request.form['countryCode']
+    if request.method == 'POST':
+        town = request.form['townName']
+        country_code = request.form['countryCode']
+        stream = request.form.get('stream') == '1'
+    else:
+        town = request.args.get('townName', '')
+        country_code = request.args.get('countryCode', '')
+        stream = request.args.get('stream') == '1'
+
+    # Store location info from geo_coder function in variable (geocoded once per request)
+    with metrics.timer('geocode'):
+        GEO_CODER_DATA = geo_coder(town, country_code)
 
     # Redirect 'home_error.html' if bad request
-    if geo_coder(town, country_code) == "Error":
+    if GEO_CODER_DATA == "Error":
 
         return render_template('home_error.html')
 
-    # Store location info from geo_coder function in variable
-    GEO_CODER_DATA = geo_coder(town, country_code)
+    # Or if GeoNames can't be asked right now
+    if GEO_CODER_DATA == "Busy":
 
-    # Get location info using geo_coder function
-    latitude = GEO_CODER_DATA['latitude']
-    longitude = GEO_CODER_DATA['longitude']
-    location_id = GEO_CODER_DATA['location_id']
+        return render_template('home_error.html', message=BUSY_MESSAGE), 503
 
-    # Getting weather information...
+    # Count the lookup (by forecast cell) so popular locations are refreshed ahead of time
+    prefetcher.record(forecast_location(GEO_CODER_DATA))
 
-    # Get weather data
-    OW_DATA = OpenWeather(latitude, longitude)
-    MO_DATA = MetOffice(latitude, longitude)
-    BBC_DATA = BBCWeather(location_id)
-    YRNO_DATA = YrNo(location_id)
-    MOON_DATA = Moon_Phase(location_id)
-
-    # Print weather data:
-    print('OpenWeather Data:', OW_DATA)
-    print('MetOffice Data:', MO_DATA)
-    print('BBC Data:', BBC_DATA)
-    print('YrNo Data:', YRNO_DATA)
-    print('Moon Phase Data:', MOON_DATA)
-
-    # Clean / store variables for averaging
-    all_temperatures = np.append(all_temperatures, [
-        clean_data(OW_DATA['temperature']),
-        clean_data(MO_DATA['temperature']),
-        clean_data(BBC_DATA['temperature']),
-        clean_data(YRNO_DATA['temperature']),
-    ])
-
-    all_feels_like = np.append(all_feels_like, [
-        clean_data(OW_DATA['feels_like']),
-        clean_data(MO_DATA['feels_like']),
-        clean_data(BBC_DATA['feels_like']),
-        clean_data(YRNO_DATA['feels_like']),
-    ])
-
-    all_wind_speeds = np.append(all_wind_speeds, [
-        clean_data(OW_DATA['wind_speed']),
-        clean_data(MO_DATA['wind_speed']),
-        clean_data(BBC_DATA['wind_speed']),
-        clean_data(YRNO_DATA['wind_speed']),
-    ])
-
-    all_rain_chance = np.append(all_rain_chance, [
-        clean_data(MO_DATA['rain_chance']),
-        clean_data(BBC_DATA['rain_chance']),
-    ])
-
-    all_humidity = np.append(all_humidity, [
-        clean_data(OW_DATA['humidity']),
-        clean_data(MO_DATA['humidity']),
-        clean_data(BBC_DATA['humidity'])
-    ])
-
-    # Print arrays
-    print("All temperatures:", all_temperatures)
-    print("All feels like:", all_feels_like)
-    print("All wind speeds:", all_wind_speeds)
-    print("All rain chance:", all_rain_chance)
-    print("All humidity:", all_humidity)
-
-    # Get average values from arrays
-    average_temperature = np.average(all_temperatures)
-    average_feels_like = np.average(all_feels_like)
-    average_wind_speed = np.average(all_wind_speeds)
-    average_rain_chance = np.average(all_rain_chance)
-    average_humidity = np.average(all_humidity)
-
-    # Format averages
-    average_temperature = format_variable(average_temperature)
-    average_feels_like = format_variable(average_feels_like)
-    average_wind_speed = format_variable(average_wind_speed)
-    average_rain_chance = format_variable(average_rain_chance)
-    average_humidity = format_variable(average_humidity)
-
-    # Store other variables
-    weather_desc = MO_DATA['weather_desc']
-    gust_speed = MO_DATA['gust_speed']
-    wind_desc = BBC_DATA['wind_desc']
-    rain_amount = YRNO_DATA['rain_amount']
-    snow_condition_flag = MO_DATA['snow_condition_flag']
-    snow_amount = MO_DATA['snow_amount']
-    uv_index_code = MO_DATA['uv_index_code']
-    uv_index_desc = MO_DATA['uv_index_desc']
-    sunrise = BBC_DATA['sunrise']
-    sunset = BBC_DATA['sunset']
-    moon_phase = MOON_DATA['moon_phase']
-    moon_percent = MOON_DATA['moon_percent']
-
-    # Format other variables where necessary
-    location_id = str(location_id)
-    gust_speed = format_variable(gust_speed)
-    snow_amount = format_variable(snow_amount)
-    uv_index_code = format_variable(uv_index_code)
-    moon_percent = format_variable(clean_data(moon_percent))
+    # Rendered page for this location and hour, if there is one
+    page = page_cache.get(GEO_CODER_DATA)
 
-    # Extras:
+    # Send the page as the providers answer (see 'stream_results')
+    if page is None and stream:
+        return Response(stream_with_context(stream_results(GEO_CODER_DATA)), headers=STREAM_HEADERS)
 
-    # Retrieve town and country code as shown in GeoNames API request, then format to create location_name string
-    town = geo_coder(town, country_code)['name']
-    country_code = geo_coder(town, country_code)['country_code']
+    if page is None:
 
-    location_name = f'{town}, {country_code}'
+        # Get weather for the location (or say so if no provider answered)
+        try:
+            weather_data = weather_report(GEO_CODER_DATA)
+        except Exception as error:
+            logger.error('report_failed location=%s error="%s"', GEO_CODER_DATA['location_id'], error)
+            return render_template('home_error.html', message=UNAVAILABLE_MESSAGE), 503
 
-    # Get date and time for current run
-    current_date_str = f'{str(datetime.now())[8:10]}/{str(datetime.now())[5:7]}/{str(datetime.now())[0:4]}'
-    current_time_str = f'{str(datetime.now())[11:16]}'
+        # Render results page
+        with metrics.timer('render'):
+            page = page_cache.render(GEO_CODER_DATA, weather_data)
 
-    # Weather emoji
-    weather_emoji = weather_emoji_picker(weather_desc)
+    # Browser copy is still current
+    if page_cache.not_modified(page, request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since')):
+        return Response(status=304, headers=page_cache.headers(page))
 
-    # Weather image
-    weather_image = weather_image_picker(weather_desc)
+    return Response(page.html, headers=page_cache.headers(page))
 
-    # Moon emoji
-    moon_emoji = MOON_DATA['moon_emoji']
 
-    # Put output variable in AppData dataclass as 'weather_data'
-    weather_data = AppData(
-        current_date=current_date_str,
-        current_time=current_time_str,
-        latitude=latitude,
-        longitude=longitude,
-        location_name=location_name,
-        location_id=location_id,
-        temperature=average_temperature,
-        feels_like=average_feels_like,
-        weather_desc=weather_desc,
-        wind_speed=average_wind_speed,
-        gust_speed=gust_speed,
-        wind_desc=wind_desc,
-        rain_chance=average_rain_chance,
-        rain_amount=rain_amount,
-        snow_condition_flag=snow_condition_flag,
-        snow_amount=snow_amount,
-        uv_index_code=uv_index_code,
-        uv_index_desc=uv_index_desc,
-        humidity=average_humidity,
-        sunrise=sunrise,
-        sunset=sunset,
-        moon_phase=moon_phase,
-        moon_emoji=moon_emoji,
-        moon_percent=moon_percent,
-        weather_emoji=weather_emoji,
-        weather_image=weather_image
-    )
+# Streamed results page
+# ---------------------
+# With 'stream=1' (a hidden field in the search forms) a results page that isn't cached yet is sent in chunks: the
+# page up to the weather (search form, date and time, clock and map) as soon as the location is geocoded, then each
+# provider's readings and the consensus so far as they arrive, then the finished weather section. The finished page
+# goes into the page cache as usual, so repeat lookups get it in one go.
+
+# A streamed page can't be revalidated, and proxies (e.g. nginx) shouldn't hold it back until it's complete
+STREAM_HEADERS = [('Cache-Control', 'no-cache'), ('X-Accel-Buffering', 'no')]
+
+
+def stream_results(GEO_CODER_DATA):
+
+    # Chunks of the results page (the ASGI server sends the same chunks, see asgi.stream_results)
+    provider_data = {}
+    provider_errors = {}
+
+    head, tail = stream_start(GEO_CODER_DATA)
+    yield head
+
+    for provider_name, data, error in fanout.as_completed(provider_calls(GEO_CODER_DATA)):
+        if error is None:
+            provider_data[provider_name] = data
+        else:
+            provider_errors[provider_name] = error
+
+        yield stream_provider(GEO_CODER_DATA, provider_data, provider_name)
+
+    yield stream_finish(GEO_CODER_DATA, provider_data, provider_errors) + tail
+
+
+def stream_start(GEO_CODER_DATA):
+
+    # The first chunk: the shell with the date and time filled in and the progress section where the weather section
+    # will go (the report has no weather yet, only the location). Also returns the rest of the shell, sent last
+    output_data = records.display(records.Report(
+        timestamp=time.time(),
+        latitude=float(GEO_CODER_DATA['latitude']),
+        longitude=float(GEO_CODER_DATA['longitude']),
+        location_id=int(GEO_CODER_DATA['location_id']),
+        location_name=report_location_name(GEO_CODER_DATA)
+    ))
+
+    shell = page_cache.shell(GEO_CODER_DATA, output_data)
+
+    head = shell[0] + page_cache.fragment('datetime', output_data) + shell[1] + page_cache.fragment('progress', output_data)
+
+    return head, shell[2]
+
+
+def stream_provider(GEO_CODER_DATA, provider_data, provider_name):
+
+    # One provider's readings (none if it failed, or MetOffice has no row for the hour) and the consensus so far
+    answered = {name: data for name, data in provider_data.items() if data is not None}
+
+    reading = None
+    if provider_name in answered:
+        reading = {variable: records.format_variable(getattr(answered[provider_name], variable))
+                   for variable in aggregation.VARIABLES}
+
+    consensus = None
+    if answered:
+        consensus = provider_consensus(GEO_CODER_DATA['latitude'], GEO_CODER_DATA['longitude'], answered)[1]
+        consensus = {variable: records.format_variable(consensus[index])
+                     for variable, index in aggregation.VARIABLE_INDEX.items()}
+
+    return page_cache.fragment('provider', {'provider': provider_name, 'reading': reading, 'consensus': consensus})
+
+
+def stream_finish(GEO_CODER_DATA, provider_data, provider_errors):
+
+    # Closes the progress section and sends the weather section (caching the whole page for the next lookup), or
+    # says so in the progress section if no provider answered
+    try:
+        weather_data = build_report(GEO_CODER_DATA, provider_data, provider_errors)
+    except Exception as error:
+        logger.error('stream_failed location=%s error="%s"', GEO_CODER_DATA['location_id'], error)
+        return page_cache.fragment('progress_done', {'answered': False})
+
+    with metrics.timer('render'):
+        page_cache.render(GEO_CODER_DATA, weather_data)
+        weather = page_cache.fragment('weather', records.display(weather_data))
+
+    return page_cache.fragment('progress_done', {'answered': True}) + weather
 
-    # (Contains 23 variables)
 
-    # Print weather_data, putting a new line after bracket/comma
-    print(str(weather_data).replace('(', '(\n').replace("',", ",\n"))
+# Town suggestions for the search form, e.g. /api/suggest?q=Lon&country=GB (from the offline gazetteer only, so
+# typing never uses GeoNames credits - empty if there's no index)
+@app.route('/api/suggest')
+def api_suggest():
 
-    # Render results page
-    return render_template('/results.html', output_data=weather_data)
+    suggestions = []
+    if gazetteer_index is not None:
+        suggestions = gazetteer_index.suggest(request.args.get('q', ''), request.args.get('country', '').strip())
+
+    return {'suggestions': suggestions}, 200, {'Cache-Control': 'public, max-age=86400'}
+
+
+# Metrics (Prometheus text format)
+@app.route('/metrics')
+def metrics_page():
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@metrics.register
+def collect_metrics():
+
+    # Statistics kept by other modules, read when '/metrics' is scraped
+    samples = [
+        ('weather_cache_requests_total', {'cache': 'GeoNames', 'result': 'hit'}, geo_cache.hits),
+        ('weather_cache_requests_total', {'cache': 'GeoNames', 'result': 'miss'}, geo_cache.misses),
+        ('weather_cache_requests_total', {'cache': 'page', 'result': 'hit'}, page_cache.pages.hits),
+        ('weather_cache_requests_total', {'cache': 'page', 'result': 'miss'}, page_cache.pages.misses)
+    ]
+
+    for provider_name, counts in single_flight.stats().items():
+        samples.append(('weather_coalesced_calls_total', {'provider': provider_name, 'outcome': 'upstream'}, counts['upstream']))
+        samples.append(('weather_coalesced_calls_total', {'provider': provider_name, 'outcome': 'coalesced'}, counts['coalesced']))
+
+    for provider_name, breaker in list(circuit_breaker.breakers.items()):
+        breaker_stats = breaker.stats()
+        samples.append(('weather_circuit_open', {'provider': provider_name}, int(breaker_stats['state'] == circuit_breaker.OPEN)))
+        samples.append(('weather_circuit_error_rate', {'provider': provider_name}, breaker_stats['error_rate']))
+
+    for provider_name, provider_quota in quota.quotas.items():
+        quota_stats = provider_quota.stats()
+        samples.append(('weather_quota_tokens', {'provider': provider_name}, quota_stats['tokens']))
+        if quota_stats['remaining_today'] is not None:
+            samples.append(('weather_quota_remaining_today', {'provider': provider_name}, quota_stats['remaining_today']))
+
+    for host, pool in http_client.pool_stats().items():
+        samples.append(('weather_http_requests_total', {'host': host}, pool['requests']))
+        samples.append(('weather_http_connections_opened_total', {'host': host}, pool['connections_opened']))
+        samples.append(('weather_http_idle_connections', {'host': host}, pool['idle_connections']))
+        samples.append(('weather_http_connection_reuse_ratio', {'host': host}, pool['reuse_ratio']))
+
+    for provider_name, hedger in list(hedging.hedgers.items()):
+        hedge_threshold = hedger.stats()['threshold']
+        if hedge_threshold is not None:
+            samples.append(('weather_hedge_threshold_seconds', {'provider': provider_name}, round(hedge_threshold, 3)))
+
+    return samples
+
+
+# JSON API
+# --------
+
+# Maximum number of locations per API request
+MAX_BATCH_SIZE = 100
+
+# Worker pool for geocoding and building reports for API batches (provider fetches still go through 'fanout')
+api_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='api')
+
+
+def api_geo_coder(query):
+
+    # Each query is either {"town": ..., "country_code": ...} or {"latitude": ..., "longitude": ...}
+    if not isinstance(query, dict):
+        return "Error"
+
+    with metrics.timer('geocode'):
+        if 'town' in query:
+            return geo_coder(str(query['town']), str(query.get('country_code', 'GB')))
+
+        if 'latitude' in query and 'longitude' in query:
+            return reverse_geo_coder(query['latitude'], query['longitude'])
+
+    return "Error"
+
+
+def api_record(index, query, weather_data=None, error=None):
+
+    # One line of NDJSON output
+    record = {'index': index, 'query': query}
+
+    if error is None:
+        record['data'] = records.display(weather_data)
+    else:
+        record['error'] = error
+
+    return json.dumps(record, default=str) + '\n'
+
+
+def api_record_from_future(index, query, future):
+
+    try:
+        return api_record(index, query, weather_data=future.result())
+    except Exception as error:
+        return api_record(index, query, error=f'Weather lookup failed: {error}')
+
+
+@app.route('/api/v1/weather', methods=['POST'])
+def api_weather():
+
+    # Request body: {"locations": [{"town": "London", "country_code": "GB"}, {"latitude": 51.5, "longitude": -0.1}]}
+    body = request.get_json(silent=True)
+
+    if not isinstance(body, dict) or not isinstance(body.get('locations'), list):
+        return {'error': "Expected a JSON object with a 'locations' list"}, 400
+
+    queries = body['locations']
+
+    if len(queries) > MAX_BATCH_SIZE:
+        return {'error': f'At most {MAX_BATCH_SIZE} locations per request'}, 400
+
+    def generate():
+
+        # Geocode every query at the same time
+        geocode_futures = {api_executor.submit(api_geo_coder, query): index for index, query in enumerate(queries)}
+
+        # Each distinct location is only fetched once, however many queries resolve to it
+        report_futures = {}  # (location_id, latitude, longitude) -> future
+        report_indexes = {}  # future -> indexes of the queries waiting on it
+        finished_reports = set()
+
+        pending = set(geocode_futures)
+
+        # Send each result back as soon as it is ready
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+
+                # Geocoding finished - start (or join) the weather report for the location
+                if future in geocode_futures:
+                    index = geocode_futures[future]
+
+                    try:
+                        geo_coder_data = future.result()
+                    except Exception as error:
+                        yield api_record(index, queries[index], error=f'Geocoding failed: {error}')
+                        continue
+
+                    if geo_coder_data == "Error":
+                        yield api_record(index, queries[index], error='Location not found')
+                        continue
+
+                    if geo_coder_data == "Busy":
+                        yield api_record(index, queries[index], error='Geocoding is busy, try again shortly')
+                        continue
+
+                    prefetcher.record(forecast_location(geo_coder_data))
+
+                    location_key = (geo_coder_data['location_id'], geo_coder_data['latitude'], geo_coder_data['longitude'])
+
+                    if location_key not in report_futures:
+                        report_future = api_executor.submit(weather_report, geo_coder_data)
+                        report_futures[location_key] = report_future
+                        report_indexes[report_future] = []
+                        pending.add(report_future)
+
+                    report_future = report_futures[location_key]
+
+                    # Report was already sent for an earlier query - send it for this one too
+                    if report_future in finished_reports:
+                        yield api_record_from_future(index, queries[index], report_future)
+                    else:
+                        report_indexes[report_future].append(index)
+
+                # Weather report finished - send it for every query waiting on it
+                else:
+                    finished_reports.add(future)
+                    for index in report_indexes.pop(future):
+                        yield api_record_from_future(index, queries[index], future)
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+# Longest history that can be asked for in one request, in hours
+MAX_HISTORY_HOURS = 366 * 24
+
+
+def nan_to_none(values):
+
+    # JSON has no NaN, missing readings are sent as null
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+@app.route('/api/v1/history')
+def api_history():
+
+    # Past readings for a location, e.g. /api/v1/history?location_id=2643743&hours=48 (no upstream calls)
+    # 'readings' is [hour][provider][variable], 'accuracy' is each provider's mean difference from the consensus
+    if history_store is None:
+        return {'error': 'History is turned off'}, 404
+
+    try:
+        location_id = int(request.args['location_id'])
+        hours = int(request.args.get('hours', 24))
+    except (KeyError, ValueError):
+        return {'error': "Expected an integer 'location_id' and optional 'hours'"}, 400
+
+    if not 0 < hours <= MAX_HISTORY_HOURS:
+        return {'error': f"'hours' must be between 1 and {MAX_HISTORY_HOURS}"}, 400
+
+    # The last 'hours' hours, including the current one
+    end_hour = timeseries.epoch_hour() + 1
+    start_hour = end_hour - hours
+
+    history_hours, readings = history_store.series(location_id, start_hour, end_hour)
+    accuracy = history_store.accuracy(location_id, start_hour, end_hour)
+
+    return {
+        'location_id': location_id,
+        'providers': aggregation.PROVIDERS,
+        'variables': aggregation.VARIABLES,
+        'hours': history_hours.tolist(),
+        'readings': nan_to_none(readings),
+        'accuracy': nan_to_none(accuracy)
+    }
 
 
 if __name__ == '__main__':
@@ -0,0 +1,463 @@
+# Async (ASGI) serving mode.
+#
+# The results page is handled on an asyncio event loop: geocoding and every provider fetch are awaited on a shared
+# aiohttp session, so one worker process can hold hundreds of lookups waiting on upstreams without an OS thread
+# each. Provider URLs, parsing, caching, circuit breakers and the report itself are shared with app.py. The CPU-bound
+# parts of a lookup (building the report, with its accuracy and history updates, and rendering the page) run on a
+# small thread pool so they don't hold up the other lookups on the loop.
+# Every other route (home page, static files, JSON API) is passed through to the Flask app.
+#
+# Run with an ASGI server, e.g.:
+#   uvicorn asgi:application --workers 4
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+import asyncio
+import codecs
+import json
+import time
+
+import aiohttp
+from asgiref.wsgi import WsgiToAsgi
+from flask import render_template
+
+import app
+import circuit_breaker  # Module for skipping providers while they are unhealthy
+import fanout  # Module for running provider fetches concurrently (timeouts are shared)
+import hedging  # Module for hedging slow upstream calls with a second request
+import html_extract  # Module for pulling elements out of scraped web pages
+import http_client  # Module containing the shared, pooled HTTP session for outbound requests
+import forecast_cache  # Module for caching provider results per location and time bucket
+import metrics  # Module for latency histograms and counters
+import page_cache  # Module for caching rendered results pages
+import quota  # Module for per-provider upstream request quotas
+import single_flight  # Module for sharing one upstream call between identical concurrent lookups
+
+# Async connection pool: total connections open at once across all upstreams
+MAX_CONNECTIONS = 200
+
+# Threads for building reports and rendering pages
+REPORT_WORKERS = 8
+report_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix='report')
+
+# Everything except the results page is served by Flask
+flask_application = WsgiToAsgi(app.app)
+
+# Created on first use, inside the event loop
+session = None
+
+
+def get_session():
+
+    global session
+
+    if session is None:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS),
+            timeout=aiohttp.ClientTimeout(connect=http_client.CONNECT_TIMEOUT, sock_read=http_client.READ_TIMEOUT)
+        )
+
+    return session
+
+
+class Response:
+
+    # Downloaded response with the parts of the requests API the parsers in app.py use
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+async def run_blocking(function, *args, **kwargs):
+
+    # function(*args, **kwargs) on a report thread, inside the Flask app context (templates need it)
+    return await asyncio.get_running_loop().run_in_executor(report_executor, in_app_context, function, args, kwargs)
+
+
+def in_app_context(function, args, kwargs):
+
+    with app.app.app_context():
+        return function(*args, **kwargs)
+
+
+async def get(url, **kwargs):
+
+    async with get_session().get(url, **kwargs) as response:
+        return Response(response.status, response.headers, await response.read())
+
+
+# Async fetchers - the same requests as the sync providers in app.py, parsed by the same functions
+
+async def geo_coder(town, country_code):
+
+    # Validate submitted form fields for request (using helper function)
+    if app.validate_request(town) is False or app.validate_request(country_code) is False:
+        return "Error"
+
+    # Check the cache first
+    cache_key = app.geo_coder_key(town, country_code)
+    geo_coder_data = app.geo_cache.get(cache_key)
+
+    if geo_coder_data is not None:
+        return geo_coder_data
+
+    # Then the offline gazetteer (memory-mapped, quick enough to run on the event loop)
+    geo_coder_data = app.local_geo_coder(town, country_code)
+
+    if geo_coder_data is not None:
+        return geo_coder_data
+
+    # Identical lookups arriving together share one GeoNames call
+    return await single_flight.async_group.do(('GeoNames',) + cache_key, geo_coder_fetch, town, country_code, cache_key)
+
+
+async def geo_coder_fetch(town, country_code, cache_key):
+
+    # As app.geo_coder_fetch, "Busy" if the GeoNames quota is used up for now
+    try:
+        await quota.acquire_async('GeoNames')
+    except quota.QuotaExceededError as error:
+        app.logger.warning('geocode_busy error="%s"', error)
+        return "Busy"
+
+    geonames_request = await get(app.geo_coder_url(town, country_code))
+
+    return app.geo_coder_result(cache_key, geonames_request)
+
+
+async def fetch_page(url, selectors):
+
+    # Stream the page through the targeted parser (see html_extract) as it downloads
+    async with get_session().get(url) as response:
+        parser = html_extract.TargetedParser(selectors)
+        decoder = codecs.getincrementaldecoder(html_extract.response_charset(response))(errors='replace')
+
+        # Stop parsing once everything is found, but read the rest so the connection can be reused
+        parse_seconds = 0
+        async for chunk in response.content.iter_chunked(html_extract.CHUNK_SIZE):
+            if not parser.done:
+                start = time.perf_counter()
+                parser.feed(decoder.decode(chunk))
+                parse_seconds += time.perf_counter() - start
+
+    metrics.observe('weather_stage_seconds', parse_seconds, stage='html_parse', engine='stream')
+
+    return html_extract.check_results(url, selectors, parser.results)
+
+
+async def openweather(latitude, longitude):
+
+    ow_request = await get(app.openweather_url(latitude, longitude))
+
+    return app.openweather_data(ow_request)
+
+
+async def metoffice_forecast(latitude, longitude):
+
+    url, headers, params = app.metoffice_request(latitude, longitude)
+
+    # Send booleans as 'True' / 'False' like requests does (aiohttp only accepts strings and numbers)
+    params = {name: str(value) if isinstance(value, bool) else value for name, value in params.items()}
+    req = await get(url, headers=headers, params=params)
+
+    return app.metoffice_forecast(req)
+
+
+async def bbc_weather(location_id):
+
+    page = await fetch_page(app.bbc_url(location_id), app.BBC_SELECTORS)
+
+    return app.bbc_data(page)
+
+
+async def yrno(location_id):
+
+    page = await fetch_page(app.yrno_url(location_id), app.YRNO_SELECTORS)
+
+    return app.yrno_data(page)
+
+
+async def cached(provider, fetch, *args):
+
+    # Async equivalent of calling a forecast_cache.CachedProvider: serve from the cache when possible,
+    # otherwise fetch through the provider's circuit breaker and store the result
+    # The time bucket is worked out once, as in forecast_cache.CachedProvider
+    key = provider.cache_key(args, time.time())
+
+    data = provider.lookup(*args, key=key)
+    if data is not None:
+        return data
+
+    # Concurrent misses for the same entry share one upstream call
+    return forecast_cache.copy(await single_flight.async_group.do(key, refresh, provider, fetch, key, *args))
+
+
+async def refresh(provider, fetch, key, *args):
+
+    # Quota first, so time spent queueing isn't counted against the provider's health
+    await quota.acquire_async(provider.name)
+
+    breaker = circuit_breaker.get(provider.name)
+    if not breaker.allow():
+        raise circuit_breaker.CircuitOpenError(f"{provider.name} is unavailable (circuit open), skipping.")
+
+    start = time.monotonic()
+    try:
+        with metrics.timer('upstream', provider=provider.name):
+            data = await hedging.call_async(provider.name, fetch, *args)
+    except Exception:
+        breaker.record(False, time.monotonic() - start)
+        raise
+
+    breaker.record(True, time.monotonic() - start)
+
+    return provider.store(args, data, key)
+
+
+async def metoffice(latitude, longitude):
+
+    forecast = await cached(app.MetOfficeForecast, metoffice_forecast, latitude, longitude)
+
+    return app.metoffice_data(forecast)
+
+
+async def fan_out(calls, deadline=fanout.OVERALL_DEADLINE):
+
+    # Async version of fanout.fan_out: 'calls' maps a provider name to a coroutine
+    results = {}
+    errors = {}
+
+    async for name, result, error in as_completed(calls, deadline):
+        if error is None:
+            results[name] = result
+        else:
+            errors[name] = error
+
+    return results, errors
+
+
+async def as_completed(calls, deadline=fanout.OVERALL_DEADLINE):
+
+    # Async version of fanout.as_completed: yields (name, result, error) for each provider as soon as it answers,
+    # fails or times out
+    tasks = {
+        asyncio.ensure_future(asyncio.wait_for(timed_call(name, call), min(fanout.PROVIDER_TIMEOUT, deadline))): name
+        for name, call in calls.items()
+    }
+
+    end = time.monotonic() + deadline
+    pending = set(tasks)
+
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(0, end - time.monotonic()),
+                                               return_when=asyncio.FIRST_COMPLETED)
+
+            # Out of time for the whole fan-out
+            if not done:
+                for task in pending:
+                    task.cancel()
+                    metrics.increment('weather_provider_timeouts_total', provider=tasks[task])
+                    yield tasks[task], None, TimeoutError(f"{tasks[task]} did not respond within {deadline} seconds.")
+                return
+
+            for task in done:
+                name = tasks[task]
+                if task.cancelled() or isinstance(task.exception(), asyncio.TimeoutError):
+                    metrics.increment('weather_provider_timeouts_total', provider=name)
+                    yield name, None, TimeoutError(f"{name} did not respond within {fanout.PROVIDER_TIMEOUT} seconds.")
+                elif task.exception() is not None:
+                    yield name, None, task.exception()
+                else:
+                    yield name, task.result(), None
+
+    finally:
+        # The caller stopped early (e.g. the browser went away)
+        for task in pending:
+            task.cancel()
+
+
+async def timed_call(name, call):
+
+    # Provider time as seen by the request, including cache hits
+    with metrics.timer('provider', provider=name):
+        return await call
+
+
+async def weather_report(GEO_CODER_DATA):
+
+    # Get weather data from all providers at the same time
+    provider_data, provider_errors = await fan_out(await provider_calls(GEO_CODER_DATA))
+
+    return await run_blocking(app.build_report, GEO_CODER_DATA, provider_data, provider_errors)
+
+
+async def provider_calls(GEO_CODER_DATA):
+
+    # Provider coroutines for a location (async version of app.provider_calls)
+    # Providers are asked about the location's forecast cell
+    FORECAST_LOCATION = app.forecast_location(GEO_CODER_DATA)
+    latitude = FORECAST_LOCATION['latitude']
+    longitude = FORECAST_LOCATION['longitude']
+    location_id = FORECAST_LOCATION['location_id']
+
+    # Except any not accurate enough here to be worth it
+    skipped = await run_blocking(app.skipped_providers, GEO_CODER_DATA)
+
+    return {name: function(*args) for name, (function, args) in {
+        'OpenWeather': (cached, (app.OpenWeather, openweather, latitude, longitude)),
+        'MetOffice': (metoffice, (latitude, longitude)),
+        'BBCWeather': (cached, (app.BBCWeather, bbc_weather, location_id)),
+        'YrNo': (cached, (app.YrNo, yrno, location_id))
+    }.items() if name not in skipped}
+
+
+async def stream_results(GEO_CODER_DATA):
+
+    # Chunks of a streamed results page, as in app.stream_results
+    provider_data = {}
+    provider_errors = {}
+
+    head, tail = await run_blocking(app.stream_start, GEO_CODER_DATA)
+    yield head
+
+    async for provider_name, data, error in as_completed(await provider_calls(GEO_CODER_DATA)):
+        if error is None:
+            provider_data[provider_name] = data
+        else:
+            provider_errors[provider_name] = error
+
+        yield await run_blocking(app.stream_provider, GEO_CODER_DATA, provider_data, provider_name)
+
+    yield await run_blocking(app.stream_finish, GEO_CODER_DATA, provider_data, provider_errors) + tail
+
+
+# ASGI handlers
+
+async def read_body(receive):
+
+    body = b''
+    more_body = True
+
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    return body
+
+
+async def send_html(send, status, html, headers=()):
+
+    body = html.encode()
+
+    headers = [(name.lower().encode(), value.encode()) for name, value in headers]
+    if status != 304:
+        headers += [(b'content-type', b'text/html; charset=utf-8'), (b'content-length', str(len(body)).encode())]
+
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_stream(send, chunks, headers=()):
+
+    # Chunked response, each chunk sent as soon as it's ready
+    headers = [(name.lower().encode(), value.encode()) for name, value in headers]
+    headers += [(b'content-type', b'text/html; charset=utf-8')]
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+
+    # Closing 'chunks' cancels any provider fetches still running if the browser goes away
+    try:
+        async for chunk in chunks:
+            await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+    finally:
+        await chunks.aclose()
+
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def results(scope, receive, send):
+
+    # Get town and country code from the search form (query string for GET /results, body for POST /)
+    if scope['method'] == 'POST':
+        form = parse_qs((await read_body(receive)).decode())
+    else:
+        form = parse_qs(scope['query_string'].decode())
+
+    town = form.get('townName', [''])[0]
+    country_code = form.get('countryCode', [''])[0]
+    stream = form.get('stream', [''])[0] == '1'
+    request_headers = {name.decode().lower(): value.decode() for name, value in scope['headers']}
+
+    # Geocode
+    with metrics.timer('geocode'):
+        GEO_CODER_DATA = await geo_coder(town, country_code)
+
+    # Redirect 'home_error.html' if bad request
+    if GEO_CODER_DATA == "Error":
+        return await send_html(send, 200, await run_blocking(render_template, 'home_error.html'))
+
+    # Or if GeoNames can't be asked right now
+    if GEO_CODER_DATA == "Busy":
+        return await send_html(send, 503, await run_blocking(render_template, 'home_error.html', message=app.BUSY_MESSAGE))
+
+    # Count the lookup (by forecast cell) so popular locations are refreshed ahead of time
+    app.prefetcher.record(app.forecast_location(GEO_CODER_DATA))
+
+    # Rendered page for this location and hour, if there is one
+    page = page_cache.get(GEO_CODER_DATA)
+
+    # Send the page as the providers answer (see app.stream_results)
+    if page is None and stream:
+        return await send_stream(send, stream_results(GEO_CODER_DATA), app.STREAM_HEADERS)
+
+    if page is None:
+
+        # Get weather for the location (or say so if no provider answered, as app.results does)
+        try:
+            weather_data = await weather_report(GEO_CODER_DATA)
+        except Exception as error:
+            app.logger.error('report_failed location=%s error="%s"', GEO_CODER_DATA['location_id'], error)
+            html = await run_blocking(render_template, 'home_error.html', message=app.UNAVAILABLE_MESSAGE)
+            return await send_html(send, 503, html)
+
+        # Render results page
+        with metrics.timer('render'):
+            page = await run_blocking(page_cache.render, GEO_CODER_DATA, weather_data)
+
+    # Browser copy is still current
+    if page_cache.not_modified(page, request_headers.get('if-none-match'), request_headers.get('if-modified-since')):
+        return await send_html(send, 304, '', page_cache.headers(page))
+
+    await send_html(send, 200, page.html, page_cache.headers(page))
+
+
+async def lifespan(scope, receive, send):
+
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+
+        elif message['type'] == 'lifespan.shutdown':
+            if session is not None:
+                await session.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+
+    if scope['type'] == 'lifespan':
+        return await lifespan(scope, receive, send)
+
+    # Results page is handled here, everything else by Flask
+    if scope['type'] == 'http' and (scope['method'], scope['path']) in (('POST', '/'), ('GET', '/results')):
+        return await results(scope, receive, send)
+
+    return await flask_application(scope, receive, send)
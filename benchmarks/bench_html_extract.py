@@ -0,0 +1,164 @@
+# Benchmark: HTML extraction engines vs the original full BeautifulSoup 'html.parser' path, for the BBC Weather
+# and Yr.No scrapers. Reports parse time and peak memory per page.
+#
+# Usage: python benchmarks/bench_html_extract.py [--fixtures DIR] [--repeat N]
+#
+# Peak memory is what tracemalloc sees. That excludes memory allocated inside C extensions, so it isn't shown for
+# lxml (whose tree lives in libxml2).
+#
+# Saved pages are read from DIR (default benchmarks/fixtures) as bbc.html and yrno.html. The ones committed there are
+# trimmed copies of the pages' markup around the scraped elements, with the inline scripts and styles taken out.
+# Any page that is missing is replaced by a synthetic page of a similar size to the untrimmed page, with the scraped
+# elements embedded in filler markup.
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import html_extract  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Selectors used by the scrapers in app.py
+SELECTORS = {
+    'bbc': {
+        'temperature': ("div", "class", "wr-time-slot-primary__temperature"),
+        'feels_like': ("span", "class", "wr-time-slot-secondary__feels-like-temperature-value gel-long-primer-bold wr-value--temperature--c"),
+        'wind_speed': ("div", "class", "wr-time-slot-primary__wind-speed"),
+        'wind_desc': ("div", "class", "wr-time-slot-secondary__wind-direction wr-time-slot-secondary__bottom-section gel-long-primer"),
+        'rain_chance': ("div", "class", "wr-u-font-weight-500"),
+        'humidity': ("dd", "class", "wr-time-slot-secondary__value gel-long-primer-bold")
+    },
+    'yrno': {
+        'temperature': [("span", "class", "temperature temperature--warm"), ("span", "class", "temperature temperature--cold")],
+        'feels_like': ("div", "class", "feels-like-text"),
+        'wind_speed': ("span", "class", "wind__value now-hero__next-hour-wind-value"),
+        'rain_amount': ("span", "class", "now-hero__next-hour-precipitation-value")
+    }
+}
+
+# Synthetic pages: elements to embed, fraction of the way through the page to put them, and page size in bytes
+SYNTHETIC = {
+    'bbc': ('<div class="wr-time-slot-primary__temperature">12°</div>'
+            '<span class="wr-time-slot-secondary__feels-like-temperature-value gel-long-primer-bold wr-value--temperature--c">10°</span>'
+            '<div class="wr-time-slot-primary__wind-speed">9 mph</div>'
+            '<div class="wr-time-slot-secondary__wind-direction wr-time-slot-secondary__bottom-section gel-long-primer">Gentle breeze</div>'
+            '<div class="wr-u-font-weight-500">10% chance of precipitation</div>'
+            '<span class="wr-c-astro-data__sunrise gel-pica-bold gs-u-pl-">Sunrise07:30</span>'
+            '<span class="wr-c-astro-data__sunset gel-pica gs-u-pl-">Sunset18:10</span>'
+            '<dl><dt>Humidity</dt><dd class="wr-time-slot-secondary__value gel-long-primer-bold">81%</dd></dl>', 0.3, 600_000),
+    'yrno': ('<span class="temperature temperature--warm">Temperature11°</span>'
+             '<div class="feels-like-text">Feels like 10°</div>'
+             '<span class="wind__value now-hero__next-hour-wind-value">4</span>'
+             '<span class="now-hero__next-hour-precipitation-value">0.2</span>', 0.2, 400_000)
+}
+
+
+def filler(size):
+
+    # Markup resembling a forecast page: nested divs, lists, links and inline styles
+    block = ('<div class="gel-wrap"><ul class="nav">' + ''.join(
+        f'<li class="nav__item"><a href="/weather/{i}" data-id="{i}">Item {i} &amp; more</a></li>' for i in range(10)) +
+        '</ul><p style="color:#333">Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>'
+        '<script>var x = {"a": [1, 2, 3]};</script></div>\n')
+
+    return block * (size // len(block) + 1)
+
+
+def synthetic_page(name):
+
+    targets, position, size = SYNTHETIC[name]
+    before = filler(int(size * position))
+    after = filler(int(size * (1 - position)))
+
+    return f'<!DOCTYPE html><html><head><title>{name}</title></head><body>{before}{targets}{after}</body></html>'.encode()
+
+
+def load_page(name, fixtures_dir):
+
+    path = os.path.join(fixtures_dir, f'{name}.html')
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            return file.read(), 'saved'
+
+    return synthetic_page(name), 'synthetic'
+
+
+def original_path(content, selectors):
+
+    # What the scrapers did before: build the whole tree with 'html.parser', then search it
+    soup = BeautifulSoup(content, 'html.parser')
+    return soup
+
+
+def stream_path(content, selectors):
+
+    chunks = (content[i:i + html_extract.CHUNK_SIZE].decode('utf-8', 'replace')
+              for i in range(0, len(content), html_extract.CHUNK_SIZE))
+    return html_extract.extract_stream(chunks, selectors)
+
+
+def soup_path(content, selectors):
+    return html_extract.extract_soup(content, selectors)
+
+
+# Engines whose memory tracemalloc can't see
+UNTRACED = ('lxml',)
+
+
+def lxml_path(content, selectors):
+    return html_extract.extract_lxml(content, selectors)
+
+
+def measure(function, content, selectors, repeat):
+
+    # Best wall time over 'repeat' runs, then peak traced memory for one run
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(content, selectors)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(content, selectors)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return best, peak
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    engines = {
+        'original (html.parser)': original_path,
+        'stream': stream_path,
+        'soup': soup_path
+    }
+    if html_extract.lxml is not None:
+        engines['lxml'] = lxml_path
+
+    print(f"{'page':<6} {'source':<10} {'engine':<24} {'time (ms)':>10} {'peak (KiB)':>11} {'speed-up':>9}")
+
+    for name, selectors in SELECTORS.items():
+        content, source = load_page(name, args.fixtures)
+        baseline = None
+
+        for engine_name, function in engines.items():
+            best, peak = measure(function, content, selectors, args.repeat)
+            baseline = baseline or best
+            peak = '-' if engine_name in UNTRACED else f"{peak / 1024:.0f}"
+            print(f"{name:<6} {source:<10} {engine_name:<24} {best * 1000:>10.2f} {peak:>11} {baseline / best:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+# Benchmark: the full results page and each stage behind it, run offline against recorded provider responses
+# (see replay.py) served from a local stub server. Reports median and best time and peak memory per stage, and can
+# save the numbers and compare a later run against them to catch performance regressions.
+#
+# Usage: python benchmarks/bench_pipeline.py [--fixtures DIR] [--location Town,CC] [--repeat N]
+#                                            [--save FILE] [--compare FILE] [--tolerance FRACTION]
+#
+# Recordings are read from DIR (default benchmarks/fixtures/recorded, made with 'python replay.py record DIR ...').
+# If there are none, a synthetic London recording is generated, with the saved scraped pages from
+# benchmarks/fixtures (see bench_html_extract.py).
+#
+# Peak memory is what tracemalloc sees, which excludes memory allocated inside C extensions such as numpy.
+# '--compare' exits with status 1 if any stage's median time is more than '--tolerance' slower than the saved run.
+from datetime import datetime, timedelta, timezone
+import argparse
+import gc
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import replay  # noqa: E402
+from stub_server import StubServer  # noqa: E402
+from bench_html_extract import load_page, FIXTURES_DIR as PAGES_DIR  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'recorded')
+
+
+def synthetic_recording(directory):
+
+    # One London lookup in the same format 'replay.py record' writes
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    steps = [{'time': (now + timedelta(hours=hour)).strftime(replay.METOFFICE_TIME_FORMAT), 'screenTemperature': 10.0,
+              'feelsLikeTemperature': 8.5, 'windSpeed10m': 4.2, 'windGustSpeed10m': 9.0, 'probOfPrecipitation': 20,
+              'significantWeatherCode': 7, 'uvIndex': 1, 'screenRelativeHumidity': 80.5, 'totalSnowAmount': 0}
+             for hour in range(-1, 48)]
+
+    place = {'name': 'London', 'countryCode': 'GB', 'lat': '51.50853', 'lng': '-0.12574', 'geonameId': 2643743,
+             'timezone': {'timeZoneId': 'Europe/London'}}
+
+    recordings = [
+        ('geonames', '/searchJSON?q=London&country=GB', 'application/json',
+         json.dumps({'totalResultsCount': 1, 'geonames': [place]})),
+        ('openweather', '/data/2.5/weather?lat=51.50853&lon=-0.12574&units=metric', 'application/json',
+         json.dumps({'main': {'temp': 11.2, 'feels_like': 9.9, 'humidity': 77}, 'wind': {'speed': 3.1},
+                     'weather': [{'description': 'broken clouds', 'icon': '04d'}]})),
+        ('metoffice', '/sitespecific/v0/point/hourly', 'application/json',
+         json.dumps({'features': [{'properties': {'timeSeries': steps}}]})),
+        ('bbc', '/weather/2643743', 'text/html; charset=utf-8', load_page('bbc', PAGES_DIR)[0].decode()),
+        ('yrno', '/en/forecast/daily-table/2-2643743', 'text/html; charset=utf-8', load_page('yrno', PAGES_DIR)[0].decode())
+    ]
+
+    for provider, key, content_type, body in recordings:
+        replay.save(directory, provider, key, 200, content_type, body.encode())
+
+
+def measure(function, setup, repeat):
+
+    # Median and best wall time over 'repeat' runs ('setup' runs before each, untimed), then peak memory for one run
+    times = []
+    for _ in range(repeat + 1):
+        setup()
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    # The first run is a warm-up
+    times = times[1:]
+
+    setup()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'median_ms': statistics.median(times) * 1000, 'best_ms': min(times) * 1000, 'peak_kib': peak / 1024}
+
+
+def stages(app, town, country_code):
+
+    # (name, setup, function) for each stage, in pipeline order
+    import aggregation
+    import forecast_cache
+    import html_extract
+    import http_client
+    import page_cache
+
+    def clear_caches():
+        app.geo_cache.clear()
+        forecast_cache.forecast_store.clear()
+        page_cache.pages.clear()
+        page_cache.shells.clear()
+
+    def nothing():
+        pass
+
+    # Inputs for the later stages, fetched once
+    clear_caches()
+    geo_coder_data = app.geo_coder(town, country_code)
+    if geo_coder_data == "Error":
+        raise Exception(f"No recording found for {town}, {country_code}")
+
+    latitude = geo_coder_data['latitude']
+    longitude = geo_coder_data['longitude']
+    location_id = geo_coder_data['location_id']
+
+    url, headers, params = app.metoffice_request(latitude, longitude)
+    metoffice_response = http_client.get(url, headers=headers, params=params)
+    bbc_page = http_client.get(app.bbc_url(location_id)).content
+    yrno_page = http_client.get(app.yrno_url(location_id)).content
+
+    provider_data, provider_errors = app.fanout.fan_out({
+        'OpenWeather': (app.OpenWeather, (latitude, longitude)),
+        'MetOffice': (app.MetOffice, (latitude, longitude)),
+        'BBCWeather': (app.BBCWeather, (location_id,)),
+        'YrNo': (app.YrNo, (location_id,))
+    })
+    if provider_errors:
+        raise Exception(f"Recorded providers failed: {provider_errors}")
+
+    weather_data = app.build_report(geo_coder_data, provider_data, {})
+    client = app.app.test_client()
+    form = {'townName': town, 'countryCode': country_code}
+
+    def parse_page(content, selectors):
+        # Fed in download-sized chunks, as when streaming, so parsing stops once everything is found
+        chunks = (content[i:i + html_extract.CHUNK_SIZE].decode('utf-8', 'replace')
+                  for i in range(0, len(content), html_extract.CHUNK_SIZE))
+        return html_extract.extract_stream(chunks, selectors)
+
+    def render():
+        with app.app.app_context():
+            page_cache.render(geo_coder_data, weather_data)
+
+    def clear_pages():
+        page_cache.pages.clear()
+
+    return [
+        ('geo_coder', clear_caches, lambda: app.geo_coder(town, country_code)),
+        ('openweather (fetch + parse)', nothing, lambda: app.OpenWeather.function(latitude, longitude)),
+        ('metoffice (fetch + parse)', nothing, lambda: app.MetOfficeForecast.function(latitude, longitude)),
+        ('metoffice (parse)', nothing, lambda: app.metoffice_data(app.metoffice_forecast(metoffice_response))),
+        ('bbc scraper (fetch + parse)', nothing, lambda: app.BBCWeather.function(location_id)),
+        ('bbc scraper (parse)', nothing, lambda: parse_page(bbc_page, app.BBC_SELECTORS)),
+        ('yrno scraper (fetch + parse)', nothing, lambda: app.YrNo.function(location_id)),
+        ('yrno scraper (parse)', nothing, lambda: parse_page(yrno_page, app.YRNO_SELECTORS)),
+        ('aggregation', nothing, lambda: aggregation.aggregate(aggregation.collect([provider_data]))),
+        ('build_report', nothing, lambda: app.build_report(geo_coder_data, provider_data, {})),
+        ('render (whole page)', clear_caches, render),
+        ('render (fragments only)', clear_pages, render),
+        ('results() cold', clear_caches, lambda: client.post('/', data=form)),
+        ('results() page cached', nothing, lambda: client.post('/', data=form))
+    ]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--location', default='London,GB')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare against results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    fixtures = args.fixtures
+    source = 'recorded'
+    if not replay.load(fixtures):
+        fixtures = tempfile.mkdtemp(prefix='weather-fixtures-')
+        synthetic_recording(fixtures)
+        source = 'synthetic'
+
+    town, _, country_code = args.location.partition(',')
+
+    with StubServer(replay.routes(fixtures)) as stub:
+
+        # Point the app at the stub before it is imported, keep its logging quiet and its history out of the way
+        os.environ.update(replay.env(stub.url))
+        os.environ['LogLevel'] = 'ERROR'
+        os.environ['HistoryFile'] = os.path.join(tempfile.mkdtemp(prefix='weather-history-'), 'history.db')
+        import app
+
+        results = {}
+        print(f"{source} fixtures, {args.location}, {args.repeat} runs per stage")
+        print(f"{'stage':<30} {'median (ms)':>12} {'best (ms)':>10} {'peak (KiB)':>11}")
+
+        for name, setup, function in stages(app, town, country_code or 'GB'):
+            results[name] = measure(function, setup, args.repeat)
+            print(f"{name:<30} {results[name]['median_ms']:>12.2f} {results[name]['best_ms']:>10.2f} "
+                  f"{results[name]['peak_kib']:>11.0f}")
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=1)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+        regressions = [name for name, result in results.items()
+                       if name in baseline and result['median_ms'] > baseline[name]['median_ms'] * (1 + args.tolerance)]
+
+        for name in regressions:
+            print(f"REGRESSION {name}: {baseline[name]['median_ms']:.2f}ms -> {results[name]['median_ms']:.2f}ms")
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# Load test: results page throughput and latency under concurrent users, for the threaded Flask server vs the
+# async (ASGI) serving mode in asgi.py. Every request is for a different town so the caches always miss and each
+# page has to wait on geocoding plus all four providers.
+#
+# Usage: python benchmarks/load_test.py [--requests N] [--concurrency N] [--delay SECONDS] [--modes flask asgi]
+#
+# Upstreams are a local stub server (see stub_server.py) answering after '--delay' seconds, so the numbers show how
+# many slow upstream calls each server can keep in flight rather than how fast the real providers are.
+from datetime import datetime, timedelta, timezone
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stub_server import StubServer  # noqa: E402
+
+# Commands to start each server on a given port
+SERVERS = {
+    'flask': [sys.executable, '-c', 'import sys, app; app.app.run(port=int(sys.argv[1]), threaded=True)'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:application', '--log-level', 'warning', '--port']
+}
+
+BBC_PAGE = ('<html><body><div class="wr-time-slot-primary__temperature">12°</div>'
+            '<span class="wr-time-slot-secondary__feels-like-temperature-value gel-long-primer-bold wr-value--temperature--c">10°</span>'
+            '<div class="wr-time-slot-primary__wind-speed">9 mph</div>'
+            '<div class="wr-time-slot-secondary__wind-direction wr-time-slot-secondary__bottom-section gel-long-primer">Gentle breeze</div>'
+            '<div class="wr-u-font-weight-500">10% chance of precipitation</div>'
+            '<dl><dt>Humidity</dt><dd class="wr-time-slot-secondary__value gel-long-primer-bold">81%</dd></dl>'
+            '</body></html>').encode()
+
+YRNO_PAGE = ('<html><body><span class="temperature temperature--warm">Temperature11°</span>'
+             '<div class="feels-like-text">Feels like 10°</div>'
+             '<span class="wind__value now-hero__next-hour-wind-value">4</span>'
+             '<span class="now-hero__next-hour-precipitation-value">0.2</span></body></html>').encode()
+
+OPENWEATHER = json.dumps({'main': {'temp': 11.2, 'feels_like': 9.9, 'humidity': 77}, 'wind': {'speed': 3.1},
+                          'weather': [{'description': 'broken clouds'}]}).encode()
+
+
+def metoffice_forecast():
+
+    # Hourly steps from a couple of hours ago to two days ahead
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    steps = [{'time': (now + timedelta(hours=hour)).strftime('%Y-%m-%dT%H:%MZ'), 'screenTemperature': 10.0,
+              'feelsLikeTemperature': 8.5, 'windSpeed10m': 4.2, 'windGustSpeed10m': 9.0, 'probOfPrecipitation': 20,
+              'significantWeatherCode': 7, 'uvIndex': 1, 'screenRelativeHumidity': 80.5}
+             for hour in range(-2, 48)]
+
+    return json.dumps({'features': [{'properties': {'timeSeries': steps}}]}).encode()
+
+
+def geonames(path, query):
+
+    # A distinct place (id and coordinates) for every town name, so no two requests share a cache entry
+    town = query.split('q=')[1].split('&')[0]
+    place_id = zlib.crc32(town.encode())
+
+    return 200, 'application/json', json.dumps({'totalResultsCount': 1, 'geonames': [{
+        'name': town, 'countryCode': 'GB', 'geonameId': place_id, 'timezone': {'timeZoneId': 'Europe/London'},
+        'lat': str(50 + place_id % 5000 / 1000), 'lng': str(-5 + place_id // 5000 % 5000 / 1000)
+    }]}).encode()
+
+
+def town_name(number):
+
+    # Form validation only accepts letters
+    letters = ''
+    while True:
+        number, digit = divmod(number, 26)
+        letters += chr(ord('a') + digit)
+        if number == 0:
+            return 'Town' + letters
+
+
+def serve_stub(routes, delays, ready):
+
+    # Upstream stub in its own process, so it doesn't compete with the load generator for the GIL
+    stub = StubServer(routes, delays)
+    ready.put(stub.url)
+    stub.server.serve_forever()
+
+
+def free_port():
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=20):
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+
+    raise Exception(f"Server on port {port} did not start within {timeout} seconds.")
+
+
+def percentile(values, proportion):
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(proportion * len(values)))]
+
+
+async def run_load(url, requests, concurrency, first_town):
+
+    latencies = []
+    failures = 0
+    queue = iter(range(first_town, first_town + requests))
+
+    async def user(session):
+        nonlocal failures
+        for number in queue:
+            start = time.monotonic()
+            try:
+                async with session.post(url, data={'townName': town_name(number), 'countryCode': 'GB'}) as response:
+                    ok = response.status == 200 and 'Sources' in await response.text()
+            except aiohttp.ClientError:
+                ok = False
+            latencies.append(time.monotonic() - start)
+            failures += not ok
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+        start = time.monotonic()
+        await asyncio.gather(*(user(session) for _ in range(concurrency)))
+        elapsed = time.monotonic() - start
+
+    return elapsed, latencies, failures
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--delay', type=float, default=0.2)
+    parser.add_argument('--modes', nargs='+', choices=sorted(SERVERS), default=['flask', 'asgi'])
+    args = parser.parse_args()
+
+    routes = {
+        '/geonames': geonames,
+        '/openweather': (200, 'application/json', OPENWEATHER),
+        '/metoffice': (200, 'application/json', metoffice_forecast()),
+        '/bbc': (200, 'text/html; charset=utf-8', BBC_PAGE),
+        '/yrno': (200, 'text/html; charset=utf-8', YRNO_PAGE)
+    }
+    delays = {path: args.delay for path in routes}
+
+    ready = multiprocessing.Queue()
+    stub = multiprocessing.Process(target=serve_stub, args=(routes, delays, ready), daemon=True)
+    stub.start()
+    stub_url = ready.get()
+
+    env = dict(os.environ)
+    for name, path in [('GeoNamesURL', '/geonames'), ('OpenWeatherURL', '/openweather'),
+                       ('MetOfficeURL', '/metoffice'), ('BBCWeatherURL', '/bbc'), ('YrNoURL', '/yrno')]:
+        env[name] = stub_url + path
+
+    # Readings history goes to a scratch file rather than the working directory
+    env['HistoryFile'] = os.path.join(tempfile.mkdtemp(prefix='weather-history-'), 'history.db')
+
+    # The stub has no rate limits to protect
+    env['UpstreamQuotas'] = 'off'
+
+    print(f"{args.requests} requests, {args.concurrency} concurrent users, {args.delay * 1000:.0f}ms upstreams")
+    print(f"{'server':8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'failed':>7}")
+
+    try:
+        for run, mode in enumerate(args.modes):
+            port = free_port()
+            server = subprocess.Popen(SERVERS[mode] + [str(port)], cwd=ROOT, env=env,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_for_port(port)
+                # Each run gets its own towns so nothing is served from another run's geocoding
+                elapsed, latencies, failures = asyncio.run(
+                    run_load(f'http://127.0.0.1:{port}/', args.requests, args.concurrency, run * args.requests))
+            finally:
+                server.terminate()
+                server.wait()
+
+            print(f"{mode:8} {len(latencies) / elapsed:8.1f} {percentile(latencies, 0.5) * 1000:8.0f} "
+                  f"{percentile(latencies, 0.99) * 1000:8.0f} {failures:7}")
+    finally:
+        stub.terminate()
+
+
+if __name__ == '__main__':
+    main()
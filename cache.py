@@ -0,0 +1,134 @@
+# Bounded, thread-safe in-memory cache with TTL expiry and LRU eviction, optionally persisted to a JSON file
+# so that a restart starts warm
+from collections import OrderedDict
+import threading
+import atexit
+import json
+import tempfile
+import time
+import os
+
+
+class TTLCache:
+
+    def __init__(self, maxsize=1000, ttl=3600, path=None, save_interval=60):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.save_interval = save_interval
+
+        # key -> (expiry timestamp, value), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.last_save = time.time()
+
+        # One save at a time
+        self.save_lock = threading.Lock()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+        if self.path:
+            self.load()
+            atexit.register(self.save)
+
+    def get(self, key, default=None):
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            # Missing or expired
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+
+            # Mark as most recently used
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+
+        if ttl is None:
+            ttl = self.ttl
+
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            self.entries.move_to_end(key)
+
+            # Evict least recently used entries
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        # Persist now and then rather than on every write, in the background so the caller doesn't wait on the disk
+        if self.path and self.save_due():
+            threading.Thread(target=self.save, name='cache-save', daemon=True).start()
+
+    def save_due(self):
+
+        # Claims the next save, so only one caller starts it
+        with self.lock:
+            now = time.time()
+            if now - self.last_save < self.save_interval:
+                return False
+
+            self.last_save = now
+            return True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+
+    def save(self):
+
+        if not self.path:
+            return
+
+        now = time.time()
+
+        # Keys are stored as lists because JSON has no tuples
+        with self.lock:
+            data = [[list(key), expiry, value] for key, (expiry, value) in self.entries.items() if expiry > now]
+
+        # Write to a temporary file of our own first, so a crash never leaves a half written cache
+        with self.save_lock:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.cache-', suffix='.tmp', delete=False) as file:
+                temp_path = file.name
+                try:
+                    json.dump(data, file)
+                except Exception:
+                    file.close()
+                    os.remove(temp_path)
+                    raise
+            os.replace(temp_path, self.path)
+
+        with self.lock:
+            self.last_save = max(self.last_save, now)
+
+    def load(self):
+
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        now = time.time()
+
+        with self.lock:
+            for key, expiry, value in data:
+                if expiry > now:
+                    self.entries[tuple(key)] = (expiry, value)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
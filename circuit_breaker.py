@@ -0,0 +1,141 @@
+# Per-provider circuit breakers: track recent error rate and latency for each provider and stop calling it while
+# it is unhealthy, so one broken or slow site doesn't hold up every request.
+#
+# A breaker is 'closed' (calls go through) until too many recent calls fail or are slow. It then 'opens' and calls
+# are skipped for a cool-down period, after which it goes 'half open' and lets a single trial call through.
+# The trial closes the breaker again if it succeeds, or re-opens it if it fails.
+from collections import deque
+import threading
+import time
+
+# Number of recent calls considered
+WINDOW_SIZE = 20
+
+# Minimum calls in the window before the breaker can open
+MIN_CALLS = 5
+
+# Fraction of failed (or slow) calls in the window that opens the breaker
+FAILURE_THRESHOLD = 0.5
+
+# Calls slower than this many seconds count as failures
+SLOW_CALL_SECONDS = 8
+
+# Seconds to skip a provider once its breaker opens
+COOL_DOWN = 60
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half open'
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, window_size=WINDOW_SIZE, min_calls=MIN_CALLS, failure_threshold=FAILURE_THRESHOLD,
+                 slow_call_seconds=SLOW_CALL_SECONDS, cool_down=COOL_DOWN):
+
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.cool_down = cool_down
+
+        # Recent outcomes: (succeeded, latency in seconds)
+        self.outcomes = deque(maxlen=window_size)
+
+        self.state = CLOSED
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+
+        # Whether a call should go ahead right now
+        with self.lock:
+
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.cool_down:
+                    return False
+                self.state = HALF_OPEN
+
+            if self.state == HALF_OPEN:
+                if self.trial_running:
+                    return False
+                self.trial_running = True
+
+            return True
+
+    def record(self, succeeded, latency):
+
+        # A slow success is still counted as a failure
+        healthy = succeeded and latency < self.slow_call_seconds
+
+        with self.lock:
+            self.outcomes.append((healthy, latency))
+
+            if self.state == HALF_OPEN:
+                self.trial_running = False
+                if healthy:
+                    self.state = CLOSED
+                    self.outcomes.clear()
+                else:
+                    self.trip()
+
+            elif self.state == CLOSED and len(self.outcomes) >= self.min_calls:
+                failures = sum(1 for outcome in self.outcomes if not outcome[0])
+                if failures / len(self.outcomes) >= self.failure_threshold:
+                    self.trip()
+
+    def trip(self):
+
+        # Open the breaker (lock must be held)
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+    def call(self, function, *args):
+
+        # Run 'function' through the breaker, raising CircuitOpenError if the provider is being skipped
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} is unavailable (circuit open), skipping.")
+
+        start = time.monotonic()
+        try:
+            result = function(*args)
+        except Exception:
+            self.record(False, time.monotonic() - start)
+            raise
+
+        self.record(True, time.monotonic() - start)
+
+        return result
+
+    def stats(self):
+
+        with self.lock:
+            calls = len(self.outcomes)
+            failures = sum(1 for outcome in self.outcomes if not outcome[0])
+            latencies = sorted(outcome[1] for outcome in self.outcomes)
+
+        return {
+            'state': self.state,
+            'calls': calls,
+            'error_rate': round(failures / calls, 3) if calls else 0.0,
+            'median_latency': round(latencies[calls // 2], 3) if calls else None
+        }
+
+
+# One breaker per provider, created on first use
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def get(name):
+
+    with breakers_lock:
+        if name not in breakers:
+            breakers[name] = CircuitBreaker(name)
+
+        return breakers[name]
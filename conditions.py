@@ -0,0 +1,198 @@
+# Weather condition table, keyed by Met Office significant weather code (0-30), built once at import.
+# Each condition carries its description, HTML emoji and image, so every provider can be reduced to a code and
+# looked up by index. OpenWeather's free-text descriptions are normalised onto the same codes.
+#
+# UV bands depend on the UV index rather than the weather code, so they are a separate table indexed by UV index.
+# Moon phase emoji are keyed by phase name.
+from collections import namedtuple
+import math
+
+Condition = namedtuple('Condition', ['code', 'description', 'emoji', 'image'])
+
+# HTML for the weather image shown on the results page
+IMAGE_HTML = '<img src="static/weatherimages/{}.jpg" style="transform: translate(100px,10px)" alt="Weather Image";>'
+
+# Code, description, HTML emoji code(s) and image file name, in code order
+CONDITION_DATA = (
+    (0, "Clear night", "127747", "ClearNight"),
+    (1, "Sunny day", "127775", "Sunny"),
+    (2, "Partly cloudy (night)", "9729", "CloudyNight"),
+    (3, "Partly cloudy (day)", "9925", "CloudyDay"),
+    (4, "Not used", "10068", "NotAvailable"),
+    (5, "Mist", "127787;&#65039", "Mist"),
+    (6, "Fog", "127787;&#65039", "Fog"),
+    (7, "Cloudy", "9729;&#65039", "Cloudy"),
+    (8, "Overcast", "127745", "Overcast"),
+    (9, "Light rain shower (night)", "9748", "LightRainShowerNight"),
+    (10, "Light rain shower (day)", "9748", "LightRainShowerDay"),
+    (11, "Drizzle", "9748", "Drizzle"),
+    (12, "Light rain", "9748", "LightRain"),
+    (13, "Heavy rain shower (night)", "9748", "HeavyRainShowerNight"),
+    (14, "Heavy rain shower (day)", "9748", "HeavyRainShowerDay"),
+    (15, "Heavy rain", "9748", "HeavyRain"),
+    (16, "Sleet shower (night)", "127784;&#65039", "SleetShowerNight"),
+    (17, "Sleet shower (day)", "127784;&#65039", "SleetShowerDay"),
+    (18, "Sleet", "127784;&#65039", "Sleet"),
+    (19, "Hail shower (night)", "127784;&#65039", "HailShowerNight"),
+    (20, "Hail shower (day)", "127784;&#65039", "HailShowerDay"),
+    (21, "Hail", "127784;&#65039", "Hail"),
+    (22, "Light snow shower (night)", "127784;&#65039", "LightSnowShowerNight"),
+    (23, "Light snow shower (day)", "127784;&#65039", "LightSnowShowerDay"),
+    (24, "Light snow", "9731;&#65039", "LightSnow"),
+    (25, "Heavy snow shower (night)", "9731;&#65039", "HeavySnowShowerNight"),
+    (26, "Heavy snow shower (day)", "9731;&#65039", "HeavySnowShowerDay"),
+    (27, "Heavy snow", "9731;&#65039", "HeavySnow"),
+    (28, "Thunder shower (night)", "127785;&#65039", "ThunderShowerNight"),
+    (29, "Thunder shower (day)", "127785;&#65039", "ThunderShowerDay"),
+    (30, "Thunder", "127785;&#65039", "Thunder")
+)
+
+# Condition for each code, CONDITIONS[code]
+CONDITIONS = tuple(Condition(code, description, '&#' + emoji, IMAGE_HTML.format(image))
+                   for code, description, emoji, image in CONDITION_DATA)
+
+# When no provider gives a code
+NOT_AVAILABLE = Condition(None, "Not available", '&#10068', IMAGE_HTML.format('NotAvailable'))
+
+# UV exposure advice for each UV index, UV_BANDS[index] (anything above 11 is 'Extreme')
+LOW_UV = "Low exposure. No protection required. You can safely stay outside"
+MODERATE_UV = "Moderate exposure. Seek shade during midday hours, cover up and wear sunscreen"
+HIGH_UV = "High exposure. Seek shade during midday hours, cover up and wear sunscreen"
+VERY_HIGH_UV = "Very high. Avoid being outside during midday hours. Shirt, sunscreen and hat are essential"
+EXTREME_UV = "Extreme. Avoid being outside during midday hours. Shirt, sunscreen and hat essential."
+
+UV_BANDS = (LOW_UV,) * 3 + (MODERATE_UV,) * 3 + (HIGH_UV,) * 2 + (VERY_HIGH_UV,) * 3 + (EXTREME_UV,)
+
+# HTML moon emoji for each moon phase
+MOON_EMOJI = {
+    "New Moon": "&#127761",
+    "Waxing Crescent": "&#127762",
+    "First Quarter": "&#127763",
+    "Waxing Gibbous": "&#127764",
+    "Full Moon": "&#127765",
+    "Waning Gibbous": "&#127766",
+    "Third Quarter": "&#127767",
+    "Waning Crescent": "&#127768"
+}
+
+# Day code -> night code, for providers that say whether it is night
+NIGHT_CODES = {1: 0, 3: 2, 10: 9, 14: 13, 17: 16, 20: 19, 23: 22, 26: 25, 29: 28}
+
+# OpenWeather descriptions (https://openweathermap.org/weather-conditions) -> daytime code
+OPENWEATHER_CODES = {
+    # Thunderstorm
+    "thunderstorm with light rain": 29,
+    "thunderstorm with rain": 29,
+    "thunderstorm with heavy rain": 29,
+    "light thunderstorm": 30,
+    "thunderstorm": 30,
+    "heavy thunderstorm": 30,
+    "ragged thunderstorm": 30,
+    "thunderstorm with light drizzle": 29,
+    "thunderstorm with drizzle": 29,
+    "thunderstorm with heavy drizzle": 29,
+    # Drizzle
+    "light intensity drizzle": 11,
+    "drizzle": 11,
+    "heavy intensity drizzle": 11,
+    "light intensity drizzle rain": 11,
+    "drizzle rain": 11,
+    "heavy intensity drizzle rain": 11,
+    "shower rain and drizzle": 10,
+    "heavy shower rain and drizzle": 14,
+    "shower drizzle": 10,
+    # Rain
+    "light rain": 12,
+    "moderate rain": 12,
+    "heavy intensity rain": 15,
+    "very heavy rain": 15,
+    "extreme rain": 15,
+    "freezing rain": 18,
+    "light intensity shower rain": 10,
+    "shower rain": 10,
+    "heavy intensity shower rain": 14,
+    "ragged shower rain": 14,
+    # Snow
+    "light snow": 24,
+    "snow": 24,
+    "heavy snow": 27,
+    "sleet": 18,
+    "light shower sleet": 17,
+    "shower sleet": 17,
+    "light rain and snow": 18,
+    "rain and snow": 18,
+    "light shower snow": 23,
+    "shower snow": 23,
+    "heavy shower snow": 26,
+    # Atmosphere
+    "mist": 5,
+    "smoke": 5,
+    "haze": 5,
+    "sand/dust whirls": 5,
+    "fog": 6,
+    "sand": 5,
+    "dust": 5,
+    "volcanic ash": 5,
+    # Clear and clouds
+    "clear sky": 1,
+    "few clouds": 3,
+    "scattered clouds": 3,
+    "broken clouds": 7,
+    "overcast clouds": 8
+}
+
+# Fallback for descriptions not in the list: first keyword found wins
+OPENWEATHER_KEYWORDS = (
+    ("thunder", 30),
+    ("hail", 21),
+    ("sleet", 18),
+    ("snow", 24),
+    ("drizzle", 11),
+    ("shower", 10),
+    ("rain", 12),
+    ("fog", 6),
+    ("mist", 5),
+    ("haze", 5),
+    ("overcast", 8),
+    ("cloud", 7),
+    ("clear", 1),
+    ("sun", 1)
+)
+
+
+def condition(code):
+
+    # Condition for a significant weather code (int, float or numeric string), NOT_AVAILABLE if missing or unknown
+    try:
+        code = float(code)
+    except (TypeError, ValueError):
+        return NOT_AVAILABLE
+
+    if math.isnan(code) or not 0 <= code < len(CONDITIONS):
+        return NOT_AVAILABLE
+
+    return CONDITIONS[int(code)]
+
+
+def uv_band(uv_index):
+
+    # Advice for a UV index (int), None if missing
+    if uv_index is None:
+        return None
+
+    return UV_BANDS[max(0, min(int(uv_index), len(UV_BANDS) - 1))]
+
+
+def normalise_openweather(description, night=False):
+
+    # Significant weather code for an OpenWeather description, e.g. 'broken clouds' -> 7, None if not recognised
+    description = ' '.join(str(description).lower().split())
+    code = OPENWEATHER_CODES.get(description)
+
+    if code is None:
+        code = next((keyword_code for keyword, keyword_code in OPENWEATHER_KEYWORDS if keyword in description), None)
+
+    if code is not None and night:
+        code = NIGHT_CODES.get(code, code)
+
+    return code
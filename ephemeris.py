@@ -0,0 +1,116 @@
+# Local astronomical calculations: moon phase / illumination and sunrise / sunset, worked out from the date and
+# coordinates instead of being scraped.
+#
+# Moon: low-precision lunar theory from Meeus, 'Astronomical Algorithms' (ch. 47-49), good to well under a degree of
+# elongation, which is far finer than the phase names need.
+# Sun: the standard sunrise equation (as used by NOAA), good to about a minute outside the polar regions.
+from datetime import datetime, timedelta, timezone
+import math
+
+# Julian date of the J2000.0 epoch (2000-01-01 12:00 UTC)
+J2000 = 2451545.0
+
+# Sun altitude at sunrise / sunset in degrees (refraction plus the sun's radius)
+SUNRISE_ALTITUDE = -0.833
+
+# Degrees of elongation either side of 0/90/180/270 that count as the named phase day (the moon moves ~12.2°/day)
+PRINCIPAL_PHASE_WINDOW = 6.1
+
+MOON_PHASES = (
+    (0, "New Moon"),
+    (90, "First Quarter"),
+    (180, "Full Moon"),
+    (270, "Third Quarter")
+)
+
+
+def julian_date(moment):
+
+    # 'moment' is a timezone aware datetime
+    return J2000 + (moment - datetime(2000, 1, 1, 12, tzinfo=timezone.utc)).total_seconds() / 86400
+
+
+def from_julian_date(julian):
+
+    return datetime(2000, 1, 1, 12, tzinfo=timezone.utc) + timedelta(days=julian - J2000)
+
+
+def moon_elongation(moment):
+
+    # Sun-moon phase angle measured from new moon: 0 = new, 90 = first quarter, 180 = full, 270 = third quarter
+    t = (julian_date(moment) - J2000) / 36525
+
+    # Mean elongation of the moon, mean anomaly of the sun and mean anomaly of the moon (degrees)
+    d = math.radians((297.8501921 + 445267.1114034 * t - 0.0018819 * t ** 2) % 360)
+    m = math.radians((357.5291092 + 35999.0502909 * t - 0.0001536 * t ** 2) % 360)
+    m_moon = math.radians((134.9633964 + 477198.8675055 * t + 0.0087414 * t ** 2) % 360)
+
+    # Phase angle (Meeus 48.4), where 180 is new moon and 0 is full moon
+    phase_angle = (180 - math.degrees(d)
+                   - 6.289 * math.sin(m_moon)
+                   + 2.100 * math.sin(m)
+                   - 1.274 * math.sin(2 * d - m_moon)
+                   - 0.658 * math.sin(2 * d)
+                   - 0.214 * math.sin(2 * m_moon)
+                   - 0.110 * math.sin(d))
+
+    return (180 - phase_angle) % 360
+
+
+def moon_phase(moment=None):
+
+    # Returns (phase name, percentage of the disc illuminated), with the same phase names as TimeandDate.com
+    if moment is None:
+        moment = datetime.now(timezone.utc)
+
+    elongation = moon_elongation(moment)
+    illumination = (1 - math.cos(math.radians(elongation))) / 2 * 100
+
+    for angle, name in MOON_PHASES:
+        if abs((elongation - angle + 180) % 360 - 180) <= PRINCIPAL_PHASE_WINDOW:
+            return name, illumination
+
+    if elongation < 90:
+        name = "Waxing Crescent"
+    elif elongation < 180:
+        name = "Waxing Gibbous"
+    elif elongation < 270:
+        name = "Waning Gibbous"
+    else:
+        name = "Waning Crescent"
+
+    return name, illumination
+
+
+def sun_times(day, latitude, longitude):
+
+    # Sunrise and sunset (UTC datetimes) for a calendar date, longitude positive east.
+    # Either can be None when the sun doesn't rise or set that day (polar day / night).
+    latitude = math.radians(float(latitude))
+    longitude = float(longitude)
+
+    # Days since J2000 at noon on 'day', then mean solar noon at this longitude
+    n = day.toordinal() - 730120
+    mean_noon = n - longitude / 360
+
+    # Solar mean anomaly, equation of the centre and ecliptic longitude
+    mean_anomaly = math.radians((357.5291 + 0.98560028 * mean_noon) % 360)
+    centre = (1.9148 * math.sin(mean_anomaly)
+              + 0.0200 * math.sin(2 * mean_anomaly)
+              + 0.0003 * math.sin(3 * mean_anomaly))
+    ecliptic_longitude = math.radians((math.degrees(mean_anomaly) + centre + 180 + 102.9372) % 360)
+
+    # Solar transit (local noon) as a Julian date
+    transit = J2000 + mean_noon + 0.0053 * math.sin(mean_anomaly) - 0.0069 * math.sin(2 * ecliptic_longitude)
+
+    # Declination of the sun and hour angle of sunrise / sunset
+    declination = math.asin(math.sin(ecliptic_longitude) * math.sin(math.radians(23.4397)))
+    cos_hour_angle = ((math.sin(math.radians(SUNRISE_ALTITUDE)) - math.sin(latitude) * math.sin(declination))
+                      / (math.cos(latitude) * math.cos(declination)))
+
+    if cos_hour_angle < -1 or cos_hour_angle > 1:
+        return None, None
+
+    hour_angle = math.degrees(math.acos(cos_hour_angle))
+
+    return from_julian_date(transit - hour_angle / 360), from_julian_date(transit + hour_angle / 360)
@@ -0,0 +1,120 @@
+# Fan-out engine: runs the provider fetches for a request at the same time on a bounded worker pool,
+# so page latency is roughly the slowest single provider instead of the sum of all of them
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import time
+
+import metrics  # Module for latency histograms and counters
+
+# Maximum number of provider fetches running at once (shared by every request in the process)
+MAX_WORKERS = 16
+
+# Seconds to wait for any single provider
+PROVIDER_TIMEOUT = 10
+
+# Seconds to wait for the whole fan-out
+OVERALL_DEADLINE = 15
+
+# Shared worker pool
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='provider')
+
+
+def fan_out(calls, provider_timeouts=None, deadline=OVERALL_DEADLINE):
+
+    # 'calls' maps a provider name to a (function, args) tuple, e.g. {'OpenWeather': (OpenWeather, (lat, lon))}
+    # 'provider_timeouts' optionally maps a provider name to its own timeout in seconds
+    results = {}
+    errors = {}
+
+    for name, result, error in as_completed(calls, provider_timeouts, deadline):
+        if error is None:
+            results[name] = result
+        else:
+            errors[name] = error
+
+    return results, errors
+
+
+def as_completed(calls, provider_timeouts=None, deadline=OVERALL_DEADLINE):
+
+    # As 'fan_out', but yields (name, result, error) for each provider as soon as it answers, fails or times out
+    # (used to stream the results page)
+    if provider_timeouts is None:
+        provider_timeouts = {}
+
+    start = time.monotonic()
+    end = start + deadline
+
+    # When each call started running (a call can wait in the shared pool's queue before it starts, and its own
+    # timeout only counts from then - the overall deadline counts from now)
+    started = {}
+
+    # Submit every call to the pool
+    futures = {}
+    for name, (function, args) in calls.items():
+        future = executor.submit(started_call, started, name, function, args)
+        futures[future] = name
+
+    def timeout(future):
+        return provider_timeouts.get(futures[future], PROVIDER_TIMEOUT)
+
+    def expiry(future):
+        name = futures[future]
+        return min(started[name] + timeout(future), end) if name in started else end
+
+    pending = set(futures)
+
+    try:
+        while pending:
+
+            # Wait until the next provider completes or the earliest remaining expiry is reached. A call still
+            # queued can't expire sooner than its own timeout from now, so check back by then
+            now = time.monotonic()
+            wake = min(expiry(future) for future in pending)
+            queued = [timeout(future) for future in pending if futures[future] not in started]
+            if queued:
+                wake = min(wake, now + min(queued))
+
+            if wake > now:
+                done, pending = wait(pending, timeout=wake - now, return_when=FIRST_COMPLETED)
+            else:
+                done = set()
+
+            # Pass on results (an exception raised by a provider is passed on rather than re-raised)
+            for future in done:
+                name = futures[future]
+                try:
+                    result, error = future.result(), None
+                except Exception as exception:
+                    result, error = None, exception
+
+                yield name, result, error
+
+            # Give up on any provider that has run out of time
+            now = time.monotonic()
+            for future in [future for future in pending if expiry(future) <= now]:
+                pending.discard(future)
+                future.cancel()
+                name = futures[future]
+                metrics.increment('weather_provider_timeouts_total', provider=name)
+                waited = round(expiry(future) - started.get(name, start), 1)
+                yield name, None, TimeoutError(f"{name} did not respond within {waited} seconds.")
+
+    finally:
+        # The caller stopped early (e.g. the browser went away), don't start anything still queued
+        for future in pending:
+            future.cancel()
+
+
+def started_call(started, name, function, args):
+
+    # Note when the call starts running, then run it
+    started[name] = time.monotonic()
+
+    return timed_call(name, function, args)
+
+
+def timed_call(name, function, args):
+
+    # Provider time as seen by the request, including cache hits
+    with metrics.timer('provider', provider=name):
+        return function(*args)
@@ -0,0 +1,174 @@
+# Forecast cache: sits in front of each provider function and keys results on (provider, location, time bucket).
+# Each provider has its own TTL. Once an entry is older than the TTL it is still served (until its time bucket ends)
+# while a background refresh fetches a new copy, so repeat lookups never wait on an upstream.
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+import threading
+import time
+
+import cache  # Module containing a TTL/LRU cache
+import circuit_breaker  # Module for skipping providers while they are unhealthy
+import hedging  # Module for hedging slow upstream calls with a second request
+import metrics  # Module for latency histograms and counters
+import quota  # Module for per-provider upstream request quotas
+import records  # Module containing the typed provider reading / weather report records
+import single_flight  # Module for sharing one upstream call between identical concurrent lookups
+
+logger = logging.getLogger('weather')
+
+# Maximum number of cached provider results across all providers
+FORECAST_CACHE_SIZE = 10000
+
+# Shared store: key -> (fetched at timestamp, provider data). Hard expiry is the end of the entry's time bucket.
+# Provider data is a records.Reading (held packed, see records.pack), a dict (callers get a copy) or a read-only
+# object such as a timeseries.HourlySeries
+forecast_store = cache.TTLCache(maxsize=FORECAST_CACHE_SIZE)
+
+# Background refreshes run here, away from the interactive fan-out pool
+refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='forecast-refresh')
+
+
+class CachedProvider:
+
+    def __init__(self, function, ttl, bucket_seconds):
+
+        self.function = function
+        self.name = function.__name__
+        self.ttl = ttl
+        self.bucket_seconds = bucket_seconds
+
+        # Keys currently being refreshed in the background
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+        functools.update_wrapper(self, function)
+
+    def cache_key(self, args, now):
+
+        # Location arguments are normalised to strings so e.g. 2643743 and '2643743' share an entry
+        return (self.name,) + tuple(str(arg) for arg in args) + (int(now // self.bucket_seconds),)
+
+    def __call__(self, *args):
+
+        # The time bucket is worked out once, so a fetch that ends after the bucket does still fills the entry looked up
+        key = self.cache_key(args, time.time())
+        data = self.lookup(*args, key=key)
+
+        # Miss - fetch now
+        if data is None:
+            return self.refresh(*args, key=key)
+
+        return data
+
+    def lookup(self, *args, key=None):
+
+        # Cached data for these arguments (in the current time bucket unless 'key' is given), or None on a miss
+        now = time.time()
+        if key is None:
+            key = self.cache_key(args, now)
+        entry = forecast_store.get(key)
+
+        if entry is None:
+            metrics.increment('weather_cache_requests_total', cache=self.name, result='miss')
+            return None
+
+        fetched_at, data = entry
+
+        # Stale - serve what we have and refresh in the background
+        if now - fetched_at >= self.ttl:
+            metrics.increment('weather_cache_requests_total', cache=self.name, result='stale')
+            self.refresh_in_background(key, args)
+        else:
+            metrics.increment('weather_cache_requests_total', cache=self.name, result='hit')
+
+        return copy(data)
+
+    def fresh(self, *args):
+
+        # Whether there's an entry for these arguments younger than the TTL (no need to fetch it again yet)
+        now = time.time()
+        entry = forecast_store.get(self.cache_key(args, now))
+
+        return entry is not None and now - entry[0] < self.ttl
+
+    def refresh(self, *args, key=None):
+
+        # Concurrent refreshes of the same entry (cache misses and background refreshes alike) share one upstream call
+        if key is None:
+            key = self.cache_key(args, time.time())
+
+        return copy(single_flight.group.do(key, functools.partial(self.fetch, key=key), *args))
+
+    def fetch(self, *args, key=None):
+
+        # Upstream calls wait for the provider's quota, then go through its circuit breaker (cache hits do neither).
+        # The quota comes first so time spent queueing isn't counted against the provider's health
+        quota.acquire(self.name)
+
+        with metrics.timer('upstream', provider=self.name):
+            data = circuit_breaker.get(self.name).call(hedging.call, self.name, self.function, *args)
+
+        return self.store(args, data, key)
+
+    def store(self, args, data, key=None):
+
+        # Only cache real results (a provider that returns None has nothing to cache). They're stored under 'key' (the
+        # entry that was looked up), or under the current time bucket if that has ended since
+        if data is not None:
+            now = time.time()
+            if key is None or (key[-1] + 1) * self.bucket_seconds <= now:
+                key = self.cache_key(args, now)
+            bucket_end = (key[-1] + 1) * self.bucket_seconds
+            forecast_store.set(key, (now, pack(data)), ttl=bucket_end - now)
+            data = copy(data)
+
+        return data
+
+    def refresh_in_background(self, key, args):
+
+        # Only one background refresh per key at a time
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                # Nobody is waiting on a background refresh, so it gives way to interactive calls for quota
+                with quota.background():
+                    self.refresh(*args, key=key)
+            except Exception as error:
+                # Keep serving the stale copy, the next stale hit will try again
+                logger.warning('background_refresh_failed provider=%s error="%s"', self.name, error)
+                metrics.increment('weather_background_refresh_failures_total', provider=self.name,
+                                  error=type(error).__name__)
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        refresh_executor.submit(run)
+
+
+def cached(ttl, bucket_seconds=3600):
+
+    # Decorator for provider functions, e.g. @forecast_cache.cached(ttl=600)
+    def decorator(function):
+        return CachedProvider(function, ttl, bucket_seconds)
+
+    return decorator
+
+
+def pack(data):
+
+    # Records are cached in their binary form, a fraction of the size of the objects
+    return records.pack(data) if isinstance(data, records.RECORD_TYPES) else data
+
+
+def copy(data):
+
+    # Unpack cached records, and hand out copies of dicts so callers can't change what's cached
+    if isinstance(data, bytes):
+        return records.unpack(data)
+
+    return dict(data) if isinstance(data, dict) else data
@@ -0,0 +1,365 @@
+# Offline gazetteer: town lookups from a local copy of a GeoNames cities dump, so most searches never reach the
+# GeoNames API. geo_coder only calls the API when the index has no match.
+#
+# Build the index once from a dump (https://download.geonames.org/export/dump/, e.g. cities15000.zip, unzipped):
+#   python gazetteer.py build cities15000.txt gazetteer.idx
+# and set 'GazetteerFile' in '.env' if it isn't 'gazetteer.idx' in the working directory.
+#
+# The index is a single file, memory-mapped and used in place (numpy arrays over the mapping, nothing is loaded up
+# front), with three tables:
+#   places    one fixed-size row per place (GeoNames ID, coordinates, country, population, name, time zone)
+#   names     every normalised name of every place (name, ASCII name and alternate names), sorted, so exact
+#             and prefix (type-ahead) searches are a binary search
+#   trigrams  for each trigram of the main names, the names containing it, for fuzzy (misspelt) searches, which
+#             are then ranked by edit distance
+import argparse
+import bisect
+import mmap
+import struct
+import unicodedata
+import zlib
+
+import numpy as np
+
+MAGIC = b'GAZ1'
+
+# Magic, then the number of places, names, trigrams and postings and the size of the text section in bytes
+HEADER = struct.Struct('<4sIIIII')
+
+PLACE = np.dtype([('location_id', '<u4'), ('latitude', '<f8'), ('longitude', '<f8'), ('population', '<u4'),
+                  ('country_code', 'S2'), ('name_offset', '<u4'), ('name_length', '<u2'), ('timezone', '<u2')])
+NAME = np.dtype([('offset', '<u4'), ('length', '<u1'), ('place', '<u4')])
+NAME_ROW = struct.Struct('<IBI')
+TRIGRAM = np.dtype([('trigram', '<u4'), ('start', '<u4'), ('count', '<u4')])
+POSTING = np.dtype('<u4')
+
+# Longest name indexed, in bytes
+MAX_NAME_LENGTH = 255
+
+# Fuzzy matches may be this many edits away (1 for short names, 2 from FUZZY_LONG_NAME characters), and at most
+# FUZZY_CANDIDATES names sharing the most trigrams with the search are compared
+FUZZY_LONG_NAME = 8
+FUZZY_CANDIDATES = 50
+
+# Type-ahead suggestions per request, and the shortest prefix suggestions are given for
+SUGGESTIONS = 10
+MIN_PREFIX_LENGTH = 2
+
+# GeoNames dump columns
+DUMP_COLUMNS = {'geonameid': 0, 'name': 1, 'asciiname': 2, 'alternatenames': 3, 'latitude': 4, 'longitude': 5,
+                'country_code': 8, 'population': 14, 'timezone': 17}
+
+
+def normalise(name):
+
+    # 'Saint-Étienne' -> 'saint etienne': no accents, lower case, anything but letters and digits becomes a space
+    name = ''.join(character for character in unicodedata.normalize('NFKD', name)
+                   if not unicodedata.combining(character))
+
+    return ' '.join(''.join(character if character.isalnum() else ' ' for character in name.lower()).split())
+
+
+def trigrams(key):
+
+    # Trigram hashes of a normalised name, padded so the start and end count e.g. '  lo', ' lon', ..., 'on '
+    padded = f'  {key} '
+
+    return {zlib.crc32(padded[position:position + 3].encode()) for position in range(len(padded) - 2)}
+
+
+def edit_distance(first, second, limit):
+
+    # Edits (insert, delete, substitute or swap two neighbouring letters) to turn one name into the other, or
+    # limit + 1 once it's certain to be over the limit
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+
+    before_previous = None
+    previous = list(range(len(second) + 1))
+    for row, first_character in enumerate(first, 1):
+        current = [row]
+        for column, second_character in enumerate(second, 1):
+            distance = min(previous[column] + 1, current[column - 1] + 1,
+                           previous[column - 1] + (first_character != second_character))
+            if (row > 1 and column > 1 and first_character == second[column - 2]
+                    and first[row - 2] == second_character):
+                distance = min(distance, before_previous[column - 2] + 1)
+            current.append(distance)
+        if min(current) > limit:
+            return limit + 1
+        before_previous, previous = previous, current
+
+    return previous[-1]
+
+
+def build(dump_path, index_path, alternate_names=True):
+
+    # Read the dump: one place per line, tab separated
+    places = []
+    timezones = {}
+    text = bytearray()
+    names = []  # (key, -population, place index)
+    fuzzy_names = set()  # keys of main names (not alternate names), for the trigram table
+
+    with open(dump_path, encoding='utf-8') as dump:
+        for line in dump:
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) <= DUMP_COLUMNS['timezone']:
+                continue
+
+            place_index = len(places)
+            name = columns[DUMP_COLUMNS['name']]
+            population = int(columns[DUMP_COLUMNS['population']] or 0)
+            encoded_name = name.encode('utf-8')[:MAX_NAME_LENGTH].decode('utf-8', 'ignore').encode('utf-8')
+
+            places.append((
+                int(columns[DUMP_COLUMNS['geonameid']]),
+                float(columns[DUMP_COLUMNS['latitude']]),
+                float(columns[DUMP_COLUMNS['longitude']]),
+                min(population, 2 ** 32 - 1),
+                columns[DUMP_COLUMNS['country_code']].encode('ascii'),
+                len(text),
+                len(encoded_name),
+                timezones.setdefault(columns[DUMP_COLUMNS['timezone']], len(timezones))
+            ))
+            text += encoded_name
+
+            main_names = {normalise(name), normalise(columns[DUMP_COLUMNS['asciiname']])}
+            other_names = {normalise(alternate) for alternate in columns[DUMP_COLUMNS['alternatenames']].split(',')
+                           if alternate_names and alternate}
+
+            for key in main_names | other_names:
+                if key and len(key.encode('utf-8')) <= MAX_NAME_LENGTH:
+                    names.append((key, -population, place_index))
+            fuzzy_names.update(key for key in main_names if key)
+
+    # Names sorted by key, most populous place first. Each distinct key is stored once in the text section
+    names.sort()
+    key_offsets = {}
+    name_rows = []
+    for key, _, place_index in names:
+        if key not in key_offsets:
+            key_offsets[key] = len(text)
+            text += key.encode('utf-8')
+        name_rows.append((key_offsets[key], len(key.encode('utf-8')), place_index))
+
+    # Trigram -> positions in the name table of the main names containing it
+    postings_by_trigram = {}
+    for position, (key, _, _) in enumerate(names):
+        if key in fuzzy_names:
+            for trigram in trigrams(key):
+                postings_by_trigram.setdefault(trigram, []).append(position)
+
+    trigram_rows = []
+    postings = []
+    for trigram in sorted(postings_by_trigram):
+        trigram_rows.append((trigram, len(postings), len(postings_by_trigram[trigram])))
+        postings += postings_by_trigram[trigram]
+
+    # Time zone names go at the end of the text section, one per line
+    timezone_text = '\n'.join(sorted(timezones, key=timezones.get)).encode('utf-8')
+
+    sections = [
+        np.array(places, dtype=PLACE).tobytes(),
+        np.array(name_rows, dtype=NAME).tobytes(),
+        np.array(trigram_rows, dtype=TRIGRAM).tobytes(),
+        np.array(postings, dtype=POSTING).tobytes(),
+        bytes(text),
+        timezone_text
+    ]
+
+    with open(index_path, 'wb') as index:
+        index.write(HEADER.pack(MAGIC, len(places), len(name_rows), len(trigram_rows), len(postings), len(text)))
+        for section in sections:
+            index.write(section)
+
+    return len(places), len(name_rows)
+
+
+class Gazetteer:
+
+    def __init__(self, path):
+
+        with open(path, 'rb') as index:
+            self.map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, place_count, name_count, trigram_count, posting_count, text_size = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise Exception(f"{path} is not a gazetteer index (build one with 'python gazetteer.py build')")
+
+        # Tables are views of the mapping
+        offset = HEADER.size
+        tables = []
+        for dtype, count in [(PLACE, place_count), (NAME, name_count), (TRIGRAM, trigram_count), (POSTING, posting_count)]:
+            tables.append(np.frombuffer(self.map, dtype=dtype, count=count, offset=offset))
+            offset += dtype.itemsize * count
+
+        self.places, self.names, self.trigrams, self.postings = tables
+        self.names_start = HEADER.size + PLACE.itemsize * place_count
+        self.text_start = offset
+        self.timezones = self.map[offset + text_size:].decode('utf-8').split('\n')
+
+        # Sorted view of the names for bisect, keys are only decoded as the search touches them
+        self.keys = NameKeys(self)
+
+    def key(self, position):
+
+        # Read straight from the mapping (much quicker than going through numpy for one row)
+        offset, length, _ = NAME_ROW.unpack_from(self.map, self.names_start + position * NAME.itemsize)
+        start = self.text_start + offset
+
+        return self.map[start:start + length].decode('utf-8')
+
+    def place(self, place_index):
+
+        # Same fields as a GeoNames API result in app.geo_coder_result
+        place = self.places[place_index]
+        start = self.text_start + int(place['name_offset'])
+
+        return {
+            'name': self.map[start:start + int(place['name_length'])].decode('utf-8'),
+            'country_code': place['country_code'].decode('ascii'),
+            'latitude': str(float(place['latitude'])),
+            'longitude': str(float(place['longitude'])),
+            'location_id': int(place['location_id']),
+            'timezone': self.timezones[place['timezone']] or None
+        }
+
+    def key_range(self, key, prefix=False):
+
+        # [start, end) positions in the name table of names equal to 'key' (or starting with it)
+        start = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_left(self.keys, key + '\U0010ffff') if prefix else bisect.bisect_right(self.keys, key)
+
+        return start, end
+
+    def in_country(self, positions, country_code):
+
+        # Which positions in the name table have a place in the country (all of them if no country is given)
+        if not country_code:
+            return np.ones(len(positions), dtype=bool)
+
+        places = self.names['place'][positions]
+
+        return self.places['country_code'][places] == country_code.upper().encode('ascii', 'replace')
+
+    def search(self, town, country_code):
+
+        # Best place called 'town' in the country (the most populous exact match, or else the closest spelling),
+        # None if nothing is close enough
+        key = normalise(town)
+        if not key:
+            return None
+
+        positions = np.arange(*self.key_range(key))
+        matches = positions[self.in_country(positions, country_code)]
+
+        # Names are sorted most populous place first
+        if len(matches):
+            return self.place(self.names['place'][matches[0]])
+
+        position = self.fuzzy(key, country_code)
+
+        return None if position is None else self.place(self.names['place'][position])
+
+    def fuzzy(self, key, country_code):
+
+        # Name table position of the closest main name within the edit limit
+        limit = 1 if len(key) < FUZZY_LONG_NAME else 2
+        key_trigrams = sorted(trigrams(key))
+
+        if not len(self.trigrams):
+            return None
+
+        rows = self.trigrams[np.searchsorted(self.trigrams['trigram'], key_trigrams).clip(0, len(self.trigrams) - 1)]
+        lists = [self.postings[row['start']:row['start'] + row['count']]
+                 for row, trigram in zip(rows, key_trigrams) if row['trigram'] == trigram]
+        if not lists:
+            return None
+
+        # Each edit changes at most 4 trigrams (3, or 4 for a swap)
+        candidates, shared = np.unique(np.concatenate(lists), return_counts=True)
+        keep = (shared >= len(key_trigrams) - 4 * limit) & self.in_country(candidates, country_code)
+        candidates, shared = candidates[keep], shared[keep]
+
+        # Names sharing the most trigrams first
+        candidates = candidates[np.argsort(-shared, kind='stable')[:FUZZY_CANDIDATES]]
+
+        best = None
+        for position in candidates:
+            distance = edit_distance(key, self.key(position), limit)
+            if distance > limit:
+                continue
+
+            population = int(self.places['population'][self.names['place'][position]])
+            if best is None or (distance, -population) < best[:2]:
+                best = (distance, -population, int(position))
+
+        return None if best is None else best[2]
+
+    def suggest(self, prefix, country_code=None, limit=SUGGESTIONS):
+
+        # Places with a name starting with 'prefix', most populous first, for type-ahead
+        key = normalise(prefix)
+        if len(key) < MIN_PREFIX_LENGTH:
+            return []
+
+        positions = np.arange(*self.key_range(key, prefix=True))
+        positions = positions[self.in_country(positions, country_code)]
+
+        places = self.names['place'][positions]
+        places = places[np.argsort(-self.places['population'][places].astype(np.int64), kind='stable')]
+
+        suggestions = []
+        seen = set()
+        for place_index in places:
+            if place_index in seen:
+                continue
+            seen.add(place_index)
+            place = self.place(place_index)
+            suggestions.append({key: place[key] for key in ('name', 'country_code', 'location_id')})
+            if len(suggestions) == limit:
+                break
+
+        return suggestions
+
+
+class NameKeys:
+
+    # Sequence of the name table's keys, for bisect
+    def __init__(self, gazetteer):
+        self.gazetteer = gazetteer
+
+    def __len__(self):
+        return len(self.gazetteer.names)
+
+    def __getitem__(self, position):
+        return self.gazetteer.key(position)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Build or search an offline gazetteer index')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = commands.add_parser('build')
+    build_parser.add_argument('dump', help='GeoNames dump e.g. cities15000.txt')
+    build_parser.add_argument('index', nargs='?', default='gazetteer.idx')
+    build_parser.add_argument('--no-alternate-names', action='store_true')
+
+    search_parser = commands.add_parser('search')
+    search_parser.add_argument('town')
+    search_parser.add_argument('country_code')
+    search_parser.add_argument('--index', default='gazetteer.idx')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        place_count, name_count = build(args.dump, args.index, alternate_names=not args.no_alternate_names)
+        print(f'{place_count} places, {name_count} names written to {args.index}')
+    else:
+        print(Gazetteer(args.index).search(args.town, args.country_code))
+
+
+if __name__ == '__main__':
+    main()
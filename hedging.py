@@ -0,0 +1,219 @@
+# Hedged requests: when a provider call is taking longer than that provider usually does (its recent p95 latency),
+# a second identical call is started and whichever answers first is used. This cuts the occasional multi-second
+# stall (a slow page load from one server) out of the results page's tail latency.
+#
+# Each provider keeps a window of recent call latencies to work out its hedge delay, and a budget: every interactive
+# call earns HEDGE_BUDGET of a hedge, so hedges add at most that fraction of extra load. Hedges also need a quota token
+# they can have without waiting (see 'quota'). Background refreshes are never hedged - nobody is waiting on them - and
+# run in their own thread as a plain call. On the ASGI server the losing call is cancelled; threads can't be cancelled, so on the Flask server the
+# loser runs to the end and its result is dropped.
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import asyncio
+import math
+import threading
+import time
+
+import metrics  # Module for latency histograms and counters
+import quota  # Module for per-provider upstream request quotas
+
+# Providers that are hedged (the Met Office's daily budget is too small to spend on duplicate calls)
+HEDGED_PROVIDERS = ('OpenWeather', 'BBCWeather', 'YrNo')
+
+# Recent latencies kept per provider, and how many are needed before hedging starts
+WINDOW_SIZE = 200
+MIN_SAMPLES = 20
+
+# Percentile of recent latencies to hedge at, and the shortest hedge delay in seconds
+HEDGE_PERCENTILE = 95
+MIN_DELAY = 0.05
+
+# Hedges earned per call (extra load is at most this fraction), and the most that can be saved up
+HEDGE_BUDGET = 0.05
+MAX_CREDIT = 5
+
+# Hedged providers (cleared to turn hedging off)
+hedged = set(HEDGED_PROVIDERS)
+
+# Threads for the calls of a hedged pair (the caller waits for whichever finishes first)
+hedge_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix='hedge')
+
+
+class Hedger:
+
+    def __init__(self, name, window_size=WINDOW_SIZE, min_samples=MIN_SAMPLES, percentile=HEDGE_PERCENTILE,
+                 budget=HEDGE_BUDGET, max_credit=MAX_CREDIT):
+
+        self.name = name
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.budget = budget
+        self.max_credit = max_credit
+
+        # Latencies of recent successful calls, in seconds
+        self.latencies = deque(maxlen=window_size)
+        self.credit = 0.0
+
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+
+        with self.lock:
+            self.latencies.append(latency)
+
+    def delay(self):
+
+        # Seconds to wait before hedging a call, or None if it shouldn't be hedged. Every call earns some budget
+        with self.lock:
+            self.credit = min(self.max_credit, self.credit + self.budget)
+
+            if self.name not in hedged or len(self.latencies) < self.min_samples:
+                return None
+
+            latencies = list(self.latencies)
+
+        return threshold(latencies, self.percentile)
+
+    def spend(self):
+
+        # Whether a hedge can be made now: there's budget left and a quota token is free
+        with self.lock:
+            if self.credit < 1:
+                metrics.increment('weather_hedged_calls_total', provider=self.name, outcome='no_budget')
+                return False
+
+        if not quota.try_acquire(self.name):
+            metrics.increment('weather_hedged_calls_total', provider=self.name, outcome='no_quota')
+            return False
+
+        with self.lock:
+            self.credit -= 1
+
+        metrics.increment('weather_hedged_calls_total', provider=self.name, outcome='hedged')
+
+        return True
+
+    def stats(self):
+
+        with self.lock:
+            latencies = list(self.latencies)
+
+        return {
+            'samples': len(latencies),
+            'threshold': threshold(latencies, self.percentile) if len(latencies) >= self.min_samples else None
+        }
+
+
+def threshold(latencies, percentile):
+
+    # Hedge delay: the given percentile of the latencies (nearest rank), but at least MIN_DELAY
+    rank = math.ceil(len(latencies) * percentile / 100) - 1
+
+    return max(MIN_DELAY, sorted(latencies)[rank])
+
+
+def timed(hedger, function, args):
+
+    start = time.monotonic()
+    result = function(*args)
+    hedger.record(time.monotonic() - start)
+
+    return result
+
+
+def call(name, function, *args):
+
+    # function(*args), hedged if it's slow. Background calls (nobody is waiting on them) are never hedged, so they
+    # run straight in the caller's thread rather than taking a hedge thread
+    hedger = get(name)
+    if quota.priority.get() != quota.INTERACTIVE:
+        return timed(hedger, function, args)
+
+    delay = hedger.delay()
+
+    if delay is None:
+        return timed(hedger, function, args)
+
+    first = hedge_executor.submit(timed, hedger, function, args)
+    if wait([first], timeout=delay).done or not hedger.spend():
+        return first.result()
+
+    second = hedge_executor.submit(timed, hedger, function, args)
+
+    # First successful answer wins; if both fail, the first call's error is raised
+    pending = {first, second}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for loser in pending:
+                    loser.cancel()
+                if future is second:
+                    metrics.increment('weather_hedged_calls_total', provider=name, outcome='won')
+                return future.result()
+
+    return first.result()
+
+
+async def timed_async(hedger, function, args):
+
+    start = time.monotonic()
+    result = await function(*args)
+    hedger.record(time.monotonic() - start)
+
+    return result
+
+
+async def call_async(name, function, *args):
+
+    # As 'call', for the ASGI server's coroutines (the loser is cancelled)
+    hedger = get(name)
+    if quota.priority.get() != quota.INTERACTIVE:
+        return await timed_async(hedger, function, args)
+
+    delay = hedger.delay()
+
+    if delay is None:
+        return await timed_async(hedger, function, args)
+
+    first = asyncio.ensure_future(timed_async(hedger, function, args))
+    tasks = {first}
+
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or not hedger.spend():
+            return await first
+
+        second = asyncio.ensure_future(timed_async(hedger, function, args))
+        tasks.add(second)
+
+        # First successful answer wins; if both fail, the first call's error is raised
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        metrics.increment('weather_hedged_calls_total', provider=name, outcome='won')
+                    return task.result()
+
+        return first.result()
+
+    finally:
+        # Cancel the loser (or both calls, if the caller itself was cancelled)
+        for task in tasks:
+            task.cancel()
+
+
+# One hedger per provider, created on first use
+hedgers = {}
+hedgers_lock = threading.Lock()
+
+
+def get(name):
+
+    with hedgers_lock:
+        if name not in hedgers:
+            hedgers[name] = Hedger(name)
+
+        return hedgers[name]
@@ -0,0 +1,192 @@
+# History store: every lookup's provider readings, kept per location at hourly resolution in an append-only SQLite
+# table, for trends and provider-accuracy analysis without calling any upstream.
+#
+# Lookups only put their readings on a queue. A background writer thread takes them off in batches and writes each
+# batch in one transaction, so recording never adds latency to a request (if the queue is full, readings are dropped
+# and counted rather than waited on). Rows are clustered on (location, hour, provider), so a location's history
+# reads back as one range scan, in the same (hours, providers, variables) array layout 'aggregation' works on.
+import atexit
+import math
+import queue
+import sqlite3
+import threading
+import warnings
+
+import numpy as np
+
+import aggregation  # Module for averaging provider readings
+import metrics  # Module for latency histograms and counters
+
+# Lookups waiting to be written; beyond this their readings are dropped
+QUEUE_SIZE = 10000
+
+# Rows per transaction, and how long the writer waits for a batch to fill
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+
+# Longest the process waits at exit for the writer to finish what's queued, in seconds
+STOP_TIMEOUT = 10
+
+# Queued after the last lookup to tell the writer to finish
+STOP = None
+
+# One row per location, hour (hours since 1970 UTC) and provider. The first reading of the hour is kept
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS readings (
+    location_id INTEGER NOT NULL,
+    hour INTEGER NOT NULL,
+    provider INTEGER NOT NULL,
+    {', '.join(f'{variable} REAL' for variable in aggregation.VARIABLES)},
+    PRIMARY KEY (location_id, hour, provider)
+) WITHOUT ROWID
+"""
+
+INSERT = (f"INSERT OR IGNORE INTO readings (location_id, hour, provider, {', '.join(aggregation.VARIABLES)}) "
+          f"VALUES ({', '.join('?' * (len(aggregation.VARIABLES) + 3))})")
+
+SELECT = (f"SELECT hour, provider, {', '.join(aggregation.VARIABLES)} FROM readings "
+          f"WHERE location_id = ? AND hour >= ? AND hour < ? ORDER BY hour")
+
+
+def connect(path):
+
+    connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+
+    # Readers don't block the writer (or each other)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute(SCHEMA)
+
+    return connection
+
+
+class HistoryStore:
+
+    def __init__(self, path, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.thread = None
+
+        # Create the table up front so queries work before anything is recorded
+        connect(path).close()
+
+    def record(self, location_id, hour, readings):
+
+        # 'readings' is one location's (providers, variables) array from aggregation.collect
+        # NaN (provider didn't answer or doesn't supply the variable) is stored as NULL
+        rows = []
+        for provider_index, values in enumerate(readings.tolist()):
+            values = tuple(None if math.isnan(value) else value for value in values)
+
+            # Providers that didn't answer
+            if values.count(None) < len(values):
+                rows.append((int(location_id), int(hour), provider_index) + values)
+
+        # One queue entry per lookup
+        try:
+            self.pending.put_nowait(rows)
+        except queue.Full:
+            metrics.increment('weather_history_rows_total', len(rows), result='dropped')
+
+        # Writer starts with the first lookup
+        self.start()
+
+    def start(self):
+
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.thread = threading.Thread(target=self.run, name='history-writer', daemon=True)
+
+        self.thread.start()
+
+        # The writer is a daemon thread, so write whatever is still queued before the process exits
+        atexit.register(self.stop)
+
+    def run(self):
+
+        connection = connect(self.path)
+
+        stopping = False
+        while not stopping:
+
+            # Wait for the first lookup, then give the batch a moment to fill (up to a stop)
+            entries = [self.pending.get()]
+            batch = list(entries[0] or [])
+            try:
+                while entries[-1] is not STOP and len(batch) < self.batch_size:
+                    entries.append(self.pending.get(timeout=self.flush_interval))
+                    batch += entries[-1] or []
+            except queue.Empty:
+                pass
+
+            stopping = entries[-1] is STOP
+
+            try:
+                with connection:
+                    connection.executemany(INSERT, batch)
+                metrics.increment('weather_history_rows_total', len(batch), result='written')
+            except sqlite3.Error:
+                metrics.increment('weather_history_rows_total', len(batch), result='failed')
+            finally:
+                for _ in entries:
+                    self.pending.task_done()
+
+        connection.close()
+
+    def flush(self):
+
+        # Wait until everything recorded so far has been written
+        self.pending.join()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+
+        # Write everything recorded so far and stop the writer (waits at most 'timeout' seconds, e.g. if the
+        # database is locked). Lookups recorded after this aren't written
+        thread = self.thread
+        if thread is None or not thread.is_alive():
+            return
+
+        try:
+            self.pending.put(STOP, timeout=timeout)
+        except queue.Full:
+            return
+
+        thread.join(timeout)
+
+    def series(self, location_id, start_hour, end_hour):
+
+        # Hours in [start_hour, end_hour) with any readings, and a (hours, providers, variables) readings array
+        connection = connect(self.path)
+        try:
+            rows = connection.execute(SELECT, (int(location_id), int(start_hour), int(end_hour))).fetchall()
+        finally:
+            connection.close()
+
+        hours = np.array(sorted({row[0] for row in rows}), dtype=np.int64)
+        readings = np.full((len(hours), len(aggregation.PROVIDERS), len(aggregation.VARIABLES)), np.nan)
+
+        if rows:
+            # NULLs come back as NaN
+            data = np.array([row[2:] for row in rows], dtype=float)
+            hour_index = np.searchsorted(hours, [row[0] for row in rows])
+            readings[hour_index, [row[1] for row in rows]] = data
+
+        return hours, readings
+
+    def accuracy(self, location_id, start_hour, end_hour):
+
+        # Mean absolute difference between each provider and the consensus (mean of all providers) over the hours,
+        # as a (providers, variables) array (NaN where a provider has no readings for a variable)
+        readings = self.series(location_id, start_hour, end_hour)[1]
+        consensus = aggregation.aggregate(readings)['mean']
+
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanmean(np.abs(readings - consensus[:, None, :]), axis=0)
@@ -0,0 +1,247 @@
+# HTML extraction engine for the scrapers (BBC Weather, Yr.No).
+#
+# The scrapers only need the text of a handful of elements, so rather than building a full BeautifulSoup tree
+# with the pure-Python 'html.parser' for every page there are three engines:
+#   - 'lxml':   the C-backed lxml parser with XPath lookups (default if lxml is installed, otherwise 'soup' is used)
+#   - 'stream': a targeted parser that feeds the page through as it downloads and stops parsing as soon as
+#               every selector has been found (default without lxml, and always used by the ASGI server, which
+#               parses on the event loop as chunks arrive)
+#   - 'soup':   BeautifulSoup with 'html.parser', as the scrapers originally worked
+#
+# On the saved pages in benchmarks/fixtures lxml parses a whole page a few times faster than 'stream' (which is
+# pure Python) - see benchmarks/bench_html_extract.py.
+#
+# Selectors map a name to a (tag, attribute, value) tuple, e.g. ("div", "class", "wr-u-font-weight-500").
+# An optional 4th item picks the nth match (0-based), e.g. ("td", None, None, 1) is the second <td> on the page.
+# A list of tuples gives alternatives, the first one found in the page wins.
+from html.parser import HTMLParser
+from bs4 import BeautifulSoup
+import codecs
+import os
+import re
+import time
+
+import http_client  # Module containing the shared, pooled HTTP session for outbound requests
+import metrics  # Module for latency histograms and counters
+
+# Optional C-backed parser
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# Extraction engine ('lxml', 'stream' or 'soup'), can be overridden in '.env'
+ENGINE = os.getenv('HTMLExtractEngine', 'stream' if lxml is None else 'lxml')
+
+# Bytes read from the response between checks for whether every selector has been found
+CHUNK_SIZE = 16 * 1024
+
+# Elements which never have a closing tag
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+
+def normalise_selectors(selectors):
+
+    # Turn every selector into a list of (tag, attribute, value, index) alternatives
+    normalised = {}
+
+    for name, selector in selectors.items():
+        alternatives = selector if isinstance(selector, list) else [selector]
+        normalised[name] = [tuple(alternative) + (0,) * (4 - len(alternative)) for alternative in alternatives]
+
+    return normalised
+
+
+def attribute_matches(actual, wanted):
+
+    # Same rules as BeautifulSoup: an exact match, or a single class name that appears in the class list
+    if wanted is None:
+        return True
+    if actual is None:
+        return False
+
+    return actual == wanted or wanted in actual.split()
+
+
+class TargetedParser(HTMLParser):
+
+    def __init__(self, selectors):
+
+        super().__init__(convert_charrefs=True)
+
+        self.selectors = normalise_selectors(selectors)
+        self.results = {}
+
+        # Number of matching elements seen so far, per (name, alternative)
+        self.match_counts = {}
+
+        # Elements currently being captured: [name, tag, nesting depth, text parts]
+        self.captures = []
+
+    @property
+    def done(self):
+        return len(self.results) == len(self.selectors)
+
+    def handle_starttag(self, tag, attrs):
+
+        # Track nesting of the same tag inside anything being captured
+        if tag not in VOID_TAGS:
+            for capture in self.captures:
+                if capture[1] == tag:
+                    capture[2] += 1
+
+        attrs = dict(attrs)
+        capturing = {capture[0] for capture in self.captures}
+
+        for name, alternatives in self.selectors.items():
+
+            if name in self.results or name in capturing:
+                continue
+
+            for alternative_number, (wanted_tag, attribute, value, index) in enumerate(alternatives):
+
+                if tag != wanted_tag or not attribute_matches(attrs.get(attribute), value):
+                    continue
+
+                count_key = (name, alternative_number)
+                count = self.match_counts.get(count_key, 0)
+                self.match_counts[count_key] = count + 1
+
+                if count == index:
+                    if tag in VOID_TAGS:
+                        self.results[name] = ''
+                    else:
+                        self.captures.append([name, tag, 1, []])
+                    break
+
+    def handle_data(self, data):
+
+        for capture in self.captures:
+            capture[3].append(data)
+
+    def handle_endtag(self, tag):
+
+        for capture in list(self.captures):
+            if capture[1] == tag:
+                capture[2] -= 1
+
+                # Element closed - store its text
+                if capture[2] == 0:
+                    self.captures.remove(capture)
+                    self.results[capture[0]] = ''.join(capture[3])
+
+
+def extract_stream(chunks, selectors):
+
+    # 'chunks' is an iterable of text, parsing stops as soon as every selector has been found
+    parser = TargetedParser(selectors)
+
+    # Only time the parsing, not waiting for chunks to download
+    parse_seconds = 0
+    for chunk in chunks:
+        start = time.perf_counter()
+        parser.feed(chunk)
+        parse_seconds += time.perf_counter() - start
+        if parser.done:
+            break
+
+    metrics.observe('weather_stage_seconds', parse_seconds, stage='html_parse', engine='stream')
+
+    return parser.results
+
+
+def extract_soup(content, selectors):
+
+    soup = BeautifulSoup(content, 'html.parser')
+
+    results = {}
+    for name, alternatives in normalise_selectors(selectors).items():
+
+        # Find every alternative, then keep whichever comes first in the page
+        found = []
+        for tag, attribute, value, index in alternatives:
+            matches = soup.find_all(tag, {attribute: value} if attribute else {}, limit=index + 1)
+            if len(matches) > index:
+                found.append(matches[index])
+
+        if found:
+            first = min(found, key=lambda element: (element.sourceline, element.sourcepos))
+            results[name] = first.get_text()
+
+    return results
+
+
+def selector_xpath(tag, attribute, value, index):
+
+    # XPath for one alternative, using the same class matching rules as BeautifulSoup
+    if attribute is None:
+        condition = ''
+    elif attribute == 'class' and ' ' not in value:
+        condition = f'[@class="{value}" or contains(concat(" ", normalize-space(@class), " "), " {value} ")]'
+    else:
+        condition = f'[@{attribute}="{value}"]'
+
+    return f'(//{tag}{condition})[{index + 1}]'
+
+
+def extract_lxml(content, selectors, encoding='utf-8'):
+
+    tree = lxml.html.fromstring(content, parser=lxml.html.HTMLParser(encoding=encoding))
+
+    results = {}
+    for name, alternatives in normalise_selectors(selectors).items():
+
+        # A union of XPath expressions comes back in page order, so the first result is the one that wins
+        matches = tree.xpath(' | '.join(selector_xpath(*alternative) for alternative in alternatives))
+        if matches:
+            results[name] = matches[0].text_content()
+
+    return results
+
+
+def response_charset(response):
+
+    # Charset from the Content-Type header, otherwise UTF-8 (requests would guess ISO-8859-1 for text/html)
+    match = re.search(r'charset=([\w-]+)', response.headers.get('Content-Type', ''))
+
+    return match.group(1) if match else 'utf-8'
+
+
+def fetch(url, selectors, engine=None):
+
+    # Download 'url' and return {name: text} for every selector, raising if any selector is not found
+    if engine is None:
+        engine = ENGINE
+
+    if engine == 'lxml' and lxml is not None:
+        response = http_client.get(url)
+        with metrics.timer('html_parse', engine='lxml'):
+            results = extract_lxml(response.content, selectors, encoding=response_charset(response))
+
+    elif engine in ('lxml', 'soup'):
+        response = http_client.get(url)
+        with metrics.timer('html_parse', engine='soup'):
+            results = extract_soup(response.content, selectors)
+
+    else:
+        # The response is closed even if the download fails part-way, so the connection isn't held
+        with http_client.get(url, stream=True) as response:
+            decoder = codecs.getincrementaldecoder(response_charset(response))(errors='replace')
+            chunks = iter(response.iter_content(CHUNK_SIZE))
+            results = extract_stream((decoder.decode(chunk) for chunk in chunks), selectors)
+
+            # Read (but don't parse) the rest of the page so the connection goes back to the pool
+            for _ in chunks:
+                pass
+
+    return check_results(url, selectors, results)
+
+
+def check_results(url, selectors, results):
+
+    # Raise if any selector wasn't found in the page
+    missing = [name for name in selectors if name not in results]
+    if missing:
+        raise Exception(f"Could not find {', '.join(missing)} in {url}")
+
+    return results
@@ -0,0 +1,82 @@
+# Shared HTTP client for every outbound provider call: one pooled session with keep-alive, compression,
+# connect/read timeouts and retry with backoff, so TCP/TLS handshakes to the same hosts are reused across requests
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import os
+
+# Connection pool sizes: number of hosts kept, and connections kept open per host
+POOL_HOSTS = 10
+POOL_CONNECTIONS_PER_HOST = 20
+
+# Timeouts in seconds (can be overridden in '.env')
+CONNECT_TIMEOUT = float(os.getenv('HTTPConnectTimeout', 3.05))
+READ_TIMEOUT = float(os.getenv('HTTPReadTimeout', 10))
+
+# Retry idempotent requests on connection errors and temporary upstream failures, waiting 0.3s, 0.6s, ...
+# A server's Retry-After is ignored (it can ask for minutes, far past the fan-out's provider timeout), and 429 Too Many
+# Requests isn't retried - staying under the providers' rate limits is up to 'quota'
+retries = Retry(
+    total=2,
+    backoff_factor=0.3,
+    status_forcelist=(500, 502, 503, 504),
+    respect_retry_after_header=False,
+    allowed_methods=frozenset(['GET']),
+    raise_on_status=False  # Hand the last response back so callers can still check 'response.ok'
+)
+
+adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_CONNECTIONS_PER_HOST, max_retries=retries)
+
+session = requests.Session()
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+session.headers.update({
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive'
+})
+
+
+# Called with every response when recording provider fixtures (see replay.py)
+recorder = None
+
+
+def get(url, **kwargs):
+
+    # Same as requests.get, but pooled and with a default timeout
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+
+    response = session.get(url, **kwargs)
+
+    if recorder is not None:
+        recorder(response)
+
+    return response
+
+
+def pool_stats():
+
+    # Per-host connection pool statistics, e.g. {'api.openweathermap.org:443': {...}}
+    stats = {}
+    pools = adapter.poolmanager.pools
+
+    with pools.lock:
+        pool_keys = list(pools.keys())
+
+    for pool_key in pool_keys:
+        pool = pools.get(pool_key)
+        if pool is None:
+            continue
+
+        # Connections opened vs requests made - every request beyond the first on a connection is a reused handshake
+        connections_opened = pool.num_connections
+        requests_made = pool.num_requests
+        idle_connections = sum(1 for connection in list(pool.pool.queue) if connection is not None) if pool.pool else 0
+
+        stats[f'{pool.host}:{pool.port}'] = {
+            'requests': requests_made,
+            'connections_opened': connections_opened,
+            'idle_connections': idle_connections,
+            'reuse_ratio': round(1 - connections_opened / requests_made, 3) if requests_made else 0.0
+        }
+
+    return stats
@@ -0,0 +1,149 @@
+# In-process metrics: latency histograms and counters for each stage of a lookup (geocode, provider fetches,
+# HTML parsing, aggregation, template rendering), served in the Prometheus text format from '/metrics'.
+#
+# Stage timings go to 'weather_stage_seconds' with a 'stage' label (plus 'provider' where there is one), and any
+# stage that raises is also counted in 'weather_stage_errors_total'. Modules with their own statistics (caches,
+# circuit breakers, request coalescing) register a collector that is read when '/metrics' is scraped.
+from contextlib import contextmanager
+import threading
+import time
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15)
+
+# Name -> (type, help text)
+METRICS = {
+    'weather_stage_seconds': ('histogram', 'Time spent in each stage of a weather lookup.'),
+    'weather_stage_errors_total': ('counter', 'Stages that raised an error.'),
+    'weather_provider_timeouts_total': ('counter', 'Provider fetches abandoned by the fan-out deadline.'),
+    'weather_provider_skipped_total': ('counter', 'Provider fetches skipped because the provider is inaccurate in the region.'),
+    'weather_cache_requests_total': ('counter', 'Cache lookups by result (hit, stale or miss).'),
+    'weather_background_refresh_failures_total': ('counter', 'Background refreshes of stale forecast cache entries that failed, by error type.'),
+    'weather_cache_hit_ratio': ('gauge', 'Fraction of cache lookups answered from the cache (hit or stale).'),
+    'weather_coalesced_calls_total': ('counter', 'Upstream calls made vs calls that shared one already in flight.'),
+    'weather_circuit_open': ('gauge', 'Whether the provider circuit breaker is skipping calls (1) or not (0).'),
+    'weather_circuit_error_rate': ('gauge', 'Provider error rate over the circuit breaker window.'),
+    'weather_history_rows_total': ('counter', 'History store rows by result (written, dropped or failed).'),
+    'weather_quota_rejected_total': ('counter', 'Upstream calls refused by the provider quota (deadline or daily budget).'),
+    'weather_quota_tokens': ('gauge', 'Tokens left in the provider quota bucket (negative while calls are queued).'),
+    'weather_quota_remaining_today': ('gauge', 'Upstream calls left in the provider daily budget.'),
+    'weather_hedged_calls_total': ('counter', 'Hedged provider calls by outcome (hedged, won, no_budget or no_quota).'),
+    'weather_hedge_threshold_seconds': ('gauge', 'Provider call latency after which a hedge is sent (recent p95).'),
+    'weather_http_requests_total': ('counter', 'Outbound HTTP requests made through the shared connection pool, per host.'),
+    'weather_http_connections_opened_total': ('counter', 'Outbound HTTP connections opened, per host.'),
+    'weather_http_idle_connections': ('gauge', 'Outbound HTTP connections kept open for reuse, per host.'),
+    'weather_http_connection_reuse_ratio': ('gauge', 'Fraction of outbound HTTP requests that reused an open connection, per host.')
+}
+
+# (name, sorted label items) -> count, or [bucket counts..., sum, count] for histograms
+values = {}
+lock = threading.Lock()
+
+# Functions returning extra [(name, labels, value)] samples when metrics are rendered
+collectors = []
+
+
+def label_key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def increment(name, amount=1, **labels):
+
+    key = label_key(name, labels)
+
+    with lock:
+        values[key] = values.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+
+    key = label_key(name, labels)
+
+    with lock:
+        histogram = values.get(key)
+        if histogram is None:
+            histogram = values[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+
+        for position, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                histogram[position] += 1
+
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+
+@contextmanager
+def timer(stage, **labels):
+
+    # with metrics.timer('geocode'): ...
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        increment('weather_stage_errors_total', stage=stage, **labels)
+        raise
+    finally:
+        observe('weather_stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+
+def register(collector):
+
+    collectors.append(collector)
+
+    return collector
+
+
+def format_labels(labels):
+
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}' if labels else ''
+
+
+def samples():
+
+    # Every (name, label items, value) sample, histograms expanded into buckets
+    with lock:
+        snapshot = [(name, labels, list(value) if isinstance(value, list) else value)
+                    for (name, labels), value in values.items()]
+
+    for collector in collectors:
+        snapshot += [label_key(name, labels) + (value,) for name, labels, value in collector()]
+
+    # Hit ratio per cache from the lookup counters
+    cache_counts = {}
+    for name, labels, value in snapshot:
+        if name == 'weather_cache_requests_total':
+            labels = dict(labels)
+            counts = cache_counts.setdefault(labels['cache'], [0, 0])
+            counts[0] += value if labels['result'] != 'miss' else 0
+            counts[1] += value
+
+    for cache_name, (answered, total) in cache_counts.items():
+        snapshot.append(label_key('weather_cache_hit_ratio', {'cache': cache_name}) + (answered / total if total else 0,))
+
+    return snapshot
+
+
+def render():
+
+    # Prometheus text exposition format
+    by_name = {}
+    for name, labels, value in samples():
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(by_name):
+        metric_type, help_text = METRICS.get(name, ('untyped', ''))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+
+        for labels, value in sorted(by_name[name]):
+            if metric_type != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+
+            for upper_bound, count in zip(LATENCY_BUCKETS + ('+Inf',), value[:len(LATENCY_BUCKETS)] + [value[-1]]):
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", str(upper_bound)),))} {count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value[-2]}')
+            lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,125 @@
+# Rendered results page cache, keyed on (location, hour bucket), with ETag / Last-Modified so browsers can revalidate
+# a page with a 304 instead of downloading it again. Pages are marked private: shared caches (proxies, CDNs) don't
+# keep them. The date and time on the page are filled in by the browser, so a cached page doesn't show an old clock.
+#
+# The page is split in two: the shell (page header, search form, clock and map), which only depends on the location
+# and is rendered once per location, and the small fragments holding the weather data, which are rendered into it.
+# 'results.html' is the shell, with a placeholder for each fragment in 'templates/fragments/'. A streamed results page
+# (see app.stream_results) uses the same shell and fragments, sent as they're ready.
+from collections import namedtuple
+from email.utils import formatdate, parsedate_to_datetime
+import hashlib
+import time
+
+from flask import render_template
+from markupsafe import Markup
+
+import cache  # Module containing a TTL/LRU cache
+import records  # Module containing the typed provider reading / weather report records
+
+# Pages are served for at most this many seconds (the shortest provider TTL), and never past the end of their hour
+PAGE_TTL = 10 * 60
+PAGE_BUCKET = 60 * 60
+PAGE_CACHE_SIZE = 2000
+
+# Shells only change if the template does
+SHELL_TTL = 24 * 60 * 60
+SHELL_CACHE_SIZE = 2000
+
+# Fragment templates, in the order they appear in the shell
+FRAGMENTS = ('datetime', 'weather')
+
+# Stands in for each fragment when the shell is rendered
+FRAGMENT_MARKER = '\x00fragment\x00'
+
+Page = namedtuple('Page', ['html', 'etag', 'last_modified', 'expires'])
+
+pages = cache.TTLCache(maxsize=PAGE_CACHE_SIZE, ttl=PAGE_TTL)
+shells = cache.TTLCache(maxsize=SHELL_CACHE_SIZE, ttl=SHELL_TTL)
+
+
+def location_key(GEO_CODER_DATA):
+
+    return (str(GEO_CODER_DATA['location_id']), str(GEO_CODER_DATA['latitude']), str(GEO_CODER_DATA['longitude']))
+
+
+def get(GEO_CODER_DATA):
+
+    # Cached page for the location this hour, or None
+    return pages.get(location_key(GEO_CODER_DATA) + (int(time.time() // PAGE_BUCKET),))
+
+
+def shell(GEO_CODER_DATA, output_data):
+
+    # Shell for the location, split around the fragment placeholders (needs a Flask app context)
+    shell_key = location_key(GEO_CODER_DATA) + (output_data['location_name'],)
+    parts = shells.get(shell_key)
+
+    if parts is None:
+        placeholders = {f'{name}_fragment': Markup(FRAGMENT_MARKER) for name in FRAGMENTS}
+        parts = render_template('results.html', output_data=output_data, **placeholders).split(FRAGMENT_MARKER)
+        shells.set(shell_key, parts)
+
+    return parts
+
+
+def fragment(name, output_data):
+
+    return render_template(f'fragments/{name}.html', output_data=output_data)
+
+
+def render(GEO_CODER_DATA, weather_data):
+
+    # Render the page into the cache and return it (needs a Flask app context)
+    # 'weather_data' is a records.Report, formatted for display here
+    now = time.time()
+    output_data = records.display(weather_data)
+    shell_parts = shell(GEO_CODER_DATA, output_data)
+
+    # Fill in the fragments
+    parts = [shell_parts[0]]
+    for name, shell_part in zip(FRAGMENTS, shell_parts[1:]):
+        parts.append(fragment(name, output_data))
+        parts.append(shell_part)
+
+    html = ''.join(parts)
+
+    # Served until the TTL runs out or the hour ends, whichever is first
+    bucket = int(now // PAGE_BUCKET)
+    expires = min(now + PAGE_TTL, (bucket + 1) * PAGE_BUCKET)
+
+    page = Page(
+        html=html,
+        etag='"' + hashlib.sha1(html.encode()).hexdigest()[:20] + '"',
+        last_modified=int(now),
+        expires=expires
+    )
+
+    pages.set(location_key(GEO_CODER_DATA) + (bucket,), page, ttl=expires - now)
+
+    return page
+
+
+def headers(page):
+
+    # Validators and freshness for a page response (for the browser's cache only)
+    return [
+        ('ETag', page.etag),
+        ('Last-Modified', formatdate(page.last_modified, usegmt=True)),
+        ('Cache-Control', f'private, max-age={max(0, int(page.expires - time.time()))}')
+    ]
+
+
+def not_modified(page, if_none_match=None, if_modified_since=None):
+
+    # Whether a conditional request's copy is still current (If-None-Match wins if both are sent)
+    if if_none_match:
+        return page.etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+    if if_modified_since:
+        try:
+            return page.last_modified <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    return False
@@ -0,0 +1,165 @@
+# Background prefetch scheduler: counts how often each geocoded location is looked up and, at every hourly
+# boundary, refreshes the forecast cache for the most popular locations so their results are ready before users ask.
+#
+# Refreshes run just after the boundary rather than before it, because MetOffice picks the row for the current hour
+# and results are cached per hourly bucket - data fetched at 11:59 would be cached for (and describe) 11:00.
+import math
+import threading
+import time
+
+import quota  # Module for per-provider upstream request quotas
+
+# Number of locations to refresh each hour
+TOP_N = 50
+
+# Seconds after the hourly boundary to start refreshing
+OFFSET = 5
+
+# Seconds between refreshes of the same location
+PERIOD = 60 * 60
+
+# Lookup counts are multiplied by this after every refresh so the ranking follows recent traffic
+DECAY = 0.5
+
+# Maximum number of locations tracked
+MAX_TRACKED = 10000
+
+# For providers with a daily quota, the share of what's left of today's background budget prefetching may use. It is
+# spread over the runs left in the day, so the budget lasts until midnight UTC and stale-cache refreshes get the rest
+BUDGET_SHARE = 0.5
+
+
+class Prefetcher:
+
+    def __init__(self, providers, top_n=TOP_N, offset=OFFSET, period=PERIOD):
+
+        # 'providers' maps a provider name to (cached provider function, location keys used as arguments,
+        # minimum seconds between calls to that provider), e.g. {'YrNo': (YrNo, ('location_id',), 2)}
+        self.providers = providers
+        self.top_n = top_n
+        self.offset = offset
+        self.period = period
+
+        # location_id -> lookup count, and location_id -> geocoded location data
+        self.counts = {}
+        self.locations = {}
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        # Statistics
+        self.stats = {'runs': 0, 'refreshed': 0, 'errors': 0, 'last_run': None, 'last_duration': None}
+
+    def record(self, location):
+
+        # Called for every lookup with the data returned by geo_coder
+        location_id = location['location_id']
+
+        with self.lock:
+            self.counts[location_id] = self.counts.get(location_id, 0) + 1
+            self.locations[location_id] = location
+
+            # Forget the least popular locations once too many are tracked
+            if len(self.counts) > MAX_TRACKED:
+                for location_id in sorted(self.counts, key=self.counts.get)[:len(self.counts) - MAX_TRACKED]:
+                    del self.counts[location_id]
+                    del self.locations[location_id]
+
+        # Scheduler starts with the first lookup
+        self.start()
+
+    def hot_locations(self):
+
+        with self.lock:
+            hottest = sorted(self.counts, key=self.counts.get, reverse=True)[:self.top_n]
+
+            return [self.locations[location_id] for location_id in hottest]
+
+    def start(self):
+
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.thread = threading.Thread(target=self.run, name='prefetch', daemon=True)
+
+        self.thread.start()
+
+    def stop(self):
+
+        self.stop_event.set()
+
+    def run(self):
+
+        while not self.stop_event.is_set():
+
+            # Sleep until just after the next boundary
+            now = time.time()
+            next_run = (now // self.period + 1) * self.period + self.offset
+            if self.stop_event.wait(next_run - now):
+                break
+
+            self.refresh_hot()
+
+    def refresh_hot(self):
+
+        start = time.time()
+        locations = self.hot_locations()
+
+        # Decay counts, dropping locations nobody has asked for in a while
+        with self.lock:
+            for location_id in list(self.counts):
+                self.counts[location_id] *= DECAY
+                if self.counts[location_id] < 0.1:
+                    del self.counts[location_id]
+                    del self.locations[location_id]
+
+        # Providers are refreshed side by side, each one paced to its own rate limit
+        threads = [
+            threading.Thread(target=self.refresh_provider, args=(provider, locations), daemon=True)
+            for provider in self.providers.values()
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.stats['runs'] += 1
+        self.stats['last_run'] = start
+        self.stats['last_duration'] = round(time.time() - start, 2)
+
+    def refresh_provider(self, provider, locations):
+
+        function, argument_keys, interval = provider
+
+        # Entries fetched within their TTL don't need refreshing yet
+        arguments = [tuple(location[key] for key in argument_keys) for location in locations]
+        arguments = [args for args in arguments if not function.fresh(*args)]
+
+        # Hottest locations first, as many as the provider's daily quota allows this run
+        remaining = quota.remaining_today(function.name, quota.BACKGROUND)
+        if remaining is not None:
+            runs_left = math.ceil((86400 - time.time() % 86400) / self.period)
+            arguments = arguments[:int(remaining * BUDGET_SHARE / runs_left)]
+
+        for args in arguments:
+
+            if self.stop_event.is_set():
+                return
+
+            call_start = time.monotonic()
+
+            # Force a fetch and store it in the forecast cache
+            try:
+                with quota.background():
+                    function.refresh(*args)
+                outcome = 'refreshed'
+            except Exception:
+                outcome = 'errors'
+
+            with self.lock:
+                self.stats[outcome] += 1
+
+            # Wait out the rest of the provider's interval
+            self.stop_event.wait(max(0, interval - (time.monotonic() - call_start)))
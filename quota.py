@@ -0,0 +1,235 @@
+# Upstream quotas: every outbound call to GeoNames, OpenWeather, the Met Office DataHub and the scraped sites takes a
+# token from that provider's bucket first, so we stay under their rate limits and daily allowances (and don't get
+# blocked by the sites we scrape).
+#
+# Each provider has a token bucket (a steady rate with room for a burst) and a daily budget that resets at midnight
+# UTC. A caller reserves a token and then sleeps until it is due, so callers queue in arrival order without holding
+# a lock while they wait. Callers that would have to wait past their deadline, or that find the day's budget used
+# up, get QuotaExceededError straight away instead of a late answer.
+#
+# Calls have a priority. Interactive calls (a user is waiting) may queue ahead of the bucket. Background calls
+# (stale-cache refreshes and prefetching) only take a token when one is free after leaving BACKGROUND_RESERVE of the
+# burst and of the daily budget for interactive calls, so they never make a user wait.
+from contextlib import contextmanager
+import asyncio
+import contextvars
+import threading
+import time
+
+import metrics  # Module for latency histograms and counters
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# Provider -> (requests per second, burst, requests per day or None for no daily limit)
+LIMITS = {
+    # Free plan: 1000 an hour, 10000 a day
+    'GeoNames': (1000 / 3600, 20, 10000),
+    # Free plan: 60 a minute, 1,000,000 a month
+    'OpenWeather': (1.0, 60, 30000),
+    # Site-specific free plan: 360 a day
+    'MetOfficeForecast': (0.1, 10, 360),
+    # Scraped sites: keep it polite
+    'BBCWeather': (2.0, 10, None),
+    'YrNo': (2.0, 10, None)
+}
+
+# Share of each burst and daily budget background calls leave for interactive calls
+BACKGROUND_RESERVE = 0.2
+
+# Longest a call will queue for a token, in seconds. Interactive calls have to fit inside the fan-out's provider
+# timeout (see 'fanout'), background calls can wait longer
+MAX_WAIT = {INTERACTIVE: 5, BACKGROUND: 60}
+
+# Priority of the calls made in the current thread / task
+priority = contextvars.ContextVar('quota_priority', default=INTERACTIVE)
+
+
+class QuotaExceededError(Exception):
+    pass
+
+
+@contextmanager
+def background():
+
+    # with quota.background(): ... marks the upstream calls inside as background calls
+    token = priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        priority.reset(token)
+
+
+def utc_day():
+
+    return int(time.time() // 86400)
+
+
+class Quota:
+
+    def __init__(self, name, rate, burst, daily_limit=None, background_reserve=BACKGROUND_RESERVE):
+
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.daily_limit = daily_limit
+        self.background_reserve = background_reserve
+
+        # Tokens go below zero while interactive calls are queued ahead of the bucket
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+        self.day = utc_day()
+        self.used_today = 0
+
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+
+        # Lock must be held
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        day = utc_day()
+        if day != self.day:
+            self.day = day
+            self.used_today = 0
+
+    def reserve(self, call_priority, deadline):
+
+        # (whether a token was taken, seconds to sleep before calling or before trying again)
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+
+            interactive = call_priority == INTERACTIVE
+            reserve = 0 if interactive else self.background_reserve
+
+            if self.daily_limit is not None and self.used_today >= self.daily_limit * (1 - reserve):
+                metrics.increment('weather_quota_rejected_total', provider=self.name, priority=call_priority, reason='daily')
+                raise QuotaExceededError(f"{self.name} daily request budget used up, skipping.")
+
+            # Time until a token is free (for background calls, one beyond the reserve)
+            wait = max(0.0, (self.burst * reserve + 1 - self.tokens) / self.rate)
+
+            if now + wait > deadline:
+                metrics.increment('weather_quota_rejected_total', provider=self.name, priority=call_priority, reason='deadline')
+                raise QuotaExceededError(f"{self.name} request rate limit reached, skipping.")
+
+            # Background calls don't queue, they come back when a token should be free
+            if not interactive and wait > 0:
+                return False, wait
+
+            self.tokens -= 1
+            self.used_today += 1
+
+            return True, wait
+
+    def try_take(self, call_priority):
+
+        # Takes a token if one is free right now (for background calls, one beyond the reserve), without queueing.
+        # Not taking one isn't a rejection - the caller just doesn't make an optional call - so it isn't counted
+        with self.lock:
+            self.refill(time.monotonic())
+
+            reserve = 0 if call_priority == INTERACTIVE else self.background_reserve
+
+            if self.daily_limit is not None and self.used_today >= self.daily_limit * (1 - reserve):
+                return False
+
+            if self.tokens < self.burst * reserve + 1:
+                return False
+
+            self.tokens -= 1
+            self.used_today += 1
+
+            return True
+
+    def remaining_today(self, call_priority=INTERACTIVE):
+
+        # Calls left in today's budget for this priority (None if there's no daily limit)
+        if self.daily_limit is None:
+            return None
+
+        reserve = 0 if call_priority == INTERACTIVE else self.background_reserve
+
+        with self.lock:
+            self.refill(time.monotonic())
+
+            return max(0, int(self.daily_limit * (1 - reserve)) - self.used_today)
+
+    def stats(self):
+
+        with self.lock:
+            self.refill(time.monotonic())
+
+            return {
+                'tokens': round(self.tokens, 3),
+                'used_today': self.used_today,
+                'remaining_today': None if self.daily_limit is None else max(0, self.daily_limit - self.used_today)
+            }
+
+
+# One quota per provider in LIMITS (other names aren't limited)
+quotas = {name: Quota(name, *limits) for name, limits in LIMITS.items()}
+
+
+def remaining_today(name, call_priority=INTERACTIVE):
+
+    # Calls left today for a provider (None if it has no daily limit)
+    provider_quota = quotas.get(name)
+
+    return None if provider_quota is None else provider_quota.remaining_today(call_priority)
+
+
+def deadline_for(call_priority):
+
+    return time.monotonic() + MAX_WAIT[call_priority]
+
+
+def acquire(name):
+
+    # Blocks until the call may go ahead, or raises QuotaExceededError
+    provider_quota = quotas.get(name)
+    if provider_quota is None:
+        return
+
+    call_priority = priority.get()
+    deadline = deadline_for(call_priority)
+
+    with metrics.timer('quota', provider=name):
+        while True:
+            taken, wait = provider_quota.reserve(call_priority, deadline)
+            if wait:
+                time.sleep(wait)
+            if taken:
+                return
+
+
+async def acquire_async(name):
+
+    # As 'acquire', for the ASGI server's event loop
+    provider_quota = quotas.get(name)
+    if provider_quota is None:
+        return
+
+    call_priority = priority.get()
+    deadline = deadline_for(call_priority)
+
+    with metrics.timer('quota', provider=name):
+        while True:
+            taken, wait = provider_quota.reserve(call_priority, deadline)
+            if wait:
+                await asyncio.sleep(wait)
+            if taken:
+                return
+
+
+def try_acquire(name):
+
+    # Takes a token only if one is free right now, for calls that are worth making but not worth waiting for
+    provider_quota = quotas.get(name)
+    if provider_quota is None:
+        return True
+
+    return provider_quota.try_take(priority.get())
@@ -0,0 +1,204 @@
+# Compact records for provider readings and the finished weather report.
+#
+# Values are kept as numbers (NaN when missing, -1 for a missing weather code) in slotted, read-only dataclasses,
+# and are only formatted for display when a page or API response is rendered (see 'display'). Records also pack to
+# a few dozen bytes with 'pack' / 'unpack', which is how they are held in the caches.
+from dataclasses import dataclass, fields
+from datetime import datetime
+import math
+import struct
+
+import conditions  # Module containing the weather condition table (descriptions, emoji, images, UV bands)
+
+NAN = math.nan
+
+# Weather code when no provider gives one
+NO_CODE = -1
+
+
+def format_variable(variable):
+
+    # Missing values (e.g. a provider didn't answer) are shown as 'N/A'
+    if variable is None or math.isnan(float(variable)):
+        return "N/A"
+
+    # Convert to float
+    variable = float(variable)
+
+    # Round float
+    variable = round(variable, 1)
+
+    # If the float is a whole number, convert it to an integer
+    if variable % 1 == 0:
+        variable = int(variable)
+
+    # Convert variable into string for output
+    variable = str(variable)
+
+    return variable
+
+
+def number(value):
+
+    # Provider values can be numbers or strings such as '12°' or '81%', anything else is NaN
+    if value is None:
+        return NAN
+
+    try:
+        return float(str(value).strip('°% '))
+    except ValueError:
+        return NAN
+
+
+# One provider's readings for the current hour (providers leave out what they don't supply)
+@dataclass(frozen=True, slots=True)
+class Reading:
+    temperature: float = NAN
+    feels_like: float = NAN
+    wind_speed: float = NAN
+    gust_speed: float = NAN
+    rain_chance: float = NAN
+    rain_amount: float = NAN
+    snow_amount: float = NAN
+    humidity: float = NAN
+    uv_index: float = NAN
+    weather_code: int = NO_CODE
+    wind_desc: str = ''
+
+
+# Stands in for a provider that didn't answer
+NO_READING = Reading()
+
+
+# Weather report for one location
+@dataclass(frozen=True, slots=True)
+class Report:
+    timestamp: float
+    latitude: float
+    longitude: float
+    location_id: int
+    location_name: str
+    temperature: float = NAN
+    feels_like: float = NAN
+    wind_speed: float = NAN
+    gust_speed: float = NAN
+    rain_chance: float = NAN
+    rain_amount: float = NAN
+    snow_amount: float = NAN
+    humidity: float = NAN
+    uv_index: float = NAN
+    moon_percent: float = NAN
+    weather_code: int = NO_CODE
+    wind_desc: str = ''
+    sunrise: str = 'N/A'
+    sunset: str = 'N/A'
+    moon_phase: str = ''
+    sources: tuple = ()
+
+
+def display(report):
+
+    # Formatted fields for the results page and the JSON API
+    created = datetime.fromtimestamp(report.timestamp)
+    condition = conditions.condition(report.weather_code)
+
+    return {
+        'current_date': created.strftime('%d/%m/%Y'),
+        'current_time': created.strftime('%H:%M'),
+        'latitude': str(report.latitude),
+        'longitude': str(report.longitude),
+        'location_name': report.location_name,
+        'location_id': str(report.location_id),
+        'temperature': format_variable(report.temperature),
+        'feels_like': format_variable(report.feels_like),
+        'weather_desc': condition.description,
+        'wind_speed': format_variable(report.wind_speed),
+        'gust_speed': format_variable(report.gust_speed),
+        'wind_desc': report.wind_desc or 'Not available',
+        'rain_chance': format_variable(report.rain_chance),
+        'rain_amount': format_variable(report.rain_amount),
+        'snow_condition_flag': int(report.snow_amount > 0),
+        'snow_amount': format_variable(report.snow_amount),
+        'uv_index_code': format_variable(report.uv_index),
+        'uv_index_desc': 'Not available' if math.isnan(report.uv_index) else conditions.uv_band(report.uv_index),
+        'humidity': format_variable(report.humidity),
+        'sunrise': report.sunrise,
+        'sunset': report.sunset,
+        'moon_phase': report.moon_phase,
+        'moon_emoji': conditions.MOON_EMOJI.get(report.moon_phase, ''),
+        'moon_percent': format_variable(report.moon_percent),
+        'weather_emoji': condition.emoji,
+        'weather_image': condition.image,
+        'sources': list(report.sources)
+    }
+
+
+# Binary format
+# -------------
+# A type byte, the numeric fields as one struct (in field order), then each text field as a 2-byte length and UTF-8.
+# Tuples of strings (e.g. 'sources') are stored as one text field, joined with SEPARATOR.
+
+RECORD_TYPES = (Reading, Report)
+
+# Struct format character for each numeric field type
+NUMBER_FORMATS = {float: 'd', int: 'i'}
+
+SEPARATOR = '\x1f'
+
+TEXT_LENGTH = struct.Struct('<H')
+
+
+def layout(record_type):
+
+    # (struct for the numeric fields, their names, text field names and types)
+    numbers = [field for field in fields(record_type) if field.type in NUMBER_FORMATS]
+    texts = [field for field in fields(record_type) if field.type not in NUMBER_FORMATS]
+
+    number_struct = struct.Struct('<B' + ''.join(NUMBER_FORMATS[field.type] for field in numbers))
+
+    return number_struct, [field.name for field in numbers], [(field.name, field.type) for field in texts]
+
+
+# Built once, LAYOUTS[type byte]
+LAYOUTS = [layout(record_type) for record_type in RECORD_TYPES]
+
+
+def pack(record):
+
+    record_type = RECORD_TYPES.index(type(record))
+    number_struct, number_names, text_fields = LAYOUTS[record_type]
+
+    parts = [number_struct.pack(record_type, *[getattr(record, name) for name in number_names])]
+
+    for name, field_type in text_fields:
+        value = getattr(record, name)
+        if field_type is tuple:
+            value = SEPARATOR.join(value)
+
+        encoded = value.encode('utf-8')
+        parts.append(TEXT_LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+
+    return b''.join(parts)
+
+
+def unpack(data):
+
+    number_struct, number_names, text_fields = LAYOUTS[data[0]]
+
+    values = number_struct.unpack_from(data)
+    record = dict(zip(number_names, values[1:]))
+
+    position = number_struct.size
+    for name, field_type in text_fields:
+        length = TEXT_LENGTH.unpack_from(data, position)[0]
+        position += TEXT_LENGTH.size
+        value = data[position:position + length].decode('utf-8')
+        position += length
+
+        if field_type is tuple:
+            value = tuple(value.split(SEPARATOR)) if value else ()
+
+        record[name] = value
+
+    return RECORD_TYPES[data[0]](**record)
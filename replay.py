@@ -0,0 +1,246 @@
+# Record / replay of upstream provider responses, so the app and the benchmarks can run offline without API keys.
+#
+# Record (needs live access and the API keys in '.env'):
+#   python replay.py record DIR London,GB Paris,FR ...
+# looks each town up through app.py and saves every GeoNames / OpenWeather / Met Office / BBC / Yr.No response as
+# DIR/<provider>/<hash>.json. Credentials (GeoNames username, OpenWeather APPID) are left out of the recordings.
+#
+# Replay:
+#   python replay.py serve DIR [--port 8001]
+# serves the recordings from a local stub server (see stub_server.py) and prints the '.env' lines that point
+# app.py at it. Requests are matched on path and query (ignoring credentials), then on path alone.
+#
+# Met Office forecasts are hourly from the time they were fetched, so replayed ones are moved forward by the hours
+# since recording (the forecast always starts the same number of hours before 'now' as it did when recorded).
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import argparse
+import base64
+import hashlib
+import json
+import os
+import time
+
+from stub_server import StubServer
+
+# Provider -> setting holding its base URL. The stub serves each provider under '/<provider>'
+PROVIDERS = {
+    'geonames': 'GeoNamesURL',
+    'openweather': 'OpenWeatherURL',
+    'metoffice': 'MetOfficeURL',
+    'bbc': 'BBCWeatherURL',
+    'yrno': 'YrNoURL'
+}
+
+# Query parameters holding credentials (compared lower case)
+SECRET_PARAMS = {'username', 'appid', 'apikey'}
+
+# Met Office forecast step time format
+METOFFICE_TIME_FORMAT = '%Y-%m-%dT%H:%MZ'
+
+
+def request_key(path, query):
+
+    # Path plus sorted query without credentials, e.g. '/data/2.5/weather?lat=51.5&lon=-0.12&units=metric'
+    params = sorted((name, value) for name, value in parse_qsl(query, keep_blank_values=True)
+                    if name.lower() not in SECRET_PARAMS)
+
+    return path + ('?' + urlencode(params) if params else '')
+
+
+def save(directory, provider, key, status, content_type, body, recorded_at=None):
+
+    # Write one recording, body as text if it is UTF-8, base64 otherwise
+    record = {
+        'request': key,
+        'status': status,
+        'content_type': content_type,
+        'recorded_at': int(time.time() if recorded_at is None else recorded_at)
+    }
+
+    try:
+        record['body'] = body.decode('utf-8')
+    except UnicodeDecodeError:
+        record['body_base64'] = base64.b64encode(body).decode('ascii')
+
+    os.makedirs(os.path.join(directory, provider), exist_ok=True)
+    path = os.path.join(directory, provider, hashlib.sha1(key.encode()).hexdigest()[:16] + '.json')
+
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(record, file, ensure_ascii=False, indent=1)
+
+    return path
+
+
+def load(directory):
+
+    # {provider: [recording, ...]}
+    recordings = {}
+
+    for provider in PROVIDERS:
+        provider_directory = os.path.join(directory, provider)
+        if not os.path.isdir(provider_directory):
+            continue
+
+        for file_name in sorted(os.listdir(provider_directory)):
+            if file_name.endswith('.json'):
+                with open(os.path.join(provider_directory, file_name), encoding='utf-8') as file:
+                    recordings.setdefault(provider, []).append(json.load(file))
+
+    return recordings
+
+
+class Recorder:
+
+    # Installed as 'http_client.recorder', called with every response the app receives
+    def __init__(self, directory, base_urls):
+
+        # 'base_urls' maps a provider to the base URL the app is calling, e.g. {'bbc': 'https://bbc.co.uk'}
+        self.directory = directory
+        self.base_urls = base_urls
+        self.saved = []
+
+    def __call__(self, response):
+
+        # URL as requested, before any redirects
+        url = response.history[0].url if response.history else response.url
+
+        for provider, base_url in self.base_urls.items():
+            if url.startswith(base_url):
+                path, query = urlsplit(url[len(base_url):])[2:4]
+                key = request_key(path, query)
+                self.saved.append(save(self.directory, provider, key, response.status_code,
+                                       response.headers.get('Content-Type', ''), response.content))
+                return
+
+
+def shift_metoffice(body, recorded_at):
+
+    # Move every forecast step forward by the whole hours since the recording was made
+    hours = int(time.time() // 3600 - recorded_at // 3600)
+    if hours == 0:
+        return body
+
+    data = json.loads(body)
+    for feature in data.get('features', []):
+        for step in feature.get('properties', {}).get('timeSeries', []):
+            step_time = datetime.strptime(step['time'], METOFFICE_TIME_FORMAT).replace(tzinfo=timezone.utc)
+            step['time'] = (step_time + timedelta(hours=hours)).strftime(METOFFICE_TIME_FORMAT)
+
+    return json.dumps(data).encode()
+
+
+# Provider -> function adjusting a time-dependent body for replay
+TIME_SHIFTS = {'metoffice': shift_metoffice}
+
+
+def routes(directory):
+
+    # StubServer routes replaying the recordings in 'directory'
+    recordings = load(directory)
+
+    def route(provider):
+
+        by_request = {}
+        by_path = {}
+        for record in recordings.get(provider, []):
+            by_request[record['request']] = record
+            by_path.setdefault(record['request'].split('?')[0], record)
+
+        prefix = '/' + provider
+
+        def respond(path, query):
+
+            path = path[len(prefix):]
+            record = by_request.get(request_key(path, query)) or by_path.get(path)
+
+            if record is None:
+                return 404, 'text/plain', f'No recording for {provider} {path}'.encode()
+
+            if 'body_base64' in record:
+                body = base64.b64decode(record['body_base64'])
+            else:
+                body = record['body'].encode('utf-8')
+
+            if provider in TIME_SHIFTS:
+                body = TIME_SHIFTS[provider](body, record['recorded_at'])
+
+            return record['status'], record['content_type'], body
+
+        return respond
+
+    return {'/' + provider: route(provider) for provider in PROVIDERS}
+
+
+def env(stub_url):
+
+    # Settings pointing app.py at the replay server (which has no quotas to protect)
+    settings = {setting: f'{stub_url}/{provider}' for provider, setting in PROVIDERS.items()}
+    settings['UpstreamQuotas'] = 'off'
+
+    return settings
+
+
+def record(directory, locations):
+
+    import app
+    import http_client
+
+    base_urls = {provider: getattr(app, setting) for provider, setting in PROVIDERS.items()}
+    recorder = http_client.recorder = Recorder(directory, base_urls)
+
+    try:
+        for location in locations:
+            town, _, country_code = location.partition(',')
+            geo_coder_data = app.geo_coder(town, country_code or 'GB')
+
+            if geo_coder_data == "Error":
+                print(f'{location}: not found')
+                continue
+
+            if geo_coder_data == "Busy":
+                print(f'{location}: GeoNames quota used up, try again later')
+                continue
+
+            app.weather_report(geo_coder_data)
+            print(f"{location}: recorded ({geo_coder_data['name']}, {geo_coder_data['location_id']})")
+    finally:
+        http_client.recorder = None
+
+    print(f'{len(recorder.saved)} responses saved to {directory}')
+
+
+def serve(directory, port):
+
+    stub = StubServer(routes(directory), port=port)
+
+    print('# Add to .env (or the environment) to use the recordings:')
+    for setting, value in env(stub.url).items():
+        print(f'{setting}={value}')
+
+    stub.server.serve_forever()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Record provider responses to disk, or replay them from a stub server')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = commands.add_parser('record')
+    record_parser.add_argument('directory')
+    record_parser.add_argument('locations', nargs='+', help='Town,CountryCode e.g. London,GB')
+
+    serve_parser = commands.add_parser('serve')
+    serve_parser.add_argument('directory')
+    serve_parser.add_argument('--port', type=int, default=8001)
+
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.directory, args.locations)
+    else:
+        serve(args.directory, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# Request coalescing ("single flight"): when identical upstream calls overlap, only the first one goes upstream and
+# the rest wait for and share its result (or its exception). Keys are tuples starting with the provider name, e.g.
+# the forecast cache key (provider, location, time bucket) or ('GeoNames', town, country code).
+#
+# During a spike of lookups for the same town this turns N identical upstream calls into one.
+from concurrent.futures import Future
+import asyncio
+import threading
+
+# Per provider counts of calls that went upstream and calls that shared one already in flight
+counts = {}
+counts_lock = threading.Lock()
+
+
+def count(key, outcome):
+
+    with counts_lock:
+        provider_counts = counts.setdefault(key[0], {'upstream': 0, 'coalesced': 0})
+        provider_counts[outcome] += 1
+
+
+def stats():
+
+    # {provider: {'upstream': n, 'coalesced': n, 'coalesced_ratio': fraction of calls that were coalesced}}
+    with counts_lock:
+        return {
+            name: dict(provider_counts,
+                       coalesced_ratio=round(provider_counts['coalesced'] / max(1, sum(provider_counts.values())), 3))
+            for name, provider_counts in counts.items()
+        }
+
+
+class SingleFlight:
+
+    # For threads (the Flask app, fan-out pool and background refreshes)
+    def __init__(self):
+
+        # Key -> Future for the call in flight
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function, *args):
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.in_flight[key] = future
+
+        # Someone else is already fetching this - wait for their result
+        if not leader:
+            count(key, 'coalesced')
+            return future.result()
+
+        count(key, 'upstream')
+        try:
+            result = function(*args)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+
+class AsyncSingleFlight:
+
+    # For coroutines on one event loop (the ASGI app)
+    def __init__(self):
+
+        # Key -> Task for the call in flight
+        self.in_flight = {}
+
+    async def do(self, key, function, *args):
+
+        task = self.in_flight.get(key)
+
+        if task is None:
+            count(key, 'upstream')
+
+            # The call runs as its own task so it carries on for the others if the caller that started it times out
+            task = asyncio.ensure_future(function(*args))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda done: self.finished(key, done))
+        else:
+            count(key, 'coalesced')
+
+        return await asyncio.shield(task)
+
+    def finished(self, key, task):
+
+        del self.in_flight[key]
+
+        # Mark the exception as retrieved in case every caller gave up waiting
+        if not task.cancelled():
+            task.exception()
+
+
+# Shared by every provider and the geocoder
+group = SingleFlight()
+async_group = AsyncSingleFlight()
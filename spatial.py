@@ -0,0 +1,90 @@
+# Spatial snapping: maps each geocoded location onto a forecast cell, so nearby locations share provider fetches and
+# cached results instead of each getting their own.
+#
+# The grid has rows 'cell_km' tall, and each row is split into columns up to 'cell_km' wide at that latitude, so
+# cells are roughly square everywhere. Providers queried by coordinates (OpenWeather, Met Office) are asked about the
+# centre of the cell, at most max_centre_error_km() from the real location. Providers keyed by location ID (the
+# scrapers) are asked about the first location looked up in the cell, at most max_location_error_km() away.
+#
+# The bounds hold at every latitude, polar rows included (to within 1% - distances are worked out as if each cell
+# were flat). Towards a pole the columns get wider in degrees but stay at most 'cell_km' wide. A row whose columns
+# would be 360 degrees or more is a single cell, but then its equator-side edge goes round the pole in less than
+# 'cell_km', so the whole row lies within cell_km / 2 pi of the pole.
+import math
+import threading
+
+import cache  # Module containing a TTL/LRU cache
+
+# Kilometres per degree of latitude (and of longitude at the equator)
+KM_PER_DEGREE = 111.32
+
+# Canonical location per cell: how many cells are remembered, and for how long
+MAX_CELLS = 50000
+CELL_TTL = 7 * 24 * 60 * 60
+
+# Decimal places of the cell centre coordinates (4 is ~10m)
+COORDINATE_PLACES = 4
+
+
+class Grid:
+
+    def __init__(self, cell_km, max_cells=MAX_CELLS, cell_ttl=CELL_TTL):
+
+        self.cell_km = cell_km
+        self.latitude_step = cell_km / KM_PER_DEGREE
+
+        # (row, column) -> location ID of the first location looked up in the cell
+        self.locations = cache.TTLCache(maxsize=max_cells, ttl=cell_ttl)
+        self.lock = threading.Lock()
+
+    def longitude_step(self, row):
+
+        # Column width in degrees for a row, wider towards the poles (one column around the pole itself). Worked
+        # out at the row's edge nearest the equator, so cells are at most 'cell_km' wide along their whole height
+        south = -90 + row * self.latitude_step
+        north = south + self.latitude_step
+        nearest_equator = 0 if south < 0 < north else min(abs(south), abs(north))
+
+        return min(360.0, self.latitude_step / max(math.cos(math.radians(nearest_equator)), 1e-6))
+
+    def cell(self, latitude, longitude):
+
+        row = math.floor((float(latitude) + 90) / self.latitude_step)
+        column = math.floor((float(longitude) + 180) / self.longitude_step(row))
+
+        return row, column
+
+    def centre(self, row, column):
+
+        latitude = min(90.0, -90 + (row + 0.5) * self.latitude_step)
+        longitude = min(180.0, -180 + (column + 0.5) * self.longitude_step(row))
+
+        return round(latitude, COORDINATE_PLACES), round(longitude, COORDINATE_PLACES)
+
+    def snap(self, location):
+
+        # Copy of the geocoded location with the cell centre's coordinates and the cell's location ID
+        row, column = self.cell(location['latitude'], location['longitude'])
+
+        with self.lock:
+            location_id = self.locations.get((row, column))
+            if location_id is None:
+                location_id = location['location_id']
+                self.locations.set((row, column), location_id)
+
+        latitude, longitude = self.centre(row, column)
+
+        snapped = dict(location)
+        snapped.update(latitude=str(latitude), longitude=str(longitude), location_id=location_id, cell=(row, column))
+
+        return snapped
+
+    def max_centre_error_km(self):
+
+        # Half the diagonal of a cell (a whole-row cell at a pole is smaller, see above)
+        return self.cell_km / math.sqrt(2)
+
+    def max_location_error_km(self):
+
+        # The whole diagonal (two locations in opposite corners)
+        return self.cell_km * math.sqrt(2)
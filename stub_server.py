@@ -0,0 +1,98 @@
+# Local stub HTTP server standing in for the upstream providers (GeoNames, OpenWeather, Met Office, BBC, Yr.No),
+# with a configurable delay per route so the fan-out can be exercised without live access.
+#
+# Point app.py at it by setting the provider base URLs in '.env' (or the environment), e.g.
+#   OpenWeatherURL=http://127.0.0.1:8001/openweather
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+import threading
+import time
+
+
+class Server(ThreadingHTTPServer):
+
+    # Room for many clients connecting at once (e.g. load tests), the default backlog is 5
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class StubServer:
+
+    def __init__(self, routes=None, delays=None, host='127.0.0.1', port=0):
+
+        # 'routes' maps a path prefix to a (status code, content type, body bytes) tuple, or to a function taking
+        # the request path and query string and returning that tuple
+        # 'delays' maps a path prefix to a delay in seconds applied before responding
+        self.routes = routes or {}
+        self.delays = delays or {}
+        self.request_count = 0
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            # Headers and body are written separately, so don't let Nagle hold the body back for an ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+
+                stub.request_count += 1
+                path, query = urlsplit(self.path)[2:4]
+
+                # Inject configured delay
+                delay = stub.match(stub.delays, path)
+                if delay:
+                    time.sleep(delay)
+
+                route = stub.match(stub.routes, path) or (404, 'text/plain', b'Not found')
+                status, content_type, body = route(path, query) if callable(route) else route
+
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Keep test output quiet
+                pass
+
+        self.server = Server((host, port), Handler)
+        self.thread = None
+
+    @staticmethod
+    def match(table, path):
+
+        # Longest matching path prefix wins
+        for prefix in sorted(table, key=len, reverse=True):
+            if path.startswith(prefix):
+                return table[prefix]
+
+        return None
+
+    @property
+    def url(self):
+
+        host, port = self.server.server_address[:2]
+
+        return f'http://{host}:{port}'
+
+    def start(self):
+
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,22 @@
+# Shared test setup: app.py is pointed at a local stub server replaying a synthetic London lookup (see replay.py and
+# benchmarks/bench_pipeline.py), with the history store, geocoding cache file and gazetteer turned off
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import replay  # noqa: E402
+from bench_pipeline import synthetic_recording  # noqa: E402
+from stub_server import StubServer  # noqa: E402
+
+# Settings have to be in place before app.py is first imported
+RECORDINGS = tempfile.mkdtemp(prefix='weather-tests-')
+synthetic_recording(RECORDINGS)
+
+stub = StubServer(replay.routes(RECORDINGS)).start()
+
+os.environ.update(replay.env(stub.url))
+os.environ.update({'HistoryFile': '', 'GeoCacheFile': '', 'GazetteerFile': ''})
@@ -0,0 +1,107 @@
+# Flask app tests: the results page and JSON API against the stub providers (see conftest.py)
+import json
+
+import pytest
+
+import aggregation  # Module for averaging provider readings
+import app
+import page_cache  # Module for caching rendered results pages
+import quota  # Module for per-provider upstream request quotas
+
+
+# Geocoding result for the recorded London lookup
+LONDON = {'name': 'London', 'country_code': 'GB', 'latitude': '51.50853', 'longitude': '-0.12574',
+          'location_id': 2643743, 'timezone': 'Europe/London'}
+
+
+@pytest.fixture
+def client():
+
+    app.geo_cache.clear()
+    page_cache.pages.clear()
+
+    return app.app.test_client()
+
+
+@pytest.fixture
+def geonames_used_up(monkeypatch):
+
+    # A GeoNames quota with no tokens left, refilling far slower than any caller will wait
+    empty = quota.Quota('GeoNames', 0.001, 1)
+    empty.tokens = 0.0
+    monkeypatch.setitem(quota.quotas, 'GeoNames', empty)
+
+
+def test_results_page(client):
+
+    response = client.get('/results?townName=London&countryCode=GB')
+
+    assert response.status_code == 200
+    assert 'London, GB' in response.get_data(as_text=True)
+
+
+def test_invalid_town(client):
+
+    response = client.get('/results?townName=L0nd0n&countryCode=GB')
+
+    assert response.status_code == 200
+    assert 'Please enter a valid location' in response.get_data(as_text=True)
+
+
+def test_geonames_quota_used_up(client, geonames_used_up):
+
+    # The search page comes back with a "try again" message instead of an error
+    response = client.get('/results?townName=Paris&countryCode=FR')
+
+    assert response.status_code == 503
+    assert 'Please try again in a minute' in response.get_data(as_text=True)
+
+
+def test_geonames_quota_used_up_api(client, geonames_used_up):
+
+    # Each query that needs GeoNames gets its own error, the rest of the batch still works
+    app.geo_cache.set(app.geo_coder_key('London', 'GB'), LONDON)
+
+    response = client.post('/api/v1/weather', json={'locations': [
+        {'town': 'Paris', 'country_code': 'FR'},
+        {'town': 'London', 'country_code': 'GB'},
+        {'latitude': 48.85, 'longitude': 2.35}
+    ]})
+
+    lines = {line['index']: line for line in map(json.loads, response.get_data(as_text=True).splitlines())}
+
+    assert response.status_code == 200
+    assert lines[0]['error'] == 'Geocoding is busy, try again shortly'
+    assert lines[1]['data']['location_name'] == 'London, GB'
+    assert lines[2]['error'] == 'Geocoding is busy, try again shortly'
+
+
+def test_reverse_geocode_bad_reply(client):
+
+    # The stub has no recording for findNearbyPlaceNameJSON, so GeoNames answers 404 with a plain text body
+    response = client.post('/api/v1/weather', json={'locations': [{'latitude': 48.85, 'longitude': 2.35}]})
+
+    assert json.loads(response.get_data(as_text=True))['error'] == 'Location not found'
+
+
+def test_reverse_geocode_keeps_each_lookups_coordinates(client):
+
+    # Lookups rounding to the same cached place still get their own coordinates back
+    app.geo_cache.set(('@51.509,-0.126', ''), LONDON)
+
+    first = app.reverse_geo_coder(51.5091, -0.1258)
+    second = app.reverse_geo_coder('51.5094', '-0.1262')
+
+    assert (first['name'], first['latitude'], first['longitude']) == ('London', '51.5091', '-0.1258')
+    assert (second['name'], second['latitude'], second['longitude']) == ('London', '51.5094', '-0.1262')
+
+
+def test_no_provider_answers(client, monkeypatch):
+
+    # Every provider skipped: the search page says so instead of a bare error
+    monkeypatch.setattr(app, 'skipped_providers', lambda GEO_CODER_DATA: set(aggregation.PROVIDERS))
+
+    response = client.get('/results?townName=London&countryCode=GB')
+
+    assert response.status_code == 503
+    assert app.UNAVAILABLE_MESSAGE.replace("'", '&#39;') in response.get_data(as_text=True)
@@ -0,0 +1,99 @@
+# ASGI server tests: the results page handled on the event loop, against the stub providers (see conftest.py)
+import asyncio
+
+import pytest
+
+import aggregation  # Module for averaging provider readings
+import app
+import asgi
+import page_cache  # Module for caching rendered results pages
+import quota  # Module for per-provider upstream request quotas
+
+
+def get(path, query='', headers=()):
+
+    # Runs one GET request through the ASGI application, returns (status, headers, body text)
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+             'headers': [(name.encode(), value.encode()) for name, value in headers]}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        try:
+            await asgi.application(scope, receive, send)
+        finally:
+            if asgi.session is not None:
+                await asgi.session.close()
+                asgi.session = None
+
+    asyncio.run(run())
+
+    start = messages[0]
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+
+    return start['status'], {name.decode(): value.decode() for name, value in start['headers']}, body.decode()
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+
+    app.geo_cache.clear()
+    page_cache.pages.clear()
+
+
+def test_geonames_quota_used_up(monkeypatch):
+
+    empty = quota.Quota('GeoNames', 0.001, 1)
+    empty.tokens = 0.0
+    monkeypatch.setitem(quota.quotas, 'GeoNames', empty)
+
+    status, headers, body = get('/results', 'townName=Paris&countryCode=FR')
+
+    assert status == 503
+    assert 'Please try again in a minute' in body
+
+
+def test_results_page():
+
+    status, headers, body = get('/results', 'townName=London&countryCode=GB')
+
+    assert status == 200
+    assert 'London, GB' in body
+    assert 'Sources: OpenWeather, MetOffice, BBCWeather, YrNo' in body
+
+
+def test_results_page_revalidated():
+
+    # A repeat lookup with the page's ETag gets 304 Not Modified from the page cache
+    status, headers, body = get('/results', 'townName=London&countryCode=GB')
+    status, _, body = get('/results', 'townName=London&countryCode=GB', [('If-None-Match', headers['etag'])])
+
+    assert status == 304
+    assert body == ''
+
+
+def test_streamed_results_page():
+
+    status, headers, body = get('/results', 'townName=London&countryCode=GB&stream=1')
+
+    assert status == 200
+    assert headers['cache-control'] == 'no-cache'
+    assert body.count('London, GB') >= 1
+    assert body.rstrip().endswith('</html>')
+    assert page_cache.get(app.geo_coder('London', 'GB')) is not None
+
+
+def test_no_provider_answers(monkeypatch):
+
+    # Every provider skipped: the search page says so instead of a bare error
+    monkeypatch.setattr(app, 'skipped_providers', lambda GEO_CODER_DATA: set(aggregation.PROVIDERS))
+
+    status, headers, body = get('/results', 'townName=London&countryCode=GB')
+
+    assert status == 503
+    assert app.UNAVAILABLE_MESSAGE.replace("'", '&#39;') in body
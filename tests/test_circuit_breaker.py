@@ -0,0 +1,121 @@
+# Circuit breaker tests: opening on errors and slow calls, the cool-down, and the half-open trial call
+import pytest
+
+import circuit_breaker  # Module for per-provider circuit breakers
+
+
+def fail():
+
+    raise Exception('Upstream error')
+
+
+def succeed():
+
+    return 'ok'
+
+
+@pytest.fixture
+def breaker():
+
+    return circuit_breaker.CircuitBreaker('Test', window_size=10, min_calls=4, failure_threshold=0.5,
+                                          slow_call_seconds=1, cool_down=60)
+
+
+def open_breaker(breaker):
+
+    for _ in range(4):
+        with pytest.raises(Exception, match='Upstream error'):
+            breaker.call(fail)
+
+
+def cool_down(breaker):
+
+    breaker.opened_at -= breaker.cool_down
+
+
+def test_closed(breaker):
+
+    assert breaker.call(succeed) == 'ok'
+    assert breaker.stats() == {'state': circuit_breaker.CLOSED, 'calls': 1, 'error_rate': 0.0,
+                               'median_latency': 0.0}
+
+
+def test_min_calls(breaker):
+
+    # Three failures aren't enough to judge the provider
+    for _ in range(3):
+        with pytest.raises(Exception):
+            breaker.call(fail)
+
+    assert breaker.state == circuit_breaker.CLOSED
+
+
+def test_opens_on_errors(breaker):
+
+    breaker.call(succeed)
+    for _ in range(3):
+        with pytest.raises(Exception, match='Upstream error'):
+            breaker.call(fail)
+
+    assert breaker.state == circuit_breaker.OPEN
+    with pytest.raises(circuit_breaker.CircuitOpenError):
+        breaker.call(succeed)
+
+
+def test_stays_closed_below_threshold(breaker):
+
+    for function in (succeed, succeed, fail, succeed, succeed, fail):
+        try:
+            breaker.call(function)
+        except Exception:
+            pass
+
+    assert breaker.state == circuit_breaker.CLOSED
+    assert breaker.stats()['error_rate'] == 0.333
+
+
+def test_slow_calls_count_as_failures(breaker):
+
+    for _ in range(4):
+        breaker.record(True, 2.0)
+
+    assert breaker.state == circuit_breaker.OPEN
+
+
+def test_half_open_trial_closes(breaker):
+
+    open_breaker(breaker)
+    cool_down(breaker)
+
+    assert breaker.allow()
+    assert breaker.state == circuit_breaker.HALF_OPEN
+
+    # Only one trial call at a time
+    assert not breaker.allow()
+
+    breaker.record(True, 0.1)
+
+    assert breaker.state == circuit_breaker.CLOSED
+    assert breaker.stats()['calls'] == 0
+    assert breaker.call(succeed) == 'ok'
+
+
+def test_half_open_trial_reopens(breaker):
+
+    open_breaker(breaker)
+    cool_down(breaker)
+
+    with pytest.raises(Exception, match='Upstream error'):
+        breaker.call(fail)
+
+    assert breaker.state == circuit_breaker.OPEN
+    with pytest.raises(circuit_breaker.CircuitOpenError):
+        breaker.call(succeed)
+
+
+def test_one_breaker_per_provider(monkeypatch):
+
+    monkeypatch.setattr(circuit_breaker, 'breakers', {})
+
+    assert circuit_breaker.get('Met Office') is circuit_breaker.get('Met Office')
+    assert circuit_breaker.get('Met Office') is not circuit_breaker.get('BBC')
@@ -0,0 +1,115 @@
+# Fan-out tests: provider calls against a local stub server with fast, slow and failing routes
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import time
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fanout  # Module for running provider fetches in parallel
+from stub_server import StubServer  # Module for the local stub upstream server
+
+ROUTES = {
+    '/fast': (200, 'text/plain', b'fast'),
+    '/slow': (200, 'text/plain', b'slow'),
+    '/fail': (500, 'text/plain', b'Internal Server Error')
+}
+
+DELAYS = {'/slow': 1.0}
+
+
+@pytest.fixture(scope='module')
+def stub():
+
+    with StubServer(ROUTES, DELAYS) as server:
+        yield server
+
+
+def fetch(url):
+
+    response = requests.get(url, timeout=5)
+    response.raise_for_status()
+
+    return response.text
+
+
+def test_partial_results(stub):
+
+    # The fast provider's answer comes back, the failing one's error is passed on, the slow one times out
+    calls = {
+        'Fast': (fetch, (stub.url + '/fast',)),
+        'Failing': (fetch, (stub.url + '/fail',)),
+        'Slow': (fetch, (stub.url + '/slow',))
+    }
+
+    start = time.monotonic()
+    results, errors = fanout.fan_out(calls, provider_timeouts={'Slow': 0.3})
+    elapsed = time.monotonic() - start
+
+    assert results == {'Fast': 'fast'}
+    assert isinstance(errors['Failing'], requests.HTTPError)
+    assert isinstance(errors['Slow'], TimeoutError)
+    assert elapsed < 0.9
+
+
+def test_provider_timeout(stub):
+
+    # Each provider gets its own timeout
+    calls = {
+        'Patient': (fetch, (stub.url + '/slow',)),
+        'Impatient': (fetch, (stub.url + '/slow',))
+    }
+
+    results, errors = fanout.fan_out(calls, provider_timeouts={'Patient': 3, 'Impatient': 0.3})
+
+    assert results == {'Patient': 'slow'}
+    assert str(errors['Impatient']) == "Impatient did not respond within 0.3 seconds."
+
+
+def test_overall_deadline(stub):
+
+    # The overall deadline cuts off providers whose own timeout is longer
+    calls = {
+        'Fast': (fetch, (stub.url + '/fast',)),
+        'Slow': (fetch, (stub.url + '/slow',))
+    }
+
+    start = time.monotonic()
+    results, errors = fanout.fan_out(calls, provider_timeouts={'Slow': 5}, deadline=0.3)
+    elapsed = time.monotonic() - start
+
+    assert results == {'Fast': 'fast'}
+    assert isinstance(errors['Slow'], TimeoutError)
+    assert elapsed < 0.9
+
+
+def test_as_completed_order(stub):
+
+    # Providers are yielded as they answer, not in the order they were given
+    calls = {
+        'Slow': (fetch, (stub.url + '/slow',)),
+        'Fast': (fetch, (stub.url + '/fast',))
+    }
+
+    names = [name for name, result, error in fanout.as_completed(calls, provider_timeouts={'Slow': 3})]
+
+    assert names == ['Fast', 'Slow']
+
+
+def test_queued_call_timeout_starts_when_it_runs(stub, monkeypatch):
+
+    # With one worker the second call waits for the first; its timeout only counts once it starts running
+    monkeypatch.setattr(fanout, 'executor', ThreadPoolExecutor(max_workers=1))
+
+    calls = {
+        'First': (fetch, (stub.url + '/slow',)),
+        'Second': (fetch, (stub.url + '/fast',))
+    }
+
+    results, errors = fanout.fan_out(calls, provider_timeouts={'First': 3, 'Second': 0.5})
+
+    assert results == {'First': 'slow', 'Second': 'fast'}
+    assert errors == {}
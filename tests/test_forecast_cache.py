@@ -0,0 +1,121 @@
+# Forecast cache tests: stale entries, background refreshes and time buckets, with a local provider function
+import logging
+import time
+
+import pytest
+
+import forecast_cache  # Module for caching provider results per location and time bucket
+import metrics  # Module for latency histograms and counters
+
+
+def wait_for_refreshes(provider, timeout=5):
+
+    # Background refreshes run on the forecast cache's own pool
+    end = time.monotonic() + timeout
+    while provider.refreshing and time.monotonic() < end:
+        time.sleep(0.01)
+
+
+@pytest.fixture(autouse=True)
+def clear_store():
+
+    forecast_cache.forecast_store.clear()
+
+
+def make_provider(function, ttl=60, bucket_seconds=3600):
+
+    function.__name__ = f'TestProvider{id(function)}'
+
+    return forecast_cache.CachedProvider(function, ttl, bucket_seconds)
+
+
+def test_miss_then_hit():
+
+    calls = []
+
+    def forecast(location_id):
+        calls.append(location_id)
+        return {'temperature': 12.0}
+
+    provider = make_provider(forecast)
+
+    assert provider(2643743) == {'temperature': 12.0}
+    assert provider('2643743') == {'temperature': 12.0}
+    assert calls == [2643743]
+
+
+def test_stale_entry_served_while_refreshing():
+
+    values = iter([{'temperature': 12.0}, {'temperature': 13.0}])
+
+    provider = make_provider(lambda location_id: next(values), ttl=0)
+
+    assert provider(1) == {'temperature': 12.0}
+
+    # Past the TTL: the stale copy comes back straight away, the refreshed one on the next lookup
+    assert provider(1) == {'temperature': 12.0}
+    wait_for_refreshes(provider)
+    assert provider(1) == {'temperature': 13.0}
+
+
+def test_failed_background_refresh_is_logged_and_counted(caplog):
+
+    def forecast(location_id):
+        if forecast.failing:
+            raise ValueError('bad page')
+        return {'temperature': 12.0}
+
+    forecast.failing = False
+    provider = make_provider(forecast, ttl=0)
+    provider(1)
+
+    forecast.failing = True
+    with caplog.at_level(logging.WARNING, logger='weather'):
+        assert provider(1) == {'temperature': 12.0}
+        wait_for_refreshes(provider)
+
+    assert f'background_refresh_failed provider={provider.name} error="bad page"' in caplog.text
+    assert f'weather_background_refresh_failures_total{{error="ValueError",provider="{provider.name}"}} 1' in metrics.render()
+
+
+class Clock:
+
+    # Stands in for the time module in forecast_cache
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def test_fetch_stored_under_the_bucket_looked_up(monkeypatch):
+
+    # A fetch that starts near the end of a time bucket fills the entry that was looked up
+    clock = Clock(3599.0)
+    monkeypatch.setattr(forecast_cache, 'time', clock)
+
+    def forecast(location_id):
+        clock.now = 3599.5
+        return {'temperature': 12.0}
+
+    provider = make_provider(forecast, bucket_seconds=3600)
+    provider(1)
+
+    assert forecast_cache.forecast_store.get((provider.name, '1', 0)) is not None
+    assert forecast_cache.forecast_store.get((provider.name, '1', 1)) is None
+
+
+def test_fetch_after_the_bucket_ends_stored_under_the_next(monkeypatch):
+
+    # The bucket looked up is over by the time the answer comes back, so it's kept for the current one
+    clock = Clock(3599.0)
+    monkeypatch.setattr(forecast_cache, 'time', clock)
+
+    def forecast(location_id):
+        clock.now = 3601.0
+        return {'temperature': 12.0}
+
+    provider = make_provider(forecast, bucket_seconds=3600)
+    provider(1)
+
+    assert forecast_cache.forecast_store.get((provider.name, '1', 1)) is not None
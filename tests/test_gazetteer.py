@@ -0,0 +1,105 @@
+# Gazetteer tests: exact, alternate-name, fuzzy and type-ahead lookups in an index built from a small GeoNames dump
+import pytest
+
+import gazetteer  # Module for offline town lookups
+
+# geonameid, name, asciiname, alternatenames, latitude, longitude, country_code, population, timezone
+PLACES = [
+    (2643743, 'London', 'London', 'Londres,Londra,Lundun', 51.50853, -0.12574, 'GB', 8961989, 'Europe/London'),
+    (6058560, 'London', 'London', '', 42.98339, -81.23304, 'CA', 346765, 'America/Toronto'),
+    (2643741, 'City of London', 'City of London', '', 51.51279, -0.09184, 'GB', 8071, 'Europe/London'),
+    (2644210, 'Liverpool', 'Liverpool', 'Lerpwl', 53.41058, -2.97794, 'GB', 864122, 'Europe/London'),
+    (2980291, 'Saint-Étienne', 'Saint-Etienne', '', 45.43389, 4.39, 'FR', 176280, 'Europe/Paris'),
+    (2988507, 'Paris', 'Paris', 'Parigi', 48.85341, 2.3488, 'FR', 2138551, 'Europe/Paris')
+]
+
+
+def dump_line(location_id, name, ascii_name, alternate_names, latitude, longitude, country_code, population,
+              timezone):
+
+    columns = [''] * 19
+    columns[0:6] = [str(location_id), name, ascii_name, alternate_names, str(latitude), str(longitude)]
+    columns[8] = country_code
+    columns[14] = str(population)
+    columns[17] = timezone
+
+    return '\t'.join(columns) + '\n'
+
+
+@pytest.fixture(scope='module')
+def index(tmp_path_factory):
+
+    directory = tmp_path_factory.mktemp('gazetteer')
+    dump_path = directory / 'cities.txt'
+    dump_path.write_text(''.join(dump_line(*place) for place in PLACES), encoding='utf-8')
+
+    gazetteer.build(dump_path, directory / 'gazetteer.idx')
+
+    return gazetteer.Gazetteer(directory / 'gazetteer.idx')
+
+
+def test_normalise():
+
+    assert gazetteer.normalise('Saint-Étienne') == 'saint etienne'
+    assert gazetteer.normalise('  NEW   york ') == 'new york'
+
+
+def test_edit_distance():
+
+    assert gazetteer.edit_distance('london', 'london', 2) == 0
+    assert gazetteer.edit_distance('london', 'lodnon', 2) == 1
+    assert gazetteer.edit_distance('london', 'paris', 2) == 3
+
+
+def test_exact(index):
+
+    place = index.search('london', 'GB')
+
+    assert place == {'name': 'London', 'country_code': 'GB', 'latitude': '51.50853', 'longitude': '-0.12574',
+                     'location_id': 2643743, 'timezone': 'Europe/London'}
+    assert index.search('London', 'CA')['location_id'] == 6058560
+
+
+def test_most_populous_without_country(index):
+
+    assert index.search('London', '')['location_id'] == 2643743
+
+
+def test_accents(index):
+
+    assert index.search('saint etienne', 'FR')['name'] == 'Saint-Étienne'
+
+
+def test_alternate_name(index):
+
+    assert index.search('Londres', 'GB')['location_id'] == 2643743
+    assert index.search('Lerpwl', 'gb')['name'] == 'Liverpool'
+
+
+def test_fuzzy(index):
+
+    assert index.search('Lndon', 'GB')['location_id'] == 2643743
+    assert index.search('Liverpoool', 'GB')['name'] == 'Liverpool'
+
+
+def test_no_match(index):
+
+    assert index.search('Lndon', 'FR') is None
+    assert index.search('Manchester', 'GB') is None
+    assert index.search('--', 'GB') is None
+
+
+def test_suggest(index):
+
+    assert [place['location_id'] for place in index.suggest('lon')] == [2643743, 6058560]
+    assert [place['name'] for place in index.suggest('Li', 'GB')] == ['Liverpool']
+    assert index.suggest('l') == []
+
+
+def test_not_an_index(tmp_path):
+
+    path = tmp_path / 'gazetteer.idx'
+    path.write_bytes(b'nope' + bytes(64))
+
+    with pytest.raises(Exception):
+        gazetteer.Gazetteer(path)
@@ -0,0 +1,140 @@
+# Hedged request tests: hedge delay, hedge budget, and which call wins (sync and async)
+import asyncio
+import threading
+import time
+
+import pytest
+
+import hedging  # Module for hedging slow upstream calls with a second request
+import metrics  # Module for latency histograms and counters
+import quota  # Module for per-provider upstream request quotas
+
+NAME = 'TestHedged'
+
+
+def count(outcome):
+
+    return metrics.values.get(metrics.label_key('weather_hedged_calls_total', {'provider': NAME, 'outcome': outcome}), 0)
+
+
+@pytest.fixture
+def hedger(monkeypatch):
+
+    # A hedged provider that usually answers in 10 ms, with a hedge saved up
+    hedger = hedging.Hedger(NAME)
+    for _ in range(hedging.MIN_SAMPLES):
+        hedger.record(0.01)
+    hedger.credit = 1.0
+
+    monkeypatch.setitem(hedging.hedgers, NAME, hedger)
+    monkeypatch.setattr(hedging, 'hedged', {NAME})
+
+    return hedger
+
+
+def slow_then_fast():
+
+    # The first call stalls, any later call answers straight away
+    calls = []
+
+    def function():
+        calls.append(threading.current_thread())
+        if len(calls) == 1:
+            time.sleep(1)
+            return 'first'
+        return 'second'
+
+    return function, calls
+
+
+def test_threshold():
+
+    latencies = [index / 100 for index in range(1, 101)]
+
+    assert hedging.threshold(latencies, 95) == 0.95
+    assert hedging.threshold([0.001] * 20, 95) == hedging.MIN_DELAY
+
+
+def test_no_hedge_until_enough_samples():
+
+    hedger = hedging.Hedger('OpenWeather')
+    for _ in range(hedging.MIN_SAMPLES - 1):
+        hedger.record(0.01)
+
+    assert hedger.delay() is None
+
+    hedger.record(0.01)
+
+    assert hedger.delay() == hedging.MIN_DELAY
+
+
+def test_budget_earned_per_call():
+
+    hedger = hedging.Hedger('OpenWeather', budget=0.25, max_credit=2)
+    for _ in range(20):
+        hedger.delay()
+
+    assert hedger.credit == 2
+
+
+def test_slow_call_hedged(hedger):
+
+    function, calls = slow_then_fast()
+    won = count('won')
+
+    start = time.monotonic()
+    result = hedging.call(NAME, function)
+
+    assert result == 'second'
+    assert time.monotonic() - start < 0.5
+    assert len(calls) == 2
+    assert count('won') == won + 1
+    assert hedger.credit < 1
+
+
+def test_no_hedge_without_budget(hedger):
+
+    hedger.credit = 0.0
+    function, calls = slow_then_fast()
+    no_budget = count('no_budget')
+
+    assert hedging.call(NAME, function) == 'first'
+    assert len(calls) == 1
+    assert count('no_budget') == no_budget + 1
+
+
+def test_background_calls_not_hedged(hedger):
+
+    # Run in the caller's thread as a plain call, however slow
+    function, calls = slow_then_fast()
+
+    with quota.background():
+        assert hedging.call(NAME, function) == 'first'
+
+    assert calls == [threading.current_thread()]
+    assert hedger.credit == 1.0
+
+
+def test_async_loser_cancelled(hedger):
+
+    cancelled = []
+    calls = []
+
+    async def function():
+        calls.append(None)
+        if len(calls) == 1:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+            return 'first'
+        return 'second'
+
+    async def run():
+        result = await hedging.call_async(NAME, function)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == 'second'
+    assert cancelled == [True]
@@ -0,0 +1,84 @@
+# Page cache tests: rendering into the cache, validators and conditional requests
+from email.utils import formatdate
+
+import pytest
+
+import app
+import page_cache  # Module for caching rendered results pages
+import records  # Module containing the typed provider reading / weather report records
+
+LONDON = {'name': 'London', 'country_code': 'GB', 'latitude': '51.50853', 'longitude': '-0.12574',
+          'location_id': 2643743, 'timezone': 'Europe/London'}
+
+
+@pytest.fixture
+def page():
+
+    page_cache.pages.clear()
+
+    report = records.Report(timestamp=0.0, latitude=51.50853, longitude=-0.12574, location_id=2643743,
+                            location_name='London, GB', temperature=11.5, sources=('OpenWeather',))
+
+    with app.app.app_context():
+        return page_cache.render(LONDON, report)
+
+
+def test_render_caches_page(page):
+
+    assert page_cache.get(LONDON) is page
+    assert 'London, GB' in page.html
+
+
+def test_clock_filled_in_by_browser(page):
+
+    # The render time is only a fallback, the browser replaces it with its own date and time
+    assert '<span id="current-time">' in page.html
+    assert "getElementById('current-time').textContent" in page.html
+
+
+def test_headers(page):
+
+    headers = dict(page_cache.headers(page))
+
+    assert headers['ETag'] == page.etag
+    assert headers['Last-Modified'] == formatdate(page.last_modified, usegmt=True)
+    assert headers['Cache-Control'].startswith('private, max-age=')
+    assert 0 <= int(headers['Cache-Control'].split('=')[1]) <= page_cache.PAGE_TTL
+
+
+def test_if_none_match(page):
+
+    assert page_cache.not_modified(page, if_none_match=page.etag)
+    assert page_cache.not_modified(page, if_none_match=f'"other", W/{page.etag}')
+    assert page_cache.not_modified(page, if_none_match='*')
+    assert not page_cache.not_modified(page, if_none_match='"other"')
+
+
+def test_if_modified_since(page):
+
+    assert page_cache.not_modified(page, if_modified_since=formatdate(page.last_modified, usegmt=True))
+    assert page_cache.not_modified(page, if_modified_since=formatdate(page.last_modified + 60, usegmt=True))
+    assert not page_cache.not_modified(page, if_modified_since=formatdate(page.last_modified - 60, usegmt=True))
+    assert not page_cache.not_modified(page, if_modified_since='not a date')
+
+
+def test_if_none_match_wins(page):
+
+    # An ETag that doesn't match means a new copy, even if the date would say otherwise
+    later = formatdate(page.last_modified + 60, usegmt=True)
+
+    assert not page_cache.not_modified(page, if_none_match='"other"', if_modified_since=later)
+
+
+def test_results_page_revalidated():
+
+    page_cache.pages.clear()
+    client = app.app.test_client()
+
+    response = client.get('/results?townName=London&countryCode=GB')
+    revalidated = client.get('/results?townName=London&countryCode=GB',
+                             headers={'If-Modified-Since': response.headers['Last-Modified']})
+
+    assert response.status_code == 200
+    assert revalidated.status_code == 304
+    assert revalidated.headers['ETag'] == response.headers['ETag']
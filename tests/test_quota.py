@@ -0,0 +1,158 @@
+# Upstream quota tests: token buckets, daily budgets, priorities, and taking a token without waiting
+import time
+
+import pytest
+
+import metrics  # Module for latency histograms and counters
+import quota  # Module for per-provider upstream request quotas
+
+NAME = 'TestQuota'
+
+
+def rejected(reason, priority=quota.INTERACTIVE):
+
+    key = metrics.label_key('weather_quota_rejected_total', {'provider': NAME, 'priority': priority, 'reason': reason})
+
+    return metrics.values.get(key, 0)
+
+
+@pytest.fixture
+def provider_quota(monkeypatch):
+
+    # One request a second, bursts of 10, 100 a day
+    provider_quota = quota.Quota(NAME, 1.0, 10, 100)
+    monkeypatch.setitem(quota.quotas, NAME, provider_quota)
+
+    return provider_quota
+
+
+def drain(provider_quota, tokens=0.0):
+
+    provider_quota.tokens = tokens
+    provider_quota.updated = time.monotonic()
+
+
+def test_burst_then_queue(provider_quota):
+
+    deadline = time.monotonic() + 5
+    waits = [provider_quota.reserve(quota.INTERACTIVE, deadline) for _ in range(12)]
+
+    # The burst goes straight through, then interactive calls queue a second apart
+    assert all(wait == (True, 0.0) for wait in waits[:10])
+    assert [round(wait, 1) for _, wait in waits[10:]] == [1.0, 2.0]
+
+
+def test_deadline(provider_quota):
+
+    drain(provider_quota)
+    before = rejected('deadline')
+
+    with pytest.raises(quota.QuotaExceededError):
+        provider_quota.reserve(quota.INTERACTIVE, time.monotonic() + 0.5)
+
+    assert rejected('deadline') == before + 1
+    assert provider_quota.tokens < 0.01
+
+
+def test_refill(provider_quota):
+
+    drain(provider_quota)
+    provider_quota.updated -= 3
+
+    assert provider_quota.stats()['tokens'] == pytest.approx(3, abs=0.01)
+
+    provider_quota.updated -= 60
+
+    assert provider_quota.stats()['tokens'] == 10
+
+
+def test_background_leaves_reserve(provider_quota):
+
+    # Background calls stop at 20% of the burst, and come back when a token beyond it should be free
+    deadline = time.monotonic() + 60
+    taken = 0
+    while provider_quota.reserve(quota.BACKGROUND, deadline)[0]:
+        taken += 1
+
+    assert taken == 8
+    assert provider_quota.reserve(quota.BACKGROUND, deadline) == (False, pytest.approx(1.0, abs=0.01))
+    assert provider_quota.reserve(quota.INTERACTIVE, deadline) == (True, 0.0)
+
+
+def test_daily_budget(provider_quota):
+
+    provider_quota.used_today = 80
+
+    # Background calls leave the last 20% of the day's budget for lookups
+    with pytest.raises(quota.QuotaExceededError):
+        provider_quota.reserve(quota.BACKGROUND, time.monotonic() + 60)
+
+    provider_quota.used_today = 99
+    provider_quota.reserve(quota.INTERACTIVE, time.monotonic() + 5)
+
+    with pytest.raises(quota.QuotaExceededError):
+        provider_quota.reserve(quota.INTERACTIVE, time.monotonic() + 5)
+
+    assert rejected('daily') >= 1
+    assert quota.remaining_today(NAME) == 0
+
+
+def test_daily_budget_resets(provider_quota):
+
+    provider_quota.used_today = 100
+    provider_quota.day -= 1
+
+    assert quota.remaining_today(NAME) == 100
+    assert quota.remaining_today(NAME, quota.BACKGROUND) == 80
+
+
+def test_try_take(provider_quota):
+
+    drain(provider_quota, 1.5)
+
+    assert quota.try_acquire(NAME)
+    assert not quota.try_acquire(NAME)
+    assert provider_quota.used_today == 1
+
+
+def test_try_take_not_counted_as_rejection(provider_quota):
+
+    # Declining to take a token isn't a refused call
+    drain(provider_quota)
+    before = rejected('deadline'), rejected('daily')
+
+    assert not quota.try_acquire(NAME)
+
+    provider_quota.used_today = 100
+    drain(provider_quota, 10)
+
+    assert not quota.try_acquire(NAME)
+    assert (rejected('deadline'), rejected('daily')) == before
+
+
+def test_try_take_background_reserve(provider_quota):
+
+    drain(provider_quota, 2.5)
+
+    with quota.background():
+        assert not quota.try_acquire(NAME)
+
+    assert quota.try_acquire(NAME)
+
+
+def test_unlimited_provider():
+
+    quota.acquire('NotLimited')
+
+    assert quota.try_acquire('NotLimited')
+    assert quota.remaining_today('NotLimited') is None
+
+
+def test_acquire_waits(provider_quota):
+
+    drain(provider_quota, 0.8)
+
+    start = time.monotonic()
+    quota.acquire(NAME)
+
+    assert 0.1 < time.monotonic() - start < 0.5
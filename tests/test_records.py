@@ -0,0 +1,102 @@
+# Record tests: packing readings and reports for the caches, parsing provider values, and formatting for display
+from dataclasses import astuple
+import math
+
+import pytest
+
+import conditions  # Module containing the weather condition table
+import records  # Module for compact provider readings and weather reports
+
+REPORT = records.Report(
+    timestamp=1700000000.0, latitude=51.50853, longitude=-0.12574, location_id=2643743, location_name='London',
+    temperature=11.25, feels_like=9.0, wind_speed=12.0, rain_chance=30.0, humidity=81.0, uv_index=2.0,
+    weather_code=7, wind_desc='Gentle breeze', sunrise='07:02', sunset='16:21', moon_phase='Waxing Crescent',
+    sources=('Met Office', 'BBC')
+)
+
+
+def same(first, second):
+
+    # Records compare equal field by field, with missing (NaN) values equal to each other
+    assert type(first) is type(second)
+    for first_value, second_value in zip(astuple(first), astuple(second)):
+        if isinstance(first_value, float) and math.isnan(first_value):
+            assert math.isnan(second_value)
+        else:
+            assert first_value == second_value
+
+
+@pytest.mark.parametrize('record', [
+    REPORT,
+    records.Report(0.0, 0.0, 0.0, 0, ''),
+    records.Reading(temperature=-3.5, weather_code=12, wind_desc='Calm'),
+    records.NO_READING
+])
+def test_round_trip(record):
+
+    same(records.unpack(records.pack(record)), record)
+
+
+def test_missing_values_kept():
+
+    unpacked = records.unpack(records.pack(REPORT))
+
+    assert math.isnan(unpacked.gust_speed)
+    assert math.isnan(unpacked.snow_amount)
+    assert unpacked.sources == ('Met Office', 'BBC')
+
+
+def test_unicode_text():
+
+    report = records.Report(0.0, 45.43389, 4.39, 2980291, 'Saint-Étienne', sources=('Météo',))
+
+    same(records.unpack(records.pack(report)), report)
+
+
+def test_packed_size():
+
+    # A reading is one struct plus a short text field
+    assert len(records.pack(records.NO_READING)) < 100
+
+
+@pytest.mark.parametrize('value, expected', [(12, 12.0), ('12°', 12.0), ('81%', 81.0), (' 4.5 ', 4.5)])
+def test_number(value, expected):
+
+    assert records.number(value) == expected
+
+
+@pytest.mark.parametrize('value', [None, '', 'N/A', 'light'])
+def test_number_missing(value):
+
+    assert math.isnan(records.number(value))
+
+
+@pytest.mark.parametrize('value, expected', [(11.25, '11.2'), (9.0, '9'), (-0.04, '0'), (math.nan, 'N/A'),
+                                             (None, 'N/A')])
+def test_format_variable(value, expected):
+
+    assert records.format_variable(value) == expected
+
+
+def test_display():
+
+    fields = records.display(REPORT)
+
+    assert fields['location_id'] == '2643743'
+    assert fields['temperature'] == '11.2'
+    assert fields['gust_speed'] == 'N/A'
+    assert fields['snow_condition_flag'] == 0
+    assert fields['weather_desc'] == conditions.condition(7).description
+    assert fields['uv_index_desc'] == conditions.uv_band(2.0)
+    assert fields['moon_emoji'] == conditions.MOON_EMOJI['Waxing Crescent']
+    assert fields['sources'] == ['Met Office', 'BBC']
+
+
+def test_display_missing():
+
+    fields = records.display(records.Report(1700000000.0, 0.0, 0.0, 0, 'Nowhere'))
+
+    assert fields['temperature'] == 'N/A'
+    assert fields['wind_desc'] == 'Not available'
+    assert fields['uv_index_desc'] == 'Not available'
+    assert fields['weather_desc'] == conditions.NOT_AVAILABLE.description
@@ -0,0 +1,145 @@
+# Single-flight tests: overlapping identical calls share one upstream call, its result and its exception
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+import time
+
+import pytest
+
+import single_flight  # Module for coalescing identical upstream calls
+
+
+@pytest.fixture(autouse=True)
+def counts(monkeypatch):
+
+    monkeypatch.setattr(single_flight, 'counts', {})
+
+
+class Upstream:
+
+    # Records calls, and holds each one until released so the others overlap it
+    def __init__(self, result='forecast'):
+
+        self.calls = 0
+        self.result = result
+        self.release = threading.Event()
+
+    def fetch(self, *args):
+
+        self.calls += 1
+        self.release.wait(5)
+        if isinstance(self.result, Exception):
+            raise self.result
+
+        return self.result
+
+
+def overlap(group, upstream, keys):
+
+    # Start a call per key, let them all reach the group, then release the upstream call(s)
+    with ThreadPoolExecutor(len(keys)) as pool:
+        futures = [pool.submit(group.do, key, upstream.fetch) for key in keys]
+        time.sleep(0.2)
+        upstream.release.set()
+
+        return [future.exception() or future.result() for future in futures]
+
+
+def test_coalesced():
+
+    upstream = Upstream()
+    results = overlap(single_flight.SingleFlight(), upstream, [('Met Office', 'London')] * 8)
+
+    assert results == ['forecast'] * 8
+    assert upstream.calls == 1
+    assert single_flight.stats() == {'Met Office': {'upstream': 1, 'coalesced': 7, 'coalesced_ratio': 0.875}}
+
+
+def test_different_keys():
+
+    upstream = Upstream()
+    results = overlap(single_flight.SingleFlight(), upstream, [('Met Office', 'London'), ('Met Office', 'Paris')])
+
+    assert results == ['forecast'] * 2
+    assert upstream.calls == 2
+
+
+def test_exception_shared():
+
+    error = Exception('Upstream error')
+    upstream = Upstream(error)
+
+    assert overlap(single_flight.SingleFlight(), upstream, [('BBC', 'London')] * 4) == [error] * 4
+    assert upstream.calls == 1
+
+
+def test_later_calls_go_upstream():
+
+    group = single_flight.SingleFlight()
+    upstream = Upstream()
+    upstream.release.set()
+
+    group.do(('BBC', 'London'), upstream.fetch)
+    group.do(('BBC', 'London'), upstream.fetch)
+
+    assert upstream.calls == 2
+    assert group.in_flight == {}
+
+
+def test_async_coalesced():
+
+    calls = []
+
+    async def fetch(town):
+        calls.append(town)
+        await asyncio.sleep(0.1)
+        return f'{town} forecast'
+
+    async def main():
+        group = single_flight.AsyncSingleFlight()
+        results = await asyncio.gather(*[group.do(('Met Office', 'London'), fetch, 'London') for _ in range(5)])
+        return group, results
+
+    group, results = asyncio.run(main())
+
+    assert results == ['London forecast'] * 5
+    assert calls == ['London']
+    assert group.in_flight == {}
+    assert single_flight.stats()['Met Office']['coalesced'] == 4
+
+
+def test_async_exception_shared():
+
+    async def fetch():
+        await asyncio.sleep(0.1)
+        raise Exception('Upstream error')
+
+    async def main():
+        group = single_flight.AsyncSingleFlight()
+        return await asyncio.gather(*[group.do(('BBC', 'London'), fetch) for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(main())
+
+    assert [str(result) for result in results] == ['Upstream error'] * 3
+    assert results[0] is results[1] is results[2]
+
+
+def test_async_caller_timeout():
+
+    # The call carries on for the others when the caller that started it gives up
+    async def fetch():
+        await asyncio.sleep(0.2)
+        return 'forecast'
+
+    async def main():
+        group = single_flight.AsyncSingleFlight()
+        key = ('Met Office', 'London')
+        leader = asyncio.ensure_future(asyncio.wait_for(group.do(key, fetch), 0.05))
+        await asyncio.sleep(0)
+        follower = group.do(key, fetch)
+        with pytest.raises(asyncio.TimeoutError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == 'forecast'
+    assert single_flight.stats()['Met Office']['upstream'] == 1
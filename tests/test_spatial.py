@@ -0,0 +1,62 @@
+# Forecast cell tests: snapping, and the distance bounds from the cell centre, including the rows at the poles
+import math
+import random
+
+import pytest
+
+import spatial  # Module for snapping locations to forecast cells
+
+
+def distance_km(latitude_1, longitude_1, latitude_2, longitude_2):
+
+    # Great-circle distance, on a sphere with spatial.KM_PER_DEGREE km per degree
+    radius = spatial.KM_PER_DEGREE * 180 / math.pi
+    latitude_1, longitude_1, latitude_2, longitude_2 = map(math.radians, (latitude_1, longitude_1, latitude_2, longitude_2))
+    h = (math.sin((latitude_2 - latitude_1) / 2) ** 2
+         + math.cos(latitude_1) * math.cos(latitude_2) * math.sin((longitude_2 - longitude_1) / 2) ** 2)
+
+    return 2 * radius * math.asin(min(1.0, math.sqrt(h)))
+
+
+def test_snap():
+
+    grid = spatial.Grid(2)
+    london = {'name': 'London', 'latitude': '51.50853', 'longitude': '-0.12574', 'location_id': 2643743}
+    nearby = {'name': 'Charing Cross', 'latitude': '51.5081', 'longitude': '-0.1248', 'location_id': 2653265}
+
+    snapped = grid.snap(london)
+
+    # Nearby places in the same cell share its centre and the first location ID looked up there
+    assert snapped['cell'] == grid.cell(51.5081, -0.1248)
+    assert grid.snap(nearby)['location_id'] == 2643743
+    assert grid.snap(nearby)['latitude'] == snapped['latitude']
+    assert distance_km(51.50853, -0.12574, float(snapped['latitude']), float(snapped['longitude'])) <= grid.max_centre_error_km()
+
+
+@pytest.mark.parametrize('cell_km', [1, 2, 25, 200, 500])
+@pytest.mark.parametrize('latitudes', ['equator', 'mid', 'north pole', 'south pole'])
+def test_centre_error_bound(cell_km, latitudes):
+
+    grid = spatial.Grid(cell_km)
+    rows = 3 * grid.latitude_step
+    low, high = {'equator': (-rows, rows), 'mid': (-60, 60), 'north pole': (90 - rows, 90), 'south pole': (-90, -90 + rows)}[latitudes]
+
+    sample = random.Random(cell_km)
+    worst = 0
+    for _ in range(5000):
+        latitude, longitude = sample.uniform(low, high), sample.uniform(-180, 180)
+        centre = grid.centre(*grid.cell(latitude, longitude))
+        worst = max(worst, distance_km(latitude, longitude, *centre))
+
+    assert worst <= grid.max_centre_error_km() * 1.01
+
+
+def test_whole_row_cell_at_pole():
+
+    # Large cells: the last row before the north pole is one cell, within cell_km / 2 pi of the pole
+    grid = spatial.Grid(500)
+    row = math.floor(180 / grid.latitude_step)
+
+    assert grid.longitude_step(row) == 360.0
+    assert grid.cell(89.9, -170) == grid.cell(89.9, 10) == (row, 0)
+    assert distance_km(-90 + row * grid.latitude_step, 0, 90, 0) <= 500 / (2 * math.pi)
@@ -0,0 +1,59 @@
+# Hourly forecast time series: turns a list of forecast steps (e.g. the Met Office 'timeSeries') into one numpy
+# column per field plus an epoch-hour -> row index, so any hour the forecast covers is an O(1) lookup.
+# One download can then answer every hour in the next ~48h without being fetched or scanned again.
+from datetime import datetime, timezone
+import calendar
+import time
+
+import numpy as np
+
+# Forecast step time format, e.g. '2024-06-21T14:00Z'
+TIME_FORMAT = '%Y-%m-%dT%H:%MZ'
+
+
+def epoch_hour(moment=None):
+
+    # Hours since 1970-01-01 00:00 UTC for a timezone aware datetime (now if not given)
+    if moment is None:
+        return int(time.time() // 3600)
+
+    return int(moment.timestamp() // 3600)
+
+
+class HourlySeries:
+
+    def __init__(self, steps, fields):
+
+        # Epoch hour of every step, and where to find it
+        hours = [calendar.timegm(time.strptime(step['time'], TIME_FORMAT)) // 3600 for step in steps]
+        self.index = {hour: row for row, hour in enumerate(hours)}
+        self.hours = np.array(hours, dtype=np.int64)
+
+        # One float column per field, NaN where a step doesn't have the field
+        self.columns = {
+            field: np.array([step.get(field, np.nan) for step in steps], dtype=float)
+            for field in fields
+        }
+
+    def __len__(self):
+        return len(self.hours)
+
+    def covers(self, hour):
+        return hour in self.index
+
+    @property
+    def first_time(self):
+        return datetime.fromtimestamp(int(self.hours[0]) * 3600, timezone.utc) if len(self) else None
+
+    @property
+    def last_time(self):
+        return datetime.fromtimestamp(int(self.hours[-1]) * 3600, timezone.utc) if len(self) else None
+
+    def row(self, hour):
+
+        # {field: value} for an epoch hour, or None if the series doesn't cover it
+        row = self.index.get(hour)
+        if row is None:
+            return None
+
+        return {field: column[row].item() for field, column in self.columns.items()}